@@ -0,0 +1,137 @@
+"""
+Compare generic flatten_for_gin/flatten_for_lists with compiled Flattener.
+
+Usage:
+
+    env/bin/python benchmarks/flatten.py
+
+"""
+
+import itertools
+import pathlib
+import timeit
+
+from qvarn.backends.postgresql import Flattener
+from qvarn.backends.postgresql import flatten_for_gin
+from qvarn.backends.postgresql import flatten_for_lists
+from qvarn.backends.postgresql import load_resource_types
+
+
+RESOURCES = pathlib.Path(__file__).resolve().parent.parent / 'tests' / 'resources'
+
+CONTACTS = [
+    {
+        'contact_type': 'phone',
+        'contact_source': 'self',
+        'contact_timestamp': '2038-02-28T01:02:03+0400',
+        'phone_number': '+358 4321',
+    },
+    {
+        'contact_type': 'email',
+        'contact_source': 'self',
+        'contact_timestamp': '2038-02-28T01:02:03+0400',
+        'email_address': 'james.bond@sis.gov.uk',
+    },
+    {
+        'contact_type': 'address',
+        'contact_source': 'self',
+        'contact_timestamp': '2038-02-28T01:02:03+0400',
+        'country': 'GB',
+        'full_address': '61 Horsen Ferry Road\nLondon S1',
+        'address_lines': ['61 Horsen Ferry Road'],
+        'post_code': 'S1',
+        'post_area': 'London',
+    },
+]
+
+RESOURCES_DATA = {
+    'person': (
+        {
+            'type': 'person',
+            'names': [
+                {
+                    'full_name': 'James Bond',
+                    'sort_key': 'Bond, James',
+                    'titles': ['Päällikkö', 'Seppä'],
+                    'given_names': ['James', '詹姆斯'],
+                    'surnames': ['Bond'],
+                },
+            ],
+        },
+        {
+            'private': {
+                'date_of_birth': '1920-11-11',
+                'gov_ids': [{'country': 'GB', 'id_type': 'ssn', 'gov_id': 'SN 00 70 07'}],
+                'nationalities': ['GB'],
+                'residences': [
+                    {'country': 'GB', 'location': 'London'},
+                    {'country': 'FI', 'location': 'Ypäjä'},
+                ],
+                'contacts': CONTACTS,
+            },
+        },
+    ),
+    'org': (
+        {
+            'type': 'org',
+            'country': 'FI',
+            'names': ['Orgtra', 'Orgtra Oy'],
+            'gov_org_ids': [
+                {'country': 'FI', 'org_id_type': 'registration_number', 'gov_org_id': '1234567-8'},
+                {'country': 'FI', 'org_id_type': 'vat_number', 'gov_org_id': 'FI12345678'},
+            ],
+            'contacts': CONTACTS,
+        },
+        {},
+    ),
+    'contract': (
+        {
+            'type': 'contract',
+            'contract_type': 'tilaajavastuu_account',
+            'preferred_language': 'fi',
+            'contract_state': 'active',
+            'start_date': '2018-01-01',
+            'contract_parties': [
+                {'type': 'person', 'role': 'user', 'resource_id': 'person-%d' % i, 'username': 'user%d' % i}
+                for i in range(10)
+            ],
+            'contract_state_history': [
+                {'state': 'draft', 'modification_timestamp': '2018-01-01T00:00:00', 'modified_by': 'admin'},
+                {'state': 'active', 'modification_timestamp': '2018-01-02T00:00:00', 'modified_by': 'admin'},
+            ],
+        },
+        {
+            'sync': {
+                'sync_revision': '42',
+                'sync_sources': [{'sync_id': 'x', 'sync_source': 'legacy'}],
+            },
+        },
+    ),
+}
+
+
+def generic(data, subpaths):
+    data = [data] + [subpaths[subpath] for subpath in sorted(subpaths) if subpaths[subpath]]
+    return list(itertools.chain.from_iterable(flatten_for_gin(x) for x in data)), flatten_for_lists(data)
+
+
+def main():
+    schemas = {schema['type']: schema for schema in load_resource_types(RESOURCES)}
+    number = 2000
+    for resource_type, (data, subpaths) in sorted(RESOURCES_DATA.items()):
+        version = schemas[resource_type]['versions'][-1]
+        files = version.get('files', [])
+        flattener = Flattener(version['prototype'], {
+            subpath: version['subpaths'][subpath]['prototype']
+            for subpath in version.get('subpaths', {}) if subpath not in files
+        })
+        assert flattener.flatten(data, subpaths)[1] == generic(data, subpaths)[1]
+        generic_time = min(timeit.repeat(lambda: generic(data, subpaths), number=number, repeat=5)) / number
+        compiled_time = min(timeit.repeat(lambda: flattener.flatten(data, subpaths), number=number, repeat=5)) / number
+        print('%-10s generic: %7.1fus  compiled: %7.1fus  speedup: %.1fx' % (
+            resource_type, generic_time * 1e6, compiled_time * 1e6, generic_time / compiled_time,
+        ))
+
+
+if __name__ == '__main__':
+    main()
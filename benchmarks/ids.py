@@ -0,0 +1,82 @@
+"""
+Compare random resource ids with time-ordered ones.
+
+Usage:
+
+    env/bin/python benchmarks/ids.py --ids 200000
+
+Ids are generated and inserted in batches of a thousand into a table with a primary key. Random ids touch pages all
+over the index, time-ordered ids only its rightmost pages, which also get filled up before they are split. Insert
+throughput differs most, once the index does not fit in shared buffers anymore.
+"""
+
+import argparse
+import hashlib
+import os
+import time
+import timeit
+
+import sqlalchemy as sa
+
+from qvarn.backends.postgresql import get_new_id
+from qvarn.backends.postgresql import settings_to_dsn
+
+
+def get_random_id(resource_type):
+    """Resource id with a fully random field, as generated before ids were time-ordered."""
+    type_field = hashlib.sha512(resource_type.encode()).hexdigest()[:4]
+    random_field = os.urandom(16).hex()
+    checksum_field = hashlib.sha512((type_field + random_field).encode()).hexdigest()[:8]
+    return '{}-{}-{}'.format(type_field, random_field, checksum_field)
+
+
+def measure(engine, generate, count, batch_size=1000):
+    metadata = sa.MetaData()
+    table = sa.Table('bench_ids', metadata, sa.Column('id', sa.String(46), primary_key=True))
+    metadata.drop_all(engine)
+    metadata.create_all(engine)
+    try:
+        start = time.perf_counter()
+        for i in range(0, count, batch_size):
+            with engine.begin() as conn:
+                conn.execute(table.insert(), [{'id': generate('orgs')} for j in range(min(batch_size, count - i))])
+        elapsed = time.perf_counter() - start
+        with engine.connect() as conn:
+            size = conn.scalar(sa.select([sa.func.pg_relation_size('bench_ids_pkey')]))
+        return elapsed, size
+    finally:
+        metadata.drop_all(engine)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--ids', type=int, default=200000)
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--dbname', default='planbtest')
+    parser.add_argument('--username', default='qvarn')
+    parser.add_argument('--password', default='qvarn')
+    args = parser.parse_args()
+
+    engine = sa.create_engine(settings_to_dsn({
+        'USERNAME': args.username,
+        'PASSWORD': args.password,
+        'HOST': args.host,
+        'PORT': None,
+        'DBNAME': args.dbname,
+    }))
+
+    schemes = (('random', get_random_id), ('ordered', get_new_id))
+    number = 100000
+    generate_times = {
+        name: min(timeit.repeat(lambda: generate('orgs'), number=number, repeat=5)) / number
+        for name, generate in schemes
+    }
+    for name, generate in schemes:
+        elapsed, size = measure(engine, generate, args.ids)
+        print('%-8s generate: %5.2fus  insert: %7.0f ids/s  index size: %6.1f MiB' % (
+            name, generate_times[name] * 1e6, args.ids / elapsed, size / 2 ** 20,
+        ))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+"""
+Measure worker startup time with many resource types.
+
+Usage:
+
+    env/bin/python benchmarks/startup.py --types 60
+
+Resource type YAML files from tests/resources are copied under new names to
+get the requested number of types. Startup is measured three times: with a
+cold schema cache and empty database, with a cold schema cache and an up to
+date database and with both warm.
+"""
+
+import argparse
+import asyncio
+import pathlib
+import tempfile
+import time
+
+import sqlalchemy as sa
+
+from qvarn.backends.postgresql import init_storage
+from qvarn.backends.postgresql import load_resource_types
+from qvarn.backends.postgresql import settings_to_dsn
+
+
+RESOURCES = pathlib.Path(__file__).resolve().parent.parent / 'tests' / 'resources'
+
+
+def generate_resource_types(path, count):
+    sources = sorted(RESOURCES.glob('*.yaml'))
+    schemas = load_resource_types(RESOURCES)
+    for i in range(count):
+        source = sources[i % len(sources)].read_text()
+        schema = schemas[i % len(sources)]
+        source = source.replace('type: %s\n' % schema['type'], 'type: bench%d\n' % i, 1)
+        source = source.replace('path: %s\n' % schema['path'], 'path: /bench%d\n' % i, 1)
+        (path / ('bench%d.yaml' % i)).write_text(source)
+
+
+def drop_tables(backend):
+    engine = sa.create_engine(settings_to_dsn(backend))
+    metadata = sa.MetaData(engine)
+    metadata.reflect(only=lambda name, meta: name.startswith('bench') or name == 'qvarn_schema')
+    metadata.drop_all()
+
+
+async def measure(settings):
+    start = time.perf_counter()
+    storage = await init_storage(settings)
+    elapsed = time.perf_counter() - start
+    storage.pool.close()
+    await storage.pool.wait_closed()
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--types', type=int, default=60)
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--dbname', default='planbtest')
+    parser.add_argument('--username', default='qvarn')
+    parser.add_argument('--password', default='qvarn')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = pathlib.Path(tmp)
+        resources = tmp / 'resources'
+        resources.mkdir()
+        generate_resource_types(resources, args.types)
+
+        backend = {
+            'USERNAME': args.username,
+            'PASSWORD': args.password,
+            'HOST': args.host,
+            'PORT': None,
+            'DBNAME': args.dbname,
+            'INITDB': True,
+        }
+        settings = {
+            'QVARN': {
+                'BACKEND': backend,
+                'RESOURCE_TYPES_PATH': str(resources),
+                'RESOURCE_TYPES_CACHE': str(tmp / 'cache.json'),
+            },
+        }
+
+        start = time.perf_counter()
+        load_resource_types(resources)
+        print('parse %d YAML files:          %.3fs' % (args.types, time.perf_counter() - start))
+        load_resource_types(resources, settings['QVARN']['RESOURCE_TYPES_CACHE'])
+        start = time.perf_counter()
+        load_resource_types(resources, settings['QVARN']['RESOURCE_TYPES_CACHE'])
+        print('load %d cached schemas:       %.3fs' % (args.types, time.perf_counter() - start))
+        (tmp / 'cache.json').unlink()
+
+        drop_tables(backend)
+        loop = asyncio.get_event_loop()
+        print('startup, empty database:       %.3fs' % loop.run_until_complete(measure(settings)))
+        (tmp / 'cache.json').unlink()
+        print('startup, cold schema cache:    %.3fs' % loop.run_until_complete(measure(settings)))
+        print('startup, warm schema cache:    %.3fs' % loop.run_until_complete(measure(settings)))
+        drop_tables(backend)
+
+
+if __name__ == '__main__':
+    main()
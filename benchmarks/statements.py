@@ -0,0 +1,153 @@
+"""
+Measure CPU spent per request in the worker and planning time spent per
+statement in PostgreSQL, with compiled query cache and prepared statements.
+
+Usage:
+
+    env/bin/python benchmarks/statements.py --requests 2000
+
+Each hot path is measured three ways: building and compiling SQLAlchemy
+queries on every call, as it was done before, with compiled queries cached
+and with cached queries executed as server-side prepared statements.
+Planning time is reported by EXPLAIN (SUMMARY), which needs PostgreSQL 10
+or newer.
+"""
+
+import argparse
+import asyncio
+import pathlib
+import time
+
+import aiopg.sa
+import sqlalchemy as sa
+
+from qvarn.backends.postgresql import PostgreSQLStorage
+from qvarn.backends.postgresql import load_resource_types
+from qvarn.backends.postgresql import settings_to_dsn
+
+
+RESOURCES = pathlib.Path(__file__).resolve().parent.parent / 'tests' / 'resources'
+
+PERSON = {
+    'type': 'person',
+    'names': [
+        {
+            'full_name': 'James Bond',
+            'sort_key': 'Bond, James',
+            'given_names': ['James'],
+            'surnames': ['Bond'],
+        },
+    ],
+}
+
+PRIVATE = {
+    'date_of_birth': '1920-11-11',
+    'nationalities': ['GB'],
+    'residences': [{'country': 'GB', 'location': 'London'}],
+}
+
+
+async def run(storage, requests, cached):
+    person = await storage.create('persons', PERSON)
+    private = await storage.put_subpath('persons', person['id'], 'private', dict(PRIVATE, revision=person['revision']))
+    person = dict(person, revision=private['revision'])
+    paths = {
+        'get': lambda: storage.get('persons', person['id']),
+        'get_subpath': lambda: storage.get_subpath('persons', person['id'], 'private'),
+        'create': lambda: storage.create('persons', PERSON),
+        'put': lambda: storage.put('persons', person['id'], person),
+        'put_subpath': lambda: storage.put_subpath('persons', person['id'], 'private', private),
+    }
+    results = {}
+    for name, call in paths.items():
+        cpu = wall = 0
+        for i in range(requests):
+            if not cached:
+                storage._queries.clear()
+            cpu_start, wall_start = time.process_time(), time.perf_counter()
+            result = await call()
+            cpu += time.process_time() - cpu_start
+            wall += time.perf_counter() - wall_start
+            if name in ('put', 'put_subpath'):
+                person = dict(person, revision=result['revision'])
+                private = dict(private, revision=result['revision'])
+        results[name] = (cpu / requests, wall / requests)
+    return results
+
+
+async def planning_time(conn, sql, params):
+    result = await conn.execute('EXPLAIN (SUMMARY, FORMAT JSON) ' + sql, params)
+    plan = (await result.first())[0]
+    return plan[0]['Planning Time']
+
+
+async def main(backend, requests):
+    dsn = settings_to_dsn(backend)
+    engine = sa.create_engine(dsn)
+    pool = await aiopg.sa.create_engine(dsn)
+    storages = [
+        ('uncached', PostgreSQLStorage(engine, pool, prepare=False), False),
+        ('compiled', PostgreSQLStorage(engine, pool, prepare=False), True),
+        ('prepared', PostgreSQLStorage(engine, pool, prepare=True), True),
+    ]
+    for name, storage, cached in storages:
+        for schema in load_resource_types(RESOURCES):
+            storage.add_resource_type(schema)
+    storages[0][1].init()
+
+    print('%-12s %-10s %12s %12s' % ('path', 'mode', 'cpu/request', 'wall/request'))
+    for name, storage, cached in storages:
+        storage.wipe_all_data('persons')
+        for path, (cpu, wall) in (await run(storage, requests, cached)).items():
+            print('%-12s %-10s %10.1fus %10.1fus' % (path, name, cpu * 1e6, wall * 1e6))
+
+    # Prepared statements have been executed many times by now, so the server uses generic plans if it can. EXPLAIN
+    # without ANALYZE plans the statements, but does not execute them.
+    storage = storages[2][1]
+    person = await storage.create('persons', PERSON)
+    values = {
+        ('get', 'person', True): {'row_id': person['id'], 'fields': None},
+        ('get_subpath', 'person', 'private'): {'row_id': person['id']},
+        ('put:select', 'person'): {'row_id': person['id']},
+        ('put', 'person'): {
+            'row_id': person['id'],
+            'old_revision': person['revision'],
+            'new_revision': person['revision'],
+            'new_data': PERSON,
+            'new_search': [],
+            'rows': [],
+        },
+    }
+    print()
+    print('%-40s %12s %12s' % ('statement', 'plain', 'prepared'))
+    for key, params in values.items():
+        query = storage._queries[key]
+        async with pool.acquire() as conn:
+            # Make sure the statement is prepared on this connection.
+            await storage._execute(conn, query, **params)
+            plain = await planning_time(conn, query.sql, query.params(params))
+            prepared = await planning_time(conn, query.execute, query.params(params))
+        print('%-40s %10.3fms %10.3fms' % (':'.join(map(str, key)), plain, prepared))
+
+    storage.wipe_all_data('persons')
+    pool.close()
+    await pool.wait_closed()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--dbname', default='planbtest')
+    parser.add_argument('--username', default='qvarn')
+    parser.add_argument('--password', default='qvarn')
+    args = parser.parse_args()
+
+    backend = {
+        'USERNAME': args.username,
+        'PASSWORD': args.password,
+        'HOST': args.host,
+        'PORT': None,
+        'DBNAME': args.dbname,
+    }
+    asyncio.get_event_loop().run_until_complete(main(backend, args.requests))
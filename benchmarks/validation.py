@@ -0,0 +1,75 @@
+"""
+Compare generic jsonschema validation with compiled Validator.
+
+JSON schemas are built from the same prototypes, allowing nulls and rejecting unknown properties the same way.
+jsonschema is a development requirement only.
+
+Usage:
+
+    env/bin/python benchmarks/validation.py
+
+"""
+
+import copy
+import timeit
+
+import jsonschema
+
+from qvarn.backends.postgresql import load_resource_types
+from qvarn.validation import Validator
+
+from flatten import RESOURCES
+from flatten import RESOURCES_DATA
+
+
+def get_json_schema(prototype):
+    """Build JSON schema of a prototype."""
+    if isinstance(prototype, dict):
+        return {
+            'type': ['object', 'null'],
+            'properties': {key: get_json_schema(value) for key, value in prototype.items()},
+            'additionalProperties': False,
+        }
+    if isinstance(prototype, list):
+        schema = {'type': ['array', 'null']}
+        if prototype:
+            schema['items'] = get_json_schema(prototype[0])
+        return schema
+    if isinstance(prototype, bool):
+        return {'type': ['boolean', 'null']}
+    if isinstance(prototype, int):
+        return {'type': ['integer', 'null']}
+    if isinstance(prototype, float):
+        return {'type': ['number', 'null']}
+    return {'type': ['string', 'null']}
+
+
+def main():
+    schemas = {schema['type']: schema for schema in load_resource_types(RESOURCES)}
+    number = 2000
+    for resource_type, (data, subpaths) in sorted(RESOURCES_DATA.items()):
+        version = schemas[resource_type]['versions'][-1]
+        prototypes = [version['prototype']] + [
+            version['subpaths'][subpath]['prototype'] for subpath in sorted(subpaths)
+        ]
+        items = [copy.deepcopy(data)] + [copy.deepcopy(subpaths[subpath]) for subpath in sorted(subpaths)]
+        generic = [jsonschema.Draft4Validator(get_json_schema(prototype)) for prototype in prototypes]
+        compiled = [Validator(prototype) for prototype in prototypes]
+
+        def run_generic():
+            for validator, item in zip(generic, items):
+                validator.validate(item)
+
+        def run_compiled():
+            for validator, item in zip(compiled, items):
+                validator.validate(item)
+
+        generic_time = min(timeit.repeat(run_generic, number=number // 10, repeat=5)) / (number // 10)
+        compiled_time = min(timeit.repeat(run_compiled, number=number, repeat=5)) / number
+        print('%-10s jsonschema: %7.1fus  compiled: %7.1fus  speedup: %.1fx' % (
+            resource_type, generic_time * 1e6, compiled_time * 1e6, generic_time / compiled_time,
+        ))
+
+
+if __name__ == '__main__':
+    main()
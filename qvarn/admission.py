@@ -0,0 +1,152 @@
+"""
+Admission control of requests.
+
+Requests are divided into route classes, each with a limit of concurrently handled requests and a bounded queue of
+requests waiting for their turn. When the queue is full, new requests are rejected right away with 503 instead of
+piling up on the storage connection pool, so that latency of accepted requests stays bounded while the database is
+slow.
+"""
+
+import asyncio
+import collections
+import functools
+import inspect
+
+from apistar import Response
+
+from qvarn import metrics
+from qvarn.exceptions import ServiceUnavailable
+
+
+ROUTE_CLASSES = ('reads', 'writes', 'searches', 'exports')
+
+# Limits of route classes, that are limited even if not configured. Each export holds a connection and a server side
+# cursor for as long as it runs.
+DEFAULT_LIMITS = {
+    'exports': {'LIMIT': 2, 'QUEUE': 10},
+}
+
+admission_active = metrics.Gauge('qvarn_admission_active', "Requests being handled, by route class.")
+
+admission_queue_depth = metrics.Gauge('qvarn_admission_queue_depth', "Requests waiting for admission, by route class.")
+
+admission_rejected = metrics.Counter(
+    'qvarn_admission_rejected', "Requests rejected with 503, because admission queue was full, by route class.",
+)
+
+
+class Admission:
+    """Limit of concurrently handled requests of a route class, with a bounded queue of waiting requests."""
+
+    def __init__(self, route_class, limit, queue, retry_after=1):
+        self.route_class = route_class
+        self.limit = limit
+        self.queue = queue
+        self.retry_after = retry_after
+        self.active = 0
+        self.waiters = collections.deque()
+
+    async def __aenter__(self):
+        if self.active < self.limit and not self.waiters:
+            self._set_active(self.active + 1)
+            return
+
+        if len(self.waiters) >= self.queue:
+            admission_rejected.inc(route_class=self.route_class)
+            raise ServiceUnavailable({
+                'error_code': 'TooManyRequests',
+                'message': 'Server is overloaded, try again later',
+            }, headers={'Retry-After': str(self.retry_after)})
+
+        waiter = asyncio.get_event_loop().create_future()
+        self.waiters.append(waiter)
+        admission_queue_depth.set(len(self.waiters), route_class=self.route_class)
+        try:
+            # Released slot is handed over to the waiter, active count stays the same.
+            await waiter
+        except asyncio.CancelledError:
+            if waiter in self.waiters:
+                self.waiters.remove(waiter)
+            elif not waiter.cancelled():
+                self._release()
+            raise
+        finally:
+            admission_queue_depth.set(len(self.waiters), route_class=self.route_class)
+
+    async def __aexit__(self, *exc_info):
+        self._release()
+
+    def _release(self):
+        while self.waiters:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self._set_active(self.active - 1)
+
+    def _set_active(self, active):
+        self.active = active
+        admission_active.set(active, route_class=self.route_class)
+
+
+def admitted(admissions, view):
+    """Wrap a view, so that it's run only when admitted in its route class.
+
+    Route class is given with route_class annotation of the view. Views without route class, or with a route class,
+    that is not limited, are returned as is. Streamed responses stay admitted until their content is sent.
+    """
+    admission = admissions.get(getattr(view, 'route_class', None))
+    if admission is None:
+        return view
+
+    @functools.wraps(view)
+    async def wrapper(*args, **kwargs):
+        await admission.__aenter__()
+        try:
+            response = await view(*args, **kwargs)
+        except BaseException:
+            await admission.__aexit__(None, None, None)
+            raise
+        if isinstance(response, Response) and inspect.isasyncgen(response.content):
+            content = admitted_content(admission, response.content)
+            # Started, so that admission is released even if content is closed or dropped before it's sent.
+            await content.__anext__()
+            response.content = content
+        else:
+            await admission.__aexit__(None, None, None)
+        return response
+
+    return wrapper
+
+
+async def admitted_content(admission, content):
+    """Pass on chunks of streamed content and release admission, once it's sent or closed."""
+    try:
+        yield b''
+        async for chunk in content:
+            yield chunk
+    finally:
+        try:
+            await content.aclose()
+        finally:
+            await admission.__aexit__(None, None, None)
+
+
+def get_admissions(settings):
+    """Return admission of each route class, or None for route classes without limits.
+
+    Limits are configured in ADMISSION settings, with LIMIT of concurrently handled requests and QUEUE size for each
+    of READS, WRITES, SEARCHES and EXPORTS route classes, exports are limited by DEFAULT_LIMITS if not configured.
+    RETRY_AFTER is the number of seconds clients are told to wait after a rejected request.
+    """
+    config = settings['QVARN'].get('ADMISSION', {})
+    admissions = {}
+    for route_class in ROUTE_CLASSES:
+        limits = config.get(route_class.upper(), DEFAULT_LIMITS.get(route_class))
+        if limits:
+            admissions[route_class] = Admission(
+                route_class, limits['LIMIT'], limits['QUEUE'], config.get('RETRY_AFTER', 1),
+            )
+        else:
+            admissions[route_class] = None
+    return admissions
@@ -1,11 +1,15 @@
 import asyncio
+import functools
+import inspect
 import logging
 import os
 import signal
+import tempfile
 
 import apistar
 import uvloop
 from apistar import Command
+from apistar import hooks
 from apistar import Component
 from apistar import Include
 from apistar import Route
@@ -14,19 +18,86 @@ from apistar import http
 from apistar.frameworks.asyncio import ASyncIOApp
 from apistar.handlers import docs_urls
 from apistar.handlers import static_urls
+from uvicorn.protocols import http as uvicorn_http
 from uvicorn.run import UvicornServer
 
 from qvarn import backends
 from qvarn import views
+from qvarn.admission import admitted
+from qvarn.admission import get_admissions
 from qvarn.auth import BearerAuthentication
+from qvarn.backends import QueryTimeout
+from qvarn.commands import export
+from qvarn.commands import import_resources
+from qvarn.commands import reindex
 from qvarn.commands import token_signing_key
+from qvarn.compression import get_compression
+from qvarn.deadlines import current_task
+from qvarn.deadlines import set_request_deadline
 from qvarn.exceptions import HTTPException
+from qvarn.timing import get_tracing
+from qvarn.timing import timed
 from qvarn.utils import merge
 
 
 logger = logging.getLogger()
 
 
+class FlowControlledReplyChannel:
+    """Reply channel, that waits until the transport can take more data, before sending a message."""
+
+    def __init__(self, channel, protocol):
+        self.channel = channel
+        self.protocol = protocol
+        self.streaming = False
+
+    async def send(self, message):
+        await self.protocol.writable.wait()
+        self.streaming = message.get('more_content', False)
+        await self.channel.send(message)
+
+
+class HttpProtocol(uvicorn_http.HttpProtocol):
+    """HTTP protocol, that cancels the request being handled, when the client disconnects.
+
+    Replies are flow controlled, so that streamed responses are produced only as fast as the client reads them.
+    """
+
+    def __init__(self, consumer, loop=None, state=None):
+        super().__init__(self.handle, loop, state)
+        self.app = consumer
+        self.request_task = None
+        self.writable = asyncio.Event()
+        self.writable.set()
+
+    async def handle(self, message, channels):
+        self.request_task = current_task()
+        reply = FlowControlledReplyChannel(channels['reply'], self)
+        try:
+            await self.app(message, dict(channels, reply=reply))
+        except Exception:
+            # Response was sent in part, the connection is closed, so that the client doesn't take it as complete.
+            if reply.streaming and self.transport is not None:
+                self.transport.close()
+            raise
+        finally:
+            self.request_task = None
+
+    def pause_writing(self):
+        super().pause_writing()
+        self.writable.clear()
+
+    def resume_writing(self):
+        super().resume_writing()
+        self.writable.set()
+
+    def connection_lost(self, exc):
+        super().connection_lost(exc)
+        self.writable.set()
+        if self.request_task is not None:
+            self.request_task.cancel()
+
+
 class QvarnUvicornServer(UvicornServer):
     def run(self, app, host, port):
         loop = asyncio.get_event_loop()
@@ -39,6 +110,11 @@ class QvarnUvicornServer(UvicornServer):
         logger.warning('Starting worker [{}] serving at: {}:{}'.format(os.getpid(), host, port))
         loop.run_forever()
 
+    async def create_server(self, loop, app, host, port):
+        protocol = functools.partial(HttpProtocol, consumer=app, loop=loop)
+        server = await loop.create_server(protocol, host=host, port=port)
+        self.servers.append(server)
+
 
 def run(app: apistar.App, host: str='127.0.0.1', port: int=8000, debug: bool=False):
     if debug:
@@ -48,6 +124,26 @@ def run(app: apistar.App, host: str='127.0.0.1', port: int=8000, debug: bool=Fal
     QvarnUvicornServer().run(app, host=host, port=port)
 
 
+class StreamingReplyChannel:
+    """Reply channel, that sends content given as an async generator of bytes in chunks, as they are produced."""
+
+    def __init__(self, channel):
+        self.channel = channel
+
+    async def send(self, message):
+        content = message.get('content')
+        if not inspect.isasyncgen(content):
+            await self.channel.send(message)
+            return
+        try:
+            await self.channel.send(dict(message, content=b'', more_content=True))
+            async for chunk in content:
+                await self.channel.send({'content': chunk, 'more_content': True})
+            await self.channel.send({'content': b'', 'more_content': False})
+        finally:
+            await content.aclose()
+
+
 class App(ASyncIOApp):
     BUILTIN_COMMANDS = [
         command for command in ASyncIOApp.BUILTIN_COMMANDS if command.name != 'run'
@@ -55,9 +151,28 @@ class App(ASyncIOApp):
         Command('run', run),
     ]
 
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.compression = get_compression(kwargs['settings'])
+        self.tracing = get_tracing(kwargs['settings'])
+
+    async def __call__(self, message, channels):
+        timing, reply = self.tracing.start(message, channels['reply'])
+        reply = self.compression.reply_channel(message, reply)
+        try:
+            await super().__call__(message, dict(channels, reply=StreamingReplyChannel(reply)))
+        finally:
+            if timing is not None:
+                self.tracing.finish(timing, message)
+
     def exception_handler(self, exc: Exception) -> http.Response:
         if isinstance(exc, HTTPException):
             return http.Response(exc.detail, status=exc.status_code, headers=exc.headers)
+        elif isinstance(exc, QueryTimeout):
+            return http.Response({
+                'error_code': 'RequestTimeout',
+                'message': 'Request was not handled before its deadline',
+            }, status=503)
         else:
             return super().exception_handler(exc)
 
@@ -77,6 +192,7 @@ async def get_app(settings: Settings=None):
                 'INITDB': True,
             },
             'RESOURCE_TYPES_PATH': '/etc/qvarn/resources',
+            'RESOURCE_TYPES_CACHE': os.path.join(tempfile.gettempdir(), 'qvarn-resource-types.json'),
             'TOKEN_ISSUER': 'https://auth-jsonb.alpha.vaultit.org',
             'TOKEN_AUDIENCE': 'http://localhost:8080',
             'TOKEN_SIGNING_KEY': (
@@ -89,8 +205,11 @@ async def get_app(settings: Settings=None):
     }
     settings = merge(default_settings, settings or {})
     settings['AUTHENTICATION'] += [BearerAuthentication(settings)]
+    settings['BEFORE_REQUEST'] = [hooks.check_permissions_async, set_request_deadline]
+    settings['AFTER_REQUEST'] = [timed('render')(hooks.render_response)]
     settings['storage'] = await backends.init(settings)
 
+    admissions = get_admissions(settings)
     routes = []
 
     if settings['DEBUG']:
@@ -101,19 +220,27 @@ async def get_app(settings: Settings=None):
 
     routes += [
         Route('/version', 'GET', views.version),
+        Route('/_metrics', 'GET', views.prometheus_metrics),
         Route('/auth/token', 'POST', views.auth_token),
-        Route('/{resource_type}', 'GET', views.resource_get),
-        Route('/{resource_type}', 'POST', views.resource_post),
-        Route('/{resource_type}/search/{query}', 'GET', views.resource_search),
-        Route('/{resource_type}/{resource_id}', 'GET', views.resource_id_get),
-        Route('/{resource_type}/{resource_id}', 'PUT', views.resource_id_put),
-        Route('/{resource_type}/{resource_id}', 'DELETE', views.resource_id_delete),
-        Route('/{resource_type}/{resource_id}/{subpath}', 'GET', views.resource_id_subpath_get),
-        Route('/{resource_type}/{resource_id}/{subpath}', 'PUT', views.resource_id_subpath_put),
+        Route('/{resource_type}', 'GET', admitted(admissions, views.resource_get)),
+        Route('/{resource_type}', 'POST', admitted(admissions, views.resource_post)),
+        Route('/{resource_type}/search/{query}', 'GET', admitted(admissions, views.resource_search)),
+        Route('/{resource_type}/_changes', 'GET', admitted(admissions, views.resource_changes)),
+        Route('/{resource_type}/_export', 'GET', admitted(admissions, views.resource_export)),
+        Route('/{resource_type}/_batch', 'GET', admitted(admissions, views.resource_batch_get)),
+        Route('/{resource_type}/_batch', 'POST', admitted(admissions, views.resource_batch_post)),
+        Route('/{resource_type}/{resource_id}', 'GET', admitted(admissions, views.resource_id_get)),
+        Route('/{resource_type}/{resource_id}', 'PUT', admitted(admissions, views.resource_id_put)),
+        Route('/{resource_type}/{resource_id}', 'DELETE', admitted(admissions, views.resource_id_delete)),
+        Route('/{resource_type}/{resource_id}/{subpath}', 'GET', admitted(admissions, views.resource_id_subpath_get)),
+        Route('/{resource_type}/{resource_id}/{subpath}', 'PUT', admitted(admissions, views.resource_id_subpath_put)),
     ]
 
     commands = [
         Command('token-signing-key', token_signing_key),
+        Command('export', export),
+        Command('import', import_resources),
+        Command('reindex', reindex),
     ]
 
     components = [
@@ -9,6 +9,7 @@ from apistar.interfaces import Router
 
 from qvarn.exceptions import Forbidden
 from qvarn.exceptions import Unauthorized
+from qvarn.timing import timed
 
 
 class BearerAuthentication:
@@ -18,6 +19,7 @@ class BearerAuthentication:
         # .exportKey('OpenSSH')
         self.pubkey = settings['QVARN']['TOKEN_SIGNING_KEY']
 
+    @timed('auth')
     def authenticate(self, authorization: http.Header, settings: Settings):
         if authorization is None:
             raise Unauthorized({
@@ -73,6 +75,7 @@ class CheckScopes:
         assert len(scopes_required) > 0
         self.scopes_required = set(scopes_required)
 
+    @timed('scopes')
     def has_permission(self, auth: Auth, router: Router, path: http.Path, method: http.Method):
         if not auth.is_authenticated():
             return False
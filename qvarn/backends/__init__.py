@@ -1,7 +1,23 @@
+import asyncio
+import copy
+import functools
 import importlib
+import urllib.parse
+import weakref
 
 from apistar import Settings
 
+from qvarn import deadlines
+from qvarn import metrics
+
+
+coalesced_reads = metrics.Counter(
+    'qvarn_coalesced_reads', "Reads, that waited for an identical read already in flight instead of a query.",
+)
+
+# In-flight reads of each event loop, keyed by storage, method name and arguments.
+_in_flight = weakref.WeakKeyDictionary()
+
 
 class StorageError(Exception):
     pass
@@ -19,6 +35,14 @@ class ResourceNotFound(StorageError):
     pass
 
 
+class IndexNotReady(StorageError):
+    pass
+
+
+class QueryTimeout(StorageError):
+    pass
+
+
 class WrongRevision(StorageError):
 
     def __init__(self, message, current, update):
@@ -27,9 +51,137 @@ class WrongRevision(StorageError):
         self.update = update
 
 
+# Number of arguments of each search operator.
+SEARCH_OPERATORS = {
+    'any': 2,
+    'contains': 2,
+    'exact': 2,
+    'ge': 2,
+    'gt': 2,
+    'le': 2,
+    'lt': 2,
+    'ne': 2,
+    'not_any': 2,
+    'startswith': 2,
+    'count': 0,
+    'exists': 0,
+    'show': 1,
+    'show_all': 0,
+    'sort': 1,
+    'offset': 1,
+    'limit': 1,
+}
+
+
+def parse_search_path(search_path):
+    """Split search path into a list of (operator, args) tuples."""
+    operators = []
+    words = map(urllib.parse.unquote, search_path.split('/'))
+    operator = next(words, None)
+    while operator:
+        if operator not in SEARCH_OPERATORS:
+            raise Exception("Unknown operator %r." % operator)
+        args_count = SEARCH_OPERATORS[operator]
+        try:
+            args = [next(words) for i in range(args_count)]
+        except StopIteration:
+            raise Exception("Operator %r requires at least %d arguments." % (operator, args_count))
+        operators.append((operator, args))
+        operator = next(words, None)
+    return operators
+
+
+def build_search_path(operators):
+    """Join a list of (operator, args) tuples back into a search path."""
+    return '/'.join(
+        urllib.parse.quote(word, safe='')
+        for operator, args in operators
+        for word in [operator] + list(args)
+    )
+
+
+def _freeze(value):
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(x) for x in value)
+    return value
+
+
+def single_flight(method):
+    """Coalesce identical concurrent calls of a storage read method.
+
+    A call made while a call with the same arguments is running in the same event loop waits for the running call
+    instead of running a query of its own. Exceptions are raised in every waiting caller. When a result is shared,
+    every caller gets a copy of it, so callers can't change results seen by others. Results don't depend on who is
+    asking, permissions are checked before storage is called, so sharing results doesn't bypass authorization.
+
+    The query runs without a deadline, each caller waits for it until its own deadline, so that a caller doesn't
+    time out because of a shorter deadline of another. A cancelled or timed out caller doesn't cancel the query of
+    others, but once the last waiting caller is gone, the query is cancelled too, so that it doesn't hold its
+    connection for nobody.
+    """
+    name = method.__name__
+
+    @functools.wraps(method)
+    async def wrapper(self, *args, **kwargs):
+        in_flight = _in_flight.setdefault(asyncio.get_event_loop(), {})
+        key = (self, name, _freeze(args), _freeze(sorted(kwargs.items())))
+        if key in in_flight:
+            flight = in_flight[key]
+            flight.shared = True
+            coalesced_reads.inc(method=name)
+        else:
+            flight = in_flight[key] = _Flight(deadlines.inherit(method(self, *args, **kwargs), deadline=False))
+
+            def done(task):
+                if in_flight.get(key) is flight:
+                    del in_flight[key]
+                if not task.cancelled():
+                    # Retrieved, so that errors of queries, that nobody waits for any more, are not logged.
+                    task.exception()
+
+            flight.task.add_done_callback(done)
+
+        def leave():
+            if flight.waiting == 1 and not flight.task.done():
+                # Nobody waits for the query any more, later callers start a query of their own.
+                if in_flight.get(key) is flight:
+                    del in_flight[key]
+                flight.task.cancel()
+
+        timeout = deadlines.get_timeout()
+        flight.waiting += 1
+        try:
+            if timeout is None:
+                result = await asyncio.shield(flight.task)
+            else:
+                result = await asyncio.wait_for(asyncio.shield(flight.task), max(timeout, 0))
+        except asyncio.CancelledError:
+            leave()
+            raise
+        except asyncio.TimeoutError as e:
+            if flight.task.done():
+                raise
+            leave()
+            raise QueryTimeout("Deadline exceeded.") from e
+        finally:
+            flight.waiting -= 1
+        return copy.deepcopy(result) if flight.shared else result
+
+    return wrapper
+
+
+class _Flight:
+    """Storage read in flight and callers waiting for it."""
+
+    def __init__(self, task):
+        self.task = task
+        self.waiting = 0
+        self.shared = False
+
+
 class Storage:
 
-    def add_resource_type(self, schema):
+    def add_resource_type(self, schema, shard=None):
         raise NotImplemented()
 
     def init(self):
@@ -38,15 +190,36 @@ class Storage:
     async def create(self, resource_path, data):
         raise NotImplemented()
 
-    async def get(self, resource_path, row_id):
+    async def get(self, resource_path, row_id, fields=None):
+        raise NotImplemented()
+
+    async def get_many(self, resource_path, row_ids, fields=None):
         raise NotImplemented()
 
     async def list(self, resource_path):
         raise NotImplemented()
 
+    async def count(self, resource_path, estimate=False):
+        raise NotImplemented()
+
     def search(self, resource_path, search_path):
         raise NotImplemented()
 
+    def export(self, resource_path, files=False):
+        raise NotImplemented()
+
+    def import_resources(self, resource_path, lines, generate_ids=False, drop_indexes=False, workers=None):
+        raise NotImplemented()
+
+    async def reindex(self, resource_path, workers=None, restart=False):
+        raise NotImplemented()
+
+    def get_resource_paths(self):
+        raise NotImplemented()
+
+    async def changes(self, resource_path, since=0, limit=1000, wait=0):
+        raise NotImplemented()
+
 
 async def init(settings: Settings):
     return await get_backend_module(settings).init_storage(settings)
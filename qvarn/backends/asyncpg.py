@@ -0,0 +1,214 @@
+"""
+PostgreSQL storage on top of asyncpg.
+
+Schema, queries and search are shared with qvarn.backends.postgresql, only the way queries are sent to the database
+differs. asyncpg talks the binary protocol, JSONB and bytea values are transferred in binary form, and every
+statement is prepared and cached per connection by asyncpg itself. Schema is still created and migrated through the
+synchronous SQLAlchemy engine, this happens only on startup.
+"""
+
+import asyncio
+import json
+
+import asyncpg
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+from apistar import Settings
+
+from qvarn.backends.postgresql import CHANGES_CHANNEL
+from qvarn.backends.postgresql import CompiledQuery
+from qvarn.backends.postgresql import PostgreSQLStorage
+from qvarn.backends.postgresql import number_params
+from qvarn.backends.postgresql import settings_to_dsn
+from qvarn.backends.postgresql import setup_storage
+
+
+def encode_jsonb(value):
+    # Binary JSONB format is a version number followed by JSON text.
+    return b'\x01' + json.dumps(value).encode()
+
+
+def decode_jsonb(data):
+    return json.loads(data[1:].decode())
+
+
+async def init_connection(conn):
+    await conn.set_type_codec(
+        'jsonb', schema='pg_catalog', format='binary',
+        encoder=encode_jsonb, decoder=decode_jsonb,
+    )
+
+
+class Connection(asyncpg.Connection):
+    """Connection, that is returned to pool without a reset query.
+
+    Storage never leaves session state behind: advisory locks are released on commit, notifications are listened on
+    a separate connection, statement_timeout is reset after use and connections of cancelled queries, that could
+    not reset it, are terminated instead of returned. This saves a round trip on every release.
+    """
+
+    def get_reset_query(self):
+        return ''
+
+    # asyncpg < 0.30
+    _get_reset_query = get_reset_query
+
+
+class Row:
+    """asyncpg record, that also gives access to values as attributes, like SQLAlchemy rows do."""
+
+    __slots__ = ('_record',)
+
+    def __init__(self, record):
+        self._record = record
+
+    def __getattr__(self, name):
+        try:
+            return self._record[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def __getitem__(self, key):
+        return self._record[key]
+
+
+class Result:
+    """Result of a query, that can be awaited or iterated asynchronously, like results of aiopg.sa."""
+
+    def __init__(self, conn, sql, args):
+        self.conn = conn
+        self.sql = sql
+        self.args = args
+        self.rows = None
+
+    def __await__(self):
+        return self._fetch().__await__()
+
+    async def _fetch(self):
+        if self.rows is None:
+            self.rows = [Row(record) for record in await self.conn.fetch(self.sql, *self.args)]
+        return self
+
+    async def __aiter__(self):
+        await self._fetch()
+        for row in self.rows:
+            yield row
+
+    async def first(self):
+        await self._fetch()
+        return self.rows[0] if self.rows else None
+
+    async def fetchall(self):
+        await self._fetch()
+        return self.rows
+
+
+class SAConnection:
+    """asyncpg connection with the subset of aiopg.sa connection interface used by PostgreSQLStorage."""
+
+    def __init__(self, conn, dialect):
+        self.connection = conn
+        self.dialect = dialect
+
+    def execute(self, query, params=None):
+        if isinstance(query, str):
+            if params:
+                query, names = number_params(query)
+                args = [params[name] for name in names]
+            else:
+                args = []
+        else:
+            query = CompiledQuery(query, self.dialect)
+            query, args = query.numbered, query.args({})
+        return Result(self.connection, query, args)
+
+    async def scalar(self, query):
+        row = await (await self.execute(query)).first()
+        return None if row is None else row[0]
+
+
+class Acquire:
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.conn = None
+
+    async def __aenter__(self):
+        self.conn = await self.pool.pool.acquire()
+        return SAConnection(self.conn, self.pool.dialect)
+
+    async def __aexit__(self, *exc_info):
+        await self.pool.pool.release(self.conn)
+
+
+class Pool:
+    """asyncpg connection pool with the subset of aiopg.sa engine interface used by PostgreSQLStorage."""
+
+    def __init__(self, pool, dsn):
+        self.pool = pool
+        self.dsn = dsn
+        self.dialect = postgresql.dialect()
+        self._closing = None
+
+    def acquire(self):
+        return Acquire(self)
+
+    def close(self):
+        self._closing = asyncio.ensure_future(self.pool.close())
+
+    async def wait_closed(self):
+        await self._closing
+
+
+class AsyncpgStorage(PostgreSQLStorage):
+
+    async def _execute(self, conn, query, **values):
+        # asyncpg prepares and caches statements by itself.
+        return await Result(conn.connection, query.numbered, query.args(values))
+
+    def _get_backend_pid(self, conn):
+        return conn.connection.get_server_pid()
+
+    def _close_connection(self, conn):
+        conn.connection.terminate()
+
+    async def _listen(self):
+        async with self._listener_lock:
+            if self._listener is not None and not self._listener.is_closed():
+                return
+            conn = await asyncpg.connect(self.pool.dsn)
+            try:
+                await conn.add_listener(CHANGES_CHANNEL, self._dispatch_notification)
+            except Exception:
+                await conn.close()
+                raise
+            self._listener = conn
+            # Writes made while not listening were missed.
+            self._invalidate_search_caches()
+
+    def _is_listening(self):
+        return self._listener is not None and not self._listener.is_closed()
+
+    def _dispatch_notification(self, conn, pid, channel, payload):
+        self._notify(payload)
+
+
+async def create_storage(backend):
+    """Create storage of a single database, without any resource types."""
+    dsn = settings_to_dsn(backend)
+    engine = sa.create_engine(dsn, echo=False)
+    # Server-side prepared statements are bound to a server connection, which is not the case with pgbouncer in
+    # transaction pooling mode.
+    prepare = backend.get('PREPARED_STATEMENTS', True)
+    pool = await asyncpg.create_pool(
+        dsn,
+        connection_class=Connection,
+        init=init_connection,
+        statement_cache_size=100 if prepare else 0,
+    )
+    return AsyncpgStorage(engine, Pool(pool, dsn), prepare=prepare)
+
+
+async def init_storage(settings: Settings):
+    return await setup_storage(settings, create_storage)
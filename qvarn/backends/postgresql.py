@@ -1,34 +1,104 @@
 import aiopg.sa
+import asyncio
+import base64
 import collections
+import concurrent.futures
+import copy
+import functools
 import hashlib
+import io
 import itertools
+import json
+import logging
+import multiprocessing
 import operator
 import os
 import pathlib
-import urllib.parse
+import re
+import tempfile
+import time
+import weakref
+from concurrent.futures import ThreadPoolExecutor
 
 import ruamel.yaml as yaml
 import sqlalchemy as sa
-from sqlalchemy.engine import reflection
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.dialects.postgresql import ARRAY
 from sqlalchemy.dialects.postgresql import JSONB
 from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.schema import CreateTable
 
 from apistar import Settings
 
+from qvarn import deadlines
+from qvarn import metrics
+from qvarn import timing
 from qvarn.backends import Storage
+from qvarn.backends import IndexNotReady
+from qvarn.backends import QueryTimeout
 from qvarn.backends import ResourceNotFound
 from qvarn.backends import ResourceTypeNotFound
 from qvarn.backends import WrongRevision
 from qvarn.backends import UnexpectedError
-from qvarn.validation import validated
+from qvarn.backends import parse_search_path
+from qvarn.backends import single_flight
+from qvarn.backends.sharding import ShardedStorage
+from qvarn.validation import ValidationError
+from qvarn.validation import get_validator
+
+
+logger = logging.getLogger(__name__)
 
 
 Index = collections.namedtuple('Index', ('name', 'using', 'table', 'columns'))
 
+Catalog = collections.namedtuple('Catalog', ('tables', 'indexes'))
+
+Migration = collections.namedtuple('Migration', ('action', 'table', 'name'))
+
+MIGRATION_LOCK_ID = 0x717661726e  # 'qvarn'
+
+# Sequence numbers of changes are ids of writing transactions times this, plus the number of the change within the
+# transaction, so a transaction can log up to this many changes.
+CHANGES_PER_TRANSACTION = 2 ** 20
+
+CHANGES_CHANNEL = 'qvarn_changes'
+
+EXPORT_BATCH_SIZE = 1000
+
+IMPORT_BATCH_SIZE = 10000
+
+REINDEX_BATCH_SIZE = 1000
+
+REINDEX_CONCURRENCY = 4
+
+# Data of file subpaths is written by put_file, not by clients, so it's validated against this instead of prototype.
+FILE_PROTOTYPE = {'content-type': ''}
+
+search_cache_requests = metrics.Counter(
+    'qvarn_search_cache_requests', "Searches of resource types with search cache, by cache hit or miss.",
+)
+
+aux_rows_written = metrics.Summary('qvarn_aux_rows_written', "Aux table rows inserted or deleted per write.")
+
 
-def get_new_id(resource_type, random_field=None):
-    type_field = hashlib.sha512(resource_type.encode()).hexdigest()[:4]
-    random_field = random_field or os.urandom(16).hex()
+@functools.lru_cache(maxsize=None)
+def get_type_field(resource_type):
+    return hashlib.sha512(resource_type.encode()).hexdigest()[:4]
+
+
+def get_new_id(resource_type, random_field=None, shard=None):
+    """Generate a new resource id.
+
+    The random field starts with microseconds since the epoch, followed by random bytes, like ULID, so that new ids
+    are appended to the end of primary key indexes instead of being scattered all over them. If shard is given, its
+    number is stored in the last byte of the random field, so that resources of hash sharded resource types can be
+    found without a lookup, see qvarn.backends.sharding.get_id_shard.
+    """
+    type_field = get_type_field(resource_type)
+    random_field = random_field or '%014x%s' % (int(time.time() * 1000000), os.urandom(9).hex())
+    if shard is not None:
+        random_field = random_field[:-2] + '%02x' % shard
     checksum_field = hashlib.sha512((type_field + random_field).encode()).hexdigest()[:8]
     return '{}-{}-{}'.format(type_field, random_field, checksum_field)
 
@@ -87,6 +157,175 @@ def clean_search_value(value):
     return value
 
 
+class ShapeMismatch(Exception):
+    pass
+
+
+class Flattener:
+    """Flattener for resources of a known shape, compiled from resource and subpath prototypes.
+
+    Produces the same rows as flatten_for_lists and the same (up to order) items as flatten_for_gin, but without
+    recursion and sorting. Prototype is turned into Python source with a nested loop for each list and a bucket for
+    each (name, depth) pair, so leaves end up in the depth order flatten_for_lists sorts them into.
+
+    Resources not matching prototype shape are flattened with generic functions.
+    """
+
+    def __init__(self, prototype, subpaths=None):
+        self.subpaths = sorted(subpaths or {})
+        self.buckets = {}
+        self.keys = []
+        lines = []
+        args = ['data'] + ['subpath_%d' % i for i in range(len(self.subpaths))]
+        prototypes = [prototype] + [subpaths[subpath] for subpath in self.subpaths]
+        for arg, proto in zip(args, prototypes):
+            lines.append('    if %s is not None:' % arg)
+            self._compile(lines, proto, arg, None, 0, 2)
+        buckets = ['b%d' % i for i in range(len(self.buckets))]
+        source = '\n'.join(
+            ['def flatten(%s):' % ', '.join(args), '    gin = []', '    gin_append = gin.append'] +
+            ['    %s = []\n    %s_append = %s.append' % (bucket, bucket, bucket) for bucket in buckets] +
+            lines +
+            ['    return gin, (%s)' % ''.join(bucket + ', ' for bucket in buckets)]
+        )
+        namespace = {'ShapeMismatch': ShapeMismatch, 'MISSING': object()}
+        namespace.update(('keys_%d' % i, keys) for i, keys in enumerate(self.keys))
+        exec(compile(source, '<flattener>', 'exec'), namespace)
+        self._flatten = namespace['flatten']
+        self.source = source
+
+        # Bucket indexes of each name sorted by depth, names sorted as in flatten_for_lists.
+        self.plan = [
+            (name, [index for (_, depth), index in sorted(
+                (item for item in self.buckets.items() if item[0][0] == name),
+                key=lambda item: item[0][1],
+            )])
+            for name in sorted({name for name, depth in self.buckets})
+        ]
+
+    def _compile(self, lines, proto, var, key, depth, level):
+        indent = '    ' * level
+        if isinstance(proto, dict):
+            self.keys.append(frozenset(proto))
+            lines.append(indent + 'if type(%s) is not dict or not keys_%d.issuperset(%s):' % (
+                var, len(self.keys) - 1, var))
+            lines.append(indent + '    raise ShapeMismatch')
+            for i, k in enumerate(sorted(proto)):
+                value = '%s_%d' % (var, i)
+                lines.append(indent + '%s = %s.get(%r, MISSING)' % (value, var, k))
+                lines.append(indent + 'if %s is not MISSING:' % value)
+                self._compile(lines, proto[k], value, k, depth + 1, level + 1)
+        elif isinstance(proto, list):
+            lines.append(indent + 'if type(%s) is not list:' % var)
+            lines.append(indent + '    raise ShapeMismatch')
+            if proto:
+                item = var + '_i'
+                lines.append(indent + 'for %s in %s:' % (item, var))
+                self._compile(lines, proto[0], item, key, depth + 1, level + 1)
+            else:
+                lines.append(indent + 'if %s:' % var)
+                lines.append(indent + '    raise ShapeMismatch')
+        else:
+            bucket = self.buckets.setdefault((key, depth), len(self.buckets))
+            lines.append(indent + 'if type(%s) is str:' % var)
+            lines.append(indent + '    %s = %s.lower()' % (var, var))
+            lines.append(indent + 'elif isinstance(%s, (dict, list, tuple)):' % var)
+            lines.append(indent + '    raise ShapeMismatch')
+            lines.append(indent + 'elif isinstance(%s, str):' % var)
+            lines.append(indent + '    %s = %s.lower()' % (var, var))
+            lines.append(indent + 'gin_append({%r: %s})' % (key, var))
+            lines.append(indent + 'b%d_append(%s)' % (bucket, var))
+
+    def flatten(self, data, subpaths=None):
+        """Return a list of items for the GIN indexed search column and a list of rows for the aux table.
+
+        Args:
+            data: resource data.
+            subpaths: dict of subpath data by subpath name.
+        """
+        subpaths = subpaths or {}
+        try:
+            gin, buckets = self._flatten(data, *(subpaths.get(subpath) or None for subpath in self.subpaths))
+        except ShapeMismatch:
+            data = [data] + [subpaths[subpath] for subpath in self.subpaths if subpaths.get(subpath)]
+            return list(itertools.chain.from_iterable(flatten_for_gin(x) for x in data)), flatten_for_lists(data)
+
+        rows = []
+        for name, indexes in self.plan:
+            i = 0
+            for index in indexes:
+                for value in buckets[index]:
+                    if i == len(rows):
+                        rows.append({})
+                    rows[i][name] = value
+                    i += 1
+        return gin, rows
+
+
+def project(column, fields):
+    """SQL expression, that builds a JSONB object containing only given top level fields of a JSONB column.
+
+    Fields missing in data are left out, if none of fields are present, NULL is returned. Fields are either a list of
+    field names, or a bind parameter to pass them on execution.
+    """
+    if not isinstance(fields, sa.sql.elements.BindParameter):
+        fields = sa.bindparam(None, list(fields), type_=ARRAY(sa.Text))
+    each = sa.func.jsonb_each(column).alias('each')
+    key = sa.column('key', type_=sa.Text)
+    value = sa.column('value', type_=JSONB)
+    return (
+        sa.select([sa.func.jsonb_object_agg(key, value)]).
+        select_from(each).
+        where(key == sa.any_(fields)).
+        as_scalar()
+    )
+
+
+def number_params(sql):
+    """Replace psycopg2 pyformat parameters with numbered ones.
+
+    Returns SQL with numbered parameters and a list of parameter names in the order of their numbers.
+    """
+    names = []
+
+    def number(match):
+        if match.group(1) not in names:
+            names.append(match.group(1))
+        return '$%d' % (names.index(match.group(1)) + 1)
+
+    return re.sub(r'%\(([^)]+)\)s', number, sql).replace('%%', '%'), names
+
+
+class CompiledQuery:
+    """A fixed shape SQLAlchemy Core query, compiled to SQL once.
+
+    Values are passed on execution as bind parameters. The same query can be executed as a named server-side prepared
+    statement, so that PostgreSQL does not parse and plan it again on every execution.
+    """
+
+    def __init__(self, query, dialect):
+        compiled = query.compile(dialect=dialect)
+        self.sql = compiled.string
+        self.processors = compiled._bind_processors
+        self.defaults = compiled.params
+        self.name = 'qvarn_' + hashlib.sha1(self.sql.encode()).hexdigest()[:16]
+        self.numbered, self.names = number_params(self.sql)
+        self.prepare = 'PREPARE %s AS %s' % (self.name, self.numbered)
+        self.execute = 'EXECUTE %s (%s)' % (self.name, ', '.join('%%(%s)s' % name for name in self.names))
+
+    def params(self, values):
+        params = dict(self.defaults, **values)
+        for key, process in self.processors.items():
+            if key in params:
+                params[key] = process(params[key])
+        return params
+
+    def args(self, values):
+        """Positional values for numbered parameters, without bind processing."""
+        params = dict(self.defaults, **values)
+        return [params[name] for name in self.names]
+
+
 def get_prototype_schema(prototype):
     by_key = operator.attrgetter('name')
     by_depth = operator.attrgetter('depth')
@@ -101,6 +340,229 @@ def get_prototype_schema(prototype):
     return schema
 
 
+ImportConfig = collections.namedtuple(
+    'ImportConfig', ('resource_type', 'prototype', 'subpaths', 'files', 'shard', 'generate_ids'),
+)
+
+ReindexConfig = collections.namedtuple('ReindexConfig', ('resource_type', 'prototype', 'subpaths'))
+
+# Flatteners of worker processes, built on first batch of an import or reindex.
+_worker_flatteners = {}
+
+
+def get_worker_flattener(resource_type, prototype, subpaths):
+    """Return flattener of a resource type in a worker process, subpaths is a sequence of (name, prototype) pairs."""
+    key = (resource_type, json.dumps([prototype, subpaths], sort_keys=True))
+    flattener = _worker_flatteners.get(key)
+    if flattener is None:
+        flattener = _worker_flatteners[key] = Flattener(prototype, dict(subpaths))
+    return flattener
+
+
+def copy_value(value):
+    """Encode a value as a field of COPY text format, JSON values are encoded as JSON."""
+    if value is None:
+        return '\\N'
+    if isinstance(value, bytes):
+        value = '\\x' + value.hex()
+    elif not isinstance(value, str):
+        value = json.dumps(value, ensure_ascii=False, separators=(',', ':'))
+    return value.replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
+def copy_row(*values):
+    return '\t'.join(copy_value(value) for value in values) + '\n'
+
+
+def prepare_import(config, lines):
+    """Turn NDJSON lines in export format into COPY rows of main, aux and files tables.
+
+    Ids and revisions of resources are kept, unless config asks to generate new ones. Run in worker processes, search
+    and aux rows are computed the same way as on create.
+    """
+    flattener = get_worker_flattener(config.resource_type, config.prototype, [
+        (subpath, prototype) for subpath, prototype in config.subpaths if subpath not in config.files
+    ])
+    subpaths = [subpath for subpath, prototype in config.subpaths]
+    validator = get_validator(config.prototype)
+    validators = [
+        (subpath, get_validator(FILE_PROTOTYPE if subpath in config.files else prototype))
+        for subpath, prototype in config.subpaths
+    ]
+    main, aux, files = [], [], []
+    for line in lines:
+        item = json.loads(line)
+        resource = item['resource']
+        unknown = set(item.get('subpaths', {})).union(item.get('files', {})).difference(subpaths)
+        if unknown:
+            raise ValueError("Unknown subpaths %s of resource %s." % (', '.join(sorted(unknown)), resource.get('id')))
+        if config.generate_ids or not resource.get('id'):
+            row_id = get_new_id(config.resource_type, shard=config.shard)
+            revision = get_new_id(config.resource_type)
+        else:
+            row_id = resource['id']
+            revision = resource.get('revision') or get_new_id(config.resource_type)
+        try:
+            data = validator.validate(resource)
+            subpath_data = {
+                subpath: subpath_validator.validate(item['subpaths'][subpath])
+                for subpath, subpath_validator in validators if item.get('subpaths', {}).get(subpath) is not None
+            }
+        except ValidationError as e:
+            # Raised again as ValueError, that can be passed back from worker processes.
+            raise ValueError("Resource %s is not valid: %s" % (resource.get('id'), e.message))
+        search, rows = flattener.flatten(data, subpath_data)
+        main.append(copy_row(row_id, revision, search, data, *(subpath_data.get(subpath) for subpath in subpaths)))
+        aux.extend(copy_row(row_id, row) for row in rows)
+        files.extend(
+            copy_row(row_id, subpath, base64.b64decode(blob)) for subpath, blob in item.get('files', {}).items()
+        )
+    return len(lines), ''.join(main), ''.join(aux), ''.join(files)
+
+
+def prepare_reindex(config, rows):
+    """Recompute search column and aux rows of (id, revision, data, subpaths) rows. Run in worker processes."""
+    flattener = get_worker_flattener(config.resource_type, config.prototype, config.subpaths)
+    prepared = []
+    for row_id, revision, data, subpaths in rows:
+        search, aux = flattener.flatten(data, subpaths)
+        prepared.append({'id': row_id, 'revision': revision, 'search': search, 'aux': aux})
+    return prepared
+
+
+def imap_bounded(pool, func, iterable, size):
+    """Like Pool.imap, but with at most size items handed to workers at a time."""
+    pending = collections.deque()
+    for item in iterable:
+        pending.append(pool.apply_async(func, (item,)))
+        if len(pending) >= size:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+
+SEARCH_FILTERS = ('any', 'contains', 'exact', 'ge', 'gt', 'le', 'lt', 'ne', 'not_any', 'startswith')
+
+
+def get_search_key(operators):
+    """Return a cache key of parsed search operators.
+
+    Order of filters doesn't change results, filters are sorted, so that the same search written differently shares
+    the key. Order of other operators is kept.
+    """
+    return (
+        tuple(sorted((operator, tuple(args)) for operator, args in operators if operator in SEARCH_FILTERS)),
+        tuple((operator, tuple(args)) for operator, args in operators if operator not in SEARCH_FILTERS),
+    )
+
+
+def get_matched_values(row, matches):
+    """Return values of each any operator, that matched a row, as they were given in the search path."""
+    matched = {}
+    for i, (key, given) in enumerate(matches):
+        found = {json.dumps(item[key]) for item in row['matched%d' % i] or ()}
+        matched.setdefault(key, []).extend(
+            value for normalized, values in given.items() if normalized in found for value in values
+        )
+    return matched
+
+
+class SearchCache:
+    """Bounded LRU cache of search results of a resource type.
+
+    Every write to the resource type, made by this or any other worker, bumps the generation of the cache and drops
+    all entries at once. Results of searches, that started before the last write, are not stored.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.generation = 0
+        self.entries = collections.OrderedDict()
+
+    def invalidate(self):
+        self.generation += 1
+        self.entries = collections.OrderedDict()
+
+    def get(self, key):
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+    def put(self, key, generation, result):
+        if generation == self.generation:
+            self.entries[key] = result
+            if len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+
+def is_query_canceled(exc):
+    # SQLSTATE of queries cancelled by statement_timeout or a cancel request, psycopg2 and asyncpg errors.
+    return getattr(exc, 'pgcode', None) == '57014' or getattr(exc, 'sqlstate', None) == '57014'
+
+
+class StorageConnection:
+    """Pool connection of a storage call, bound by the deadline of the current task.
+
+    Waiting for a connection is limited by the time left until the deadline and statement_timeout is set to it. If
+    the task is cancelled while the connection is in use, the running query is cancelled in the database too,
+    instead of running on until it's done.
+    """
+
+    def __init__(self, storage):
+        self.storage = storage
+        self.context = None
+        self.conn = None
+        self.pid = None
+        self.timeout = None
+        self.acquired = None
+
+    async def __aenter__(self):
+        timeout = deadlines.get_timeout()
+        if timeout is not None and timeout <= 0:
+            raise QueryTimeout("Deadline exceeded.")
+        start = timing.now()
+        self.context = self.storage.pool.acquire()
+        try:
+            if timeout is None:
+                self.conn = await self.context.__aenter__()
+            else:
+                try:
+                    self.conn = await asyncio.wait_for(self.context.__aenter__(), timeout)
+                except asyncio.TimeoutError:
+                    raise QueryTimeout("Deadline exceeded while waiting for a connection.")
+        finally:
+            timing.record('pool', start)
+        self.acquired = timing.now()
+        self.pid = self.storage._get_backend_pid(self.conn)
+        if timeout is not None:
+            self.timeout = timeout
+            try:
+                await self.conn.execute('SET statement_timeout = %d' % max(1, int(timeout * 1000)))
+            except BaseException as e:
+                await self.__aexit__(type(e), e, e.__traceback__)
+                raise
+        return self.conn
+
+    async def __aexit__(self, exc_type, exc, tb):
+        try:
+            if isinstance(exc, asyncio.CancelledError):
+                self.storage._cancel_query(self.conn, self.pid)
+            elif self.timeout is not None:
+                try:
+                    await self.conn.execute('RESET statement_timeout')
+                except Exception:
+                    # Connection must not go back to the pool with statement_timeout still set.
+                    self.storage._close_connection(self.conn)
+        finally:
+            await self.context.__aexit__(exc_type, exc, tb)
+            timing.record('db', self.acquired)
+        if self.timeout is not None and exc is not None:
+            timeout = deadlines.get_timeout()
+            if is_query_canceled(exc) or (isinstance(exc, asyncio.CancelledError) and timeout is not None and
+                                          timeout <= 0):
+                raise QueryTimeout("Deadline exceeded.") from exc
+
+
 class Field:
 
     def __init__(self, name, values, inlist):
@@ -119,44 +581,235 @@ class Field:
 
 class PostgreSQLStorage(Storage):
 
-    def __init__(self, engine, pool):
+    def __init__(self, engine, pool, prepare=True):
         self.indexes = []
         self.engine = engine
         self.pool = pool
+        self.prepare = prepare
         self.metadata = sa.MetaData(engine)
-        self.inspector = reflection.Inspector.from_engine(engine)
+        self.schema_table = sa.Table(
+            'qvarn_schema', self.metadata,
+            sa.Column('key', sa.String(64), primary_key=True),
+            sa.Column('fingerprint', sa.String(64), nullable=False),
+        )
+        # Position of interrupted reindexes, by resource type.
+        self.reindex_table = sa.Table(
+            'qvarn_reindex', self.metadata,
+            sa.Column('resource_type', sa.String(255), primary_key=True),
+            sa.Column('last_id', sa.String(46), nullable=False),
+        )
         self.tables = {}
         self.aux_tables = {}
         self.files_tables = {}
+        self.changes_tables = {}
+        self.flatteners = {}
+        self.validators = {}
         self._resources_by_path = {}
         self.schema = {}
+        self.partitions = {}
+        self.shards = {}
+        self.search_caches = {}
+        self.pending_indexes = set()
+        self.migration = None
+        self._listener = None
+        self._listener_lock = asyncio.Lock()
+        self._change_events = {}
+        self._queries = {}
+        self._prepared = weakref.WeakKeyDictionary()
 
     def _add_index(self, name, table, *columns, using='gin'):
         self.indexes.append(Index(name, using, table, columns))
 
-    def _create_indexes(self):
-        self.inspector = reflection.Inspector.from_engine(self.engine)
-        existing_tables = self.inspector.get_table_names()
-        sort_key = operator.attrgetter('table')
-        indexes = sorted(self.indexes, key=sort_key)
-        indexes = itertools.groupby(indexes, key=sort_key)
-        for table, table_indexes in indexes:
-            if table in existing_tables:
-                existing_indexes = {x['name'] for x in self.inspector.get_indexes(table)}
-                for index in table_indexes:
-                    if index.name not in existing_indexes:
-                        if index.using == 'gin':
-                            idx = sa.Index(
-                                index.name, *index.columns,
-                                postgresql_using='gin',
-                                postgresql_ops={'data': 'jsonb_path_ops'},
-                            )
-                        else:
-                            raise Exception(
-                                "Unknown index 'using' paramter: %r." %
-                                index.using
-                            )
-                        idx.create()
+    def _get_catalog(self, conn):
+        """Reflect all tables with their columns and indexes in the current schema with a single catalog query.
+
+        Returns a Catalog where tables maps table names to sets of column names and indexes maps index names to
+        index validity, invalid indexes are left behind by failed concurrent index builds.
+        """
+        result = conn.execute(sa.text(
+            "SELECT t.relname AS table_name, "
+            "  ARRAY("
+            "    SELECT a.attname FROM pg_attribute a "
+            "    WHERE a.attrelid = t.oid AND a.attnum > 0 AND NOT a.attisdropped"
+            "  ) AS columns, "
+            "  ARRAY("
+            "    SELECT i.relname FROM pg_index x JOIN pg_class i ON i.oid = x.indexrelid "
+            "    WHERE x.indrelid = t.oid AND x.indisvalid"
+            "  ) AS valid_indexes, "
+            "  ARRAY("
+            "    SELECT i.relname FROM pg_index x JOIN pg_class i ON i.oid = x.indexrelid "
+            "    WHERE x.indrelid = t.oid AND NOT x.indisvalid"
+            "  ) AS invalid_indexes "
+            "FROM pg_class t "
+            "WHERE t.relkind IN ('r', 'p') AND t.relnamespace = to_regnamespace(current_schema())"
+        ))
+        tables = {}
+        indexes = {}
+        for row in result:
+            tables[row.table_name] = set(row.columns)
+            indexes.update((name, True) for name in row.valid_indexes)
+            indexes.update((name, False) for name in row.invalid_indexes)
+        return Catalog(tables, indexes)
+
+    def _get_schema_fingerprint(self):
+        """Hash of all DDL statements needed to create current tables and indexes."""
+        dialect = postgresql.dialect()
+        fingerprint = hashlib.sha256()
+        for table in self.metadata.sorted_tables:
+            fingerprint.update(str(CreateTable(table).compile(dialect=dialect)).encode())
+        for index in self.indexes:
+            fingerprint.update(repr((index.name, index.using, index.table, [c.name for c in index.columns])).encode())
+        fingerprint.update(repr(sorted(self.partitions.items())).encode())
+        return fingerprint.hexdigest()
+
+    def _get_stored_fingerprint(self, conn):
+        exists = conn.execute(sa.select([sa.func.to_regclass(self.schema_table.name)])).scalar()
+        if exists is None:
+            return None
+        return conn.execute(
+            sa.select([self.schema_table.c.fingerprint]).
+            where(self.schema_table.c.key == 'tables')
+        ).scalar()
+
+    def _store_fingerprint(self, conn, fingerprint):
+        conn.execute(
+            insert(self.schema_table).
+            values(key='tables', fingerprint=fingerprint).
+            on_conflict_do_update(
+                index_elements=[self.schema_table.c.key],
+                set_={'fingerprint': fingerprint},
+            )
+        )
+
+    def _get_index(self, index, partition=None):
+        name, columns = index.name, index.columns
+        if partition is not None:
+            # Index of a single partition, numbered the same way as partition.
+            table = self.metadata.tables[index.table].tometadata(sa.MetaData(), name=partition)
+            name = self._get_partition_name(name, self.partitions[index.table].index(partition))
+            columns = [table.c[column.name] for column in columns]
+        if index.using == 'gin':
+            return sa.Index(
+                name, *columns,
+                postgresql_using='gin',
+                postgresql_ops={'data': 'jsonb_path_ops'},
+            )
+        else:
+            raise Exception(
+                "Unknown index 'using' paramter: %r." %
+                index.using
+            )
+
+    def plan_migrations(self, catalog):
+        """Compare defined tables and indexes with live database catalog and return a list of needed migrations.
+
+        Missing tables are not included, they are created with all their indexes by metadata.create_all().
+        """
+        migrations = []
+        for table in self.metadata.sorted_tables:
+            if table.name in catalog.tables:
+                for column in table.columns:
+                    if column.name not in catalog.tables[table.name]:
+                        migrations.append(Migration('add_column', table.name, column.name))
+        for index in self.indexes:
+            if index.table in catalog.tables:
+                if catalog.indexes.get(index.name) is False:
+                    migrations.append(Migration('drop_index', index.table, index.name))
+                if not catalog.indexes.get(index.name):
+                    migrations.append(Migration('create_index', index.table, index.name))
+        return migrations
+
+    def _add_column(self, conn, table_name, column_name):
+        table = self.metadata.tables[table_name]
+        column = table.c[column_name]
+        # Nullable columns without a default are added without rewriting the table.
+        assert column.nullable and column.server_default is None
+        conn.execute('ALTER TABLE %s ADD COLUMN IF NOT EXISTS %s %s' % (
+            conn.dialect.identifier_preparer.format_table(table),
+            conn.dialect.identifier_preparer.format_column(column),
+            column.type.compile(dialect=conn.dialect),
+        ))
+
+    def _build_index_concurrently(self, index, progress_interval=10):
+        """Build an index without blocking writes, logging build progress while waiting.
+
+        Indexes can't be built concurrently on partitioned tables. Instead, an index is created on the partitioned
+        table only, then an index is built concurrently on each partition, one by one, and attached to it. The index
+        becomes valid, when all partitions are attached. Indexes already built on partitions are reused.
+        """
+        def compile(index):
+            return str(sa.schema.CreateIndex(index).compile(dialect=self.engine.dialect))
+
+        def build():
+            # CREATE INDEX CONCURRENTLY can't be run inside a transaction block.
+            with self.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+                if index.table not in self.partitions:
+                    conn.execute('DROP INDEX CONCURRENTLY IF EXISTS %s' % index.name)
+                    conn.execute(compile(self._get_index(index)).replace(
+                        'CREATE INDEX', 'CREATE INDEX CONCURRENTLY IF NOT EXISTS', 1,
+                    ))
+                    return
+
+                conn.execute(compile(self._get_index(index)).replace(
+                    'CREATE INDEX', 'CREATE INDEX IF NOT EXISTS', 1,
+                ).replace(' ON ', ' ON ONLY ', 1))
+                for partition in self.partitions[index.table]:
+                    partition_index = self._get_index(index, partition)
+                    if not self._get_catalog(conn).indexes.get(partition_index.name):
+                        logger.info("Building index %s on partition %s.", partition_index.name, partition)
+                        conn.execute('DROP INDEX CONCURRENTLY IF EXISTS %s' % partition_index.name)
+                        conn.execute(compile(partition_index).replace('CREATE INDEX', 'CREATE INDEX CONCURRENTLY', 1))
+                    conn.execute('ALTER INDEX %s ATTACH PARTITION %s' % (index.name, partition_index.name))
+
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            future = executor.submit(build)
+            while True:
+                try:
+                    return future.result(timeout=progress_interval)
+                except concurrent.futures.TimeoutError:
+                    self._log_index_progress(index)
+
+    def _log_index_progress(self, index):
+        try:
+            with self.engine.connect() as conn:
+                row = conn.execute(sa.text(
+                    "SELECT phase, blocks_done, blocks_total, tuples_done, tuples_total "
+                    "FROM pg_stat_progress_create_index "
+                    "WHERE relid = to_regclass(:table) "
+                    "OR relid IN (SELECT inhrelid FROM pg_inherits WHERE inhparent = to_regclass(:table))"
+                ), table=index.table).first()
+        except sa.exc.DBAPIError:
+            # pg_stat_progress_create_index is available since PostgreSQL 12.
+            row = None
+        if row:
+            logger.info("Building index %s: %s, blocks %s/%s, tuples %s/%s.", index.name, row.phase,
+                        row.blocks_done, row.blocks_total, row.tuples_done, row.tuples_total)
+        else:
+            logger.info("Building index %s.", index.name)
+
+    def migrate(self):
+        """Build all pending indexes concurrently, activating searches depending on each index once it is valid.
+
+        Intended to be run in a background thread, because building indexes on large tables can take a long time.
+        An advisory lock makes sure, that only one worker builds indexes, others wait until the build is finished.
+        """
+        fingerprint = self._get_schema_fingerprint()
+        with self.engine.connect() as lock:
+            lock.execute(sa.select([sa.func.pg_advisory_lock(MIGRATION_LOCK_ID)]))
+            try:
+                for index in self.indexes:
+                    if index.name in self.pending_indexes:
+                        with self.engine.connect() as conn:
+                            valid = self._get_catalog(conn).indexes.get(index.name)
+                        if not valid:
+                            logger.warning("Building index %s on %s concurrently.", index.name, index.table)
+                            self._build_index_concurrently(index)
+                            logger.warning("Index %s is ready.", index.name)
+                        self.pending_indexes.discard(index.name)
+                with self.engine.begin() as conn:
+                    self._store_fingerprint(conn, fingerprint)
+            finally:
+                lock.execute(sa.select([sa.func.pg_advisory_unlock(MIGRATION_LOCK_ID)]))
 
     def _create_tables(self, schema):
         version = schema['versions'][-1]
@@ -164,6 +817,11 @@ class PostgreSQLStorage(Storage):
         resource_type = schema['type']
         files = version.get('files', [])
 
+        # Main, aux and files tables can be hash partitioned by resource id, all rows of a resource are in partitions
+        # with the same number.
+        partitions = schema.get('partitions')
+        partition_by = {'postgresql_partition_by': 'HASH (id)'} if partitions else {}
+
         # Define main table
         main_table = sa.Table(
             chop_long_name(resource_type), self.metadata,
@@ -173,19 +831,23 @@ class PostgreSQLStorage(Storage):
             sa.Column('data', JSONB, nullable=False), *(
                 sa.Column('data_' + subpath, JSONB, nullable=True)
                 for subpath in sorted(subpaths.keys())
-            )
+            ),
+            **partition_by
         )
+        self._add_partitions(main_table, partitions)
         self.tables[resource_type] = main_table
 
         # Define gin index for EXACT searches
-        self._add_index(chop_long_name('gin_idx_' + resource_type), main_table.name, main_table.c.search)
+        self._add_index(self._get_gin_index_name(resource_type), main_table.name, main_table.c.search)
 
         # Define auxiliary tables and gin indexes for all nested lists.
         aux_table = sa.Table(
             chop_long_name(resource_type + '__aux'), self.metadata,
             sa.Column('id', sa.ForeignKey(main_table.c.id, ondelete='CASCADE'), index=True),
             sa.Column('data', JSONB, nullable=False),
+            **partition_by
         )
+        self._add_partitions(aux_table, partitions)
         self.aux_tables[resource_type] = aux_table
 
         # Define files table if needed.
@@ -195,10 +857,43 @@ class PostgreSQLStorage(Storage):
                 sa.Column('id', sa.ForeignKey(main_table.c.id, ondelete='CASCADE'), index=True),
                 sa.Column('subpath', sa.String(128), nullable=False),
                 sa.Column('blob', sa.LargeBinary()),
-                sa.UniqueConstraint('id', 'subpath', name=self._get_file_unique_idx_name(resource_type))
+                sa.UniqueConstraint('id', 'subpath', name=self._get_file_unique_idx_name(resource_type)),
+                **partition_by
             )
+            self._add_partitions(files_table, partitions)
             self.files_tables[resource_type] = files_table
 
+        # Define change log table, ids are not foreign keys, because deletes are logged too.
+        changes_table = sa.Table(
+            chop_long_name(resource_type + '__changes'), self.metadata,
+            sa.Column('seq', sa.BigInteger, primary_key=True, autoincrement=False),
+            sa.Column('id', sa.String(46), nullable=False),
+            sa.Column('revision', sa.String(46), nullable=True),
+            sa.Column('change', sa.String(16), nullable=False),
+        )
+        self.changes_tables[resource_type] = changes_table
+
+    def _add_partitions(self, table, partitions):
+        if not partitions:
+            return
+        self.partitions[table.name] = [self._get_partition_name(table.name, i) for i in range(partitions)]
+        for i, name in enumerate(self.partitions[table.name]):
+            sa.event.listen(table, 'after_create', sa.DDL(
+                'CREATE TABLE %s PARTITION OF %s FOR VALUES WITH (MODULUS %d, REMAINDER %d)' % (
+                    name, table.name, partitions, i,
+                )
+            ))
+
+    def _get_partition_name(self, name, number):
+        return chop_long_name('%s__p%d' % (name, number))
+
+    def _get_gin_index_name(self, resource_type):
+        return chop_long_name('gin_idx_' + resource_type)
+
+    def _check_index(self, name):
+        if name in self.pending_indexes:
+            raise IndexNotReady("Index %s is not ready yet." % name)
+
     def _get_file_unique_idx_name(self, resource_type):
         return chop_long_name(resource_type + '__unique_idx')
 
@@ -227,145 +922,439 @@ class PostgreSQLStorage(Storage):
             tuple(self.schema[resource_type]['subpaths'][subpath]['prototype'] for subpath in subpaths)
         )
 
-    async def _update_aux_tables(self, conn, resource_type, row_id, create=None):
-        # TODO: should be defered
-
-        if create is None:
-            # Get data from main table and all subpaths.
-            # We need this, because search look for data everywhere including all subpaths.
-            table = self.tables[resource_type]
-            subpaths = self._get_subpaths(resource_type)
-            result = await conn.execute(sa.select(
-                [table.c.data] +
-                [table.c['data_' + subpath] for subpath in subpaths]
-            ).where(table.c.id == row_id))
-            row = await result.first()
-            data = (
-                [row.data] +
-                [row['data_' + subpath] for subpath in subpaths if row['data_' + subpath]]
-            )
-
-            # Update search field containing data from resource and all subpaths in a convinient shape for searches.
-            await conn.execute(
-                table.update().
-                where(table.c.id == row_id).
-                values(
-                    search=list(itertools.chain.from_iterable(flatten_for_gin(x) for x in data))
-                )
-            )
-
-        else:
-            data = create
-
-        # Update list tables
+    def _aux_ctes(self, resource_type, target):
+        # Only delete old rows, that are not in the new set and only insert new rows, that are not there yet. Equal
+        # rows are matched by their number among duplicates. Nothing is touched unless target returns a row.
         aux_table = self.aux_tables[resource_type]
+        value = sa.column('value', JSONB)
+        old = (
+            sa.select([
+                sa.literal_column('ctid').label('ctid'),
+                aux_table.c.data,
+                sa.func.row_number().over(partition_by=aux_table.c.data).label('n'),
+            ]).
+            where(aux_table.c.id == sa.bindparam('row_id', type_=sa.String)).
+            where(sa.exists(sa.select([target.c.id]))).
+            cte('old_aux')
+        )
+        new = (
+            sa.select([
+                value.label('data'),
+                sa.func.row_number().over(partition_by=value).label('n'),
+            ]).
+            select_from(sa.func.jsonb_array_elements(sa.bindparam('rows', type_=JSONB)).alias('rows')).
+            where(sa.exists(sa.select([target.c.id]))).
+            cte('new_aux')
+        )
+        same = sa.and_(old.c.data == new.c.data, old.c.n == new.c.n)
+        deleted = (
+            aux_table.delete().
+            # ctid is unique only within a partition, id selects the partition.
+            where(aux_table.c.id == sa.bindparam('row_id', type_=sa.String)).
+            where(sa.literal_column('ctid').in_(
+                sa.select([old.c.ctid]).
+                select_from(old.outerjoin(new, same)).
+                where(new.c.n.is_(None))
+            )).
+            returning(aux_table.c.id).
+            cte('deleted_aux')
+        )
+        inserted = (
+            aux_table.insert().
+            from_select(['id', 'data'], (
+                sa.select([sa.bindparam('row_id', type_=sa.String), new.c.data]).
+                select_from(new.outerjoin(old, same)).
+                where(old.c.n.is_(None))
+            )).
+            returning(aux_table.c.id).
+            cte('inserted_aux')
+        )
+        return [deleted, inserted]
+
+    def _change_cte(self, resource_type, change, target):
+        changes_table = self.changes_tables[resource_type]
+
+        # Changes become visible on commit, in any order. Sequence numbers follow transaction ids, so that readers can
+        # stop at the oldest running transaction, see changes(), and never see a gap, that is filled later.
+        notify = sa.select([
+            sa.func.pg_notify(CHANGES_CHANNEL, resource_type).label('notify'),
+        ]).select_from(target).alias('notify')
+        revision = sa.null() if change == 'deleted' else sa.bindparam('new_revision', type_=sa.String)
+        return (
+            changes_table.insert().
+            from_select(['seq', 'id', 'revision', 'change'], (
+                sa.select([
+                    sa.func.txid_current(type_=sa.BigInteger) * CHANGES_PER_TRANSACTION,
+                    sa.bindparam('row_id', type_=sa.String),
+                    revision,
+                    sa.literal(change),
+                ]).
+                select_from(notify)
+            )).
+            returning(changes_table.c.seq).
+            cte('change')
+        )
 
-        # Delete old rows, before inserting new ones.
-        if create is None:
-            await conn.execute(aux_table.delete().where(aux_table.c.id == row_id))
+    def _write_query(self, resource_type, target, change, aux=False):
+        """Build a query, that executes a write as a single statement.
+
+        Target is a data-modifying CTE, returning id of the written resource row. Aux rows, if requested, and the
+        change log entry are written by other CTEs of the same statement, only if target returned a row. Current
+        revision is returned too, to tell whether a resource does not exist or revision does not match, if it did not.
+        """
+        table = self.tables[resource_type]
+        aux = self._aux_ctes(resource_type, target) if aux else []
+        change = self._change_cte(resource_type, change, target)
+
+        def count(cte):
+            return sa.select([sa.func.count()]).select_from(cte).as_scalar()
+
+        return sa.select([
+            sa.select([table.c.revision]).
+            where(table.c.id == sa.bindparam('row_id', type_=sa.String)).
+            as_scalar().label('current'),
+            count(target).label('written'),
+            count(change).label('logged'),
+        ] + [count(cte).label(cte.name) for cte in aux])
+
+    async def _write(self, conn, resource_type, query, **values):
+        result = await self._execute(conn, query, **values)
+        row = await result.first()
+        if row.written > 1:
+            raise UnexpectedError((
+                "Update query returned %r rowcount, expected values are 0 or 1. Don't know how to handle that."
+            ) % row.written)
+        if 'rows' in values and row.written:
+            aux_rows_written.observe(row.deleted_aux + row.inserted_aux, resource_type=resource_type)
+        if row.written and resource_type in self.search_caches:
+            # Other workers learn about the write from the change notification.
+            self.search_caches[resource_type].invalidate()
+        return row
+
+    def _unchanged(self, table):
+        """Condition of an update, that the row was not written since the update statement started.
+
+        A row written by a concurrent statement is checked again after it's committed, but aux rows it wrote are not
+        visible to the update, that would leave them behind. xmin of the row, as seen by the statement, differs from
+        xmin of the row written in the meantime.
+        """
+        seen = table.alias('seen')
+        return sa.literal_column('%s.xmin' % table.name) == (
+            sa.select([sa.literal_column('seen.xmin')]).
+            select_from(seen).
+            where(seen.c.id == sa.bindparam('row_id')).
+            as_scalar()
+        )
+
+    async def _write_unchanged(self, conn, resource_type, query, **values):
+        """Execute a write with the _unchanged condition until it writes the row or its revision does not match.
 
-        # Populate aux table with data from lists, for searches.
-        await conn.execute(aux_table.insert().values([{
-            'id': row_id,
-            'data': item,
-        } for item in flatten_for_lists(data)]))
+        Revision returned by the statement is the one it saw. If it matched, but the row was not written, the row was
+        written in the meantime, by a reindex, that kept the revision, or by a write, that the next run tells apart.
+        """
+        while True:
+            row = await self._write(conn, resource_type, query, **values)
+            if row.written or row.current != values['old_revision']:
+                return row
 
-    def add_resource_type(self, schema):
+    def _check_revision(self, row_id, current, old_revision):
+        if current is None:
+            raise ResourceNotFound("Resource %s not found." % row_id)
+        if current != old_revision:
+            raise WrongRevision("Expected revision is %s, got %s." % (current, old_revision),
+                                current=current, update=old_revision)
+
+    def _get_query(self, key, build):
+        """Get a compiled query by key, build function is called to build it only once."""
+        query = self._queries.get(key)
+        if query is None:
+            query = self._queries[key] = CompiledQuery(build(), self.pool.dialect)
+        return query
+
+    async def _execute(self, conn, query, **values):
+        if not self.prepare:
+            return await conn.execute(query.sql, query.params(values))
+        prepared = self._prepared.setdefault(conn.connection, set())
+        if query.name not in prepared:
+            await conn.execute(query.prepare)
+            prepared.add(query.name)
+        return await conn.execute(query.execute, query.params(values))
+
+    def _acquire(self):
+        return StorageConnection(self)
+
+    def _get_backend_pid(self, conn):
+        return conn.connection.raw.get_backend_pid()
+
+    def _close_connection(self, conn):
+        conn.connection.close()
+
+    def _cancel_query(self, conn, pid):
+        """Cancel query of a connection, that was in use by a cancelled task."""
+        # Connection is closed first, so that it's not given to another task before the query is cancelled.
+        self._close_connection(conn)
+        asyncio.ensure_future(self._cancel_backend(pid))
+
+    async def _cancel_backend(self, pid):
+        try:
+            async with self.pool.acquire() as conn:
+                await conn.execute(sa.select([sa.func.pg_cancel_backend(pid)]))
+        except Exception as e:
+            logger.warning("Could not cancel query of backend %s: %s", pid, e)
+
+    async def _listen(self):
+        async with self._listener_lock:
+            if self._listener is not None:
+                return
+            conn = await aiopg.connect(self.pool.dsn)
+            try:
+                async with conn.cursor() as cursor:
+                    await cursor.execute('LISTEN %s' % CHANGES_CHANNEL)
+            except Exception:
+                conn.close()
+                raise
+            self._listener = asyncio.ensure_future(self._dispatch_notifications(conn))
+            # Writes made while not listening were missed.
+            self._invalidate_search_caches()
+
+    def _is_listening(self):
+        return self._listener is not None and not self._listener.done()
+
+    async def _dispatch_notifications(self, conn):
+        try:
+            while True:
+                notification = await conn.notifies.get()
+                self._notify(notification.payload)
+        finally:
+            # Wake up all waiters, they will query change log again and start a new listener if needed.
+            conn.close()
+            self._listener = None
+            for event in self._change_events.values():
+                event.set()
+            self._change_events = {}
+            self._invalidate_search_caches()
+
+    def _notify(self, resource_type):
+        event = self._change_events.pop(resource_type, None)
+        if event is not None:
+            event.set()
+        if resource_type in self.search_caches:
+            self.search_caches[resource_type].invalidate()
+
+    def _invalidate_search_caches(self):
+        for cache in self.search_caches.values():
+            cache.invalidate()
+
+    def _get_change_event(self, resource_type):
+        if resource_type not in self._change_events:
+            self._change_events[resource_type] = asyncio.Event()
+        return self._change_events[resource_type]
+
+    def add_resource_type(self, schema, shard=None):
+        """Add a resource type.
+
+        Shard is the number of this storage among the shards of a hash sharded resource type, it is encoded into ids
+        of created resources.
+        """
         self.schema[schema['type']] = schema['versions'][-1]
+        self.shards[schema['type']] = shard
+        if schema.get('search_cache'):
+            self.search_caches[schema['type']] = SearchCache(schema['search_cache'])
         self._create_tables(schema)
+        self.flatteners[schema['type']] = Flattener(self.schema[schema['type']]['prototype'], {
+            subpath: self.schema[schema['type']]['subpaths'][subpath]['prototype']
+            for subpath in self._get_subpaths(schema['type'])
+        })
+        # Validators keyed by (resource type, subpath), subpath is None for resource itself.
+        self.validators[schema['type'], None] = get_validator(self.schema[schema['type']]['prototype'])
+        self.validators.update(
+            ((schema['type'], subpath), get_validator(self.schema[schema['type']]['subpaths'][subpath]['prototype']))
+            for subpath in self._get_subpaths(schema['type'])
+        )
         self._resources_by_path[schema['path'].strip('/')] = schema
 
     def init(self):
-        self.metadata.create_all()
-        self._create_indexes()
+        """Create missing tables, add missing columns and return a list of indexes that still need to be built.
+
+        Indexes on new tables are created right away, because new tables are empty. Indexes on existing tables are
+        only marked as pending, call migrate() to build them.
+        """
+        fingerprint = self._get_schema_fingerprint()
+        with self.engine.begin() as conn:
+            if self._get_stored_fingerprint(conn) == fingerprint:
+                logger.info("Database schema is up to date, skipping DDL.")
+                return []
+
+            catalog = self._get_catalog(conn)
+            new_tables = [table for table in self.metadata.sorted_tables if table.name not in catalog.tables]
+            self.metadata.create_all(conn, tables=new_tables, checkfirst=False)
+
+            pending = []
+            for index in self.indexes:
+                if index.table not in catalog.tables:
+                    self._get_index(index).create(conn)
+
+            for migration in self.plan_migrations(catalog):
+                if migration.action == 'add_column':
+                    logger.warning("Adding column %s to %s.", migration.name, migration.table)
+                    self._add_column(conn, migration.table, migration.name)
+                elif migration.action == 'create_index':
+                    pending.append(migration.name)
+
+            if pending:
+                self.pending_indexes.update(pending)
+            else:
+                self._store_fingerprint(conn, fingerprint)
+
+        return pending
 
     async def create(self, resource_path, data):
         resource_type = self._get_resource_type(resource_path)
         table = self._get_table(resource_path)
 
-        row_id = get_new_id(resource_type)
+        row_id = get_new_id(resource_type, shard=self.shards[resource_type])
         revision = get_new_id(resource_type)
 
-        data = validated(resource_type, self.schema[resource_type]['prototype'], data)
-        search = list(flatten_for_gin(data))
-
-        async with self.pool.acquire() as conn:
-            async with conn.begin():
-                await conn.execute(table.insert().values(id=row_id, revision=revision, data=data, search=search))
-                await self._update_aux_tables(conn, resource_type, row_id, data)
+        with timing.phase('validate'):
+            data = self.validators[resource_type, None].validate(data)
+        with timing.phase('flatten'):
+            search, rows = self.flatteners[resource_type].flatten(data)
+
+        query = self._get_query(('create', resource_type), lambda: self._write_query(resource_type, (
+            table.insert().
+            values(
+                id=sa.bindparam('row_id'),
+                revision=sa.bindparam('new_revision'),
+                data=sa.bindparam('new_data'),
+                search=sa.bindparam('new_search'),
+            ).
+            returning(table.c.id).
+            cte('target')
+        ), 'created', aux=True))
+        async with self._acquire() as conn:
+            await self._write(conn, resource_type, query, row_id=row_id, new_revision=revision, new_data=data,
+                              new_search=search, rows=rows)
 
         return dict(data, id=row_id, revision=revision)
 
-    async def get(self, resource_path, row_id):
+    @single_flight
+    async def get(self, resource_path, row_id, fields=None):
+        resource_type = self._get_resource_type(resource_path)
         table = self._get_table(resource_path)
-        async with self.pool.acquire() as conn:
-            result = await conn.execute(sa.select([
+
+        def build():
+            data = table.c.data if fields is None else project(table.c.data, sa.bindparam('fields'))
+            return sa.select([
                 table.c.id,
                 table.c.revision,
-                table.c.data,
-            ]).where(table.c.id == row_id))
+                data.label('data'),
+            ]).where(table.c.id == sa.bindparam('row_id'))
+
+        query = self._get_query(('get', resource_type, fields is None), build)
+        async with self._acquire() as conn:
+            result = await self._execute(conn, query, row_id=row_id, fields=fields and list(fields))
             row = await result.first()
         if row:
-            return dict(row.data, id=row.id, revision=row.revision)
+            return dict(row.data or {}, id=row.id, revision=row.revision)
         else:
             raise ResourceNotFound("Resource %s not found." % row_id)
 
+    async def get_many(self, resource_path, row_ids, fields=None):
+        """Get many resources in a single query.
+
+        Returns a list of found resources in the same order as given ids and a list of ids that were not found. If
+        fields are given, only these fields are selected from resource data.
+        """
+        table = self._get_table(resource_path)
+        data = table.c.data if fields is None else project(table.c.data, fields)
+        query = (
+            sa.select([table.c.id, table.c.revision, data.label('data')]).
+            where(table.c.id == sa.any_(sa.bindparam('ids', list(row_ids), type_=ARRAY(sa.String))))
+        )
+        async with self._acquire() as conn:
+            found = {
+                row.id: dict(row.data or {}, id=row.id, revision=row.revision)
+                async for row in conn.execute(query)
+            }
+        return (
+            [found[row_id] for row_id in row_ids if row_id in found],
+            [row_id for row_id in row_ids if row_id not in found],
+        )
+
     async def put(self, resource_path, row_id, data):
         table = self._get_table(resource_path)
 
         resource_type = self._get_resource_type(resource_path)
         new_revision = get_new_id(resource_type)
-        old_revision = data.get('revision')
-
-        data = validated(resource_type, self.schema[resource_type]['prototype'], data)
-        search = list(flatten_for_gin(data))
 
-        async with self.pool.acquire() as conn:
-            async with conn.begin():
-                result = await conn.execute(
-                    table.update().
-                    where(table.c.id == row_id).
-                    where(table.c.revision == old_revision).
-                    values(revision=new_revision, data=data, search=search)
-                )
+        with timing.phase('validate'):
+            resource = self.validators[resource_type, None].validate(data)
+        old_revision = data.get('revision')
+        data = resource
+        subpaths = self._get_subpaths(resource_type)
 
-                if result.rowcount == 1:
-                    await self._update_aux_tables(conn, resource_type, row_id)
+        select = self._get_query(('put:select', resource_type), lambda: sa.select(
+            [table.c.revision] +
+            [table.c['data_' + subpath] for subpath in subpaths]
+        ).where(table.c.id == sa.bindparam('row_id')))
+        update = self._get_query(('put', resource_type), lambda: self._write_query(resource_type, (
+            table.update().
+            where(table.c.id == sa.bindparam('row_id')).
+            where(table.c.revision == sa.bindparam('old_revision')).
+            where(self._unchanged(table)).
+            values(
+                revision=sa.bindparam('new_revision'),
+                data=sa.bindparam('new_data'),
+                search=sa.bindparam('new_search'),
+            ).
+            returning(table.c.id).
+            cte('target')
+        ), 'updated', aux=True))
+
+        async with self._acquire() as conn:
+            # Search data includes all subpaths, so they are read first. Revision check of the update makes sure,
+            # that they were not changed in between.
+            result = await self._execute(conn, select, row_id=row_id)
+            row = await result.first()
+            self._check_revision(row_id, row and row.revision, old_revision)
 
-                elif result.rowcount == 0:
-                    result = await conn.execute(sa.select([table.c.revision]).where(table.c.id == row_id))
-                    row = await result.first()
-                    if row is None:
-                        raise ResourceNotFound("Resource %s not found." % row_id)
-                    else:
-                        raise WrongRevision("Expected revision is %s, got %s." % (row.revision, old_revision),
-                                            current=row.revision, update=old_revision)
-
-                else:
-                    raise UnexpectedError((
-                        "Update query returned %r rowcount, expected values are 0 or 1. Don't know how to handle that."
-                    ) % result.rowcount)
+            with timing.phase('flatten'):
+                search, rows = self.flatteners[resource_type].flatten(data, {
+                    subpath: row['data_' + subpath] for subpath in subpaths
+                })
+            row = await self._write_unchanged(conn, resource_type, update, row_id=row_id, old_revision=old_revision,
+                                              new_revision=new_revision, new_data=data, new_search=search, rows=rows)
+            if row.written == 0:
+                self._check_revision(row_id, row.current, old_revision)
 
         return dict(data, id=row_id, revision=new_revision)
 
     async def delete(self, resource_path, row_id):
         resource_type = self._get_resource_type(resource_path)
         table = self._get_table(resource_path)
-        aux_table = self.aux_tables[resource_type]
 
-        with self.engine.begin() as conn:
-            conn.execute(table.delete().where(table.c.id == row_id))
-            conn.execute(aux_table.delete().where(table.c.id == row_id))
+        # Rows in aux and files tables are deleted by ON DELETE CASCADE.
+        query = self._get_query(('delete', resource_type), lambda: self._write_query(resource_type, (
+            table.delete().
+            where(table.c.id == sa.bindparam('row_id')).
+            returning(table.c.id).
+            cte('target')
+        ), 'deleted'))
+        async with self._acquire() as conn:
+            await self._write(conn, resource_type, query, row_id=row_id)
 
         return {}
 
+    @single_flight
     async def get_subpath(self, resource_path, row_id, subpath):
+        resource_type = self._get_resource_type(resource_path)
         table = self._get_table(resource_path)
-        async with self.pool.acquire() as conn:
-            result = await conn.execute(sa.select([
-                table.c.revision,
-                table.c['data_' + subpath],
-            ]).where(table.c.id == row_id))
+        query = self._get_query(('get_subpath', resource_type, subpath), lambda: sa.select([
+            table.c.revision,
+            table.c['data_' + subpath],
+        ]).where(table.c.id == sa.bindparam('row_id')))
+        async with self._acquire() as conn:
+            result = await self._execute(conn, query, row_id=row_id)
             row = await result.first()
         if row:
             return dict(row['data_' + subpath], revision=row.revision)
@@ -377,41 +1366,52 @@ class PostgreSQLStorage(Storage):
 
         resource_type = self._get_resource_type(resource_path)
         new_revision = get_new_id(resource_type)
-        old_revision = data.get('revision')
 
-        data = validated(resource_type, self.schema[resource_type]['subpaths'][subpath]['prototype'], data)
-
-        async with self.pool.acquire() as conn:
-            async with conn.begin():
-                result = await conn.execute(
-                    table.update().
-                    where(table.c.id == row_id).
-                    where(table.c.revision == old_revision).
-                    values({
-                        'revision': new_revision,
-                        'data_' + subpath: data,
-                    })
-                )
-
-                if result.rowcount == 1:
-                    await self._update_aux_tables(conn, resource_type, row_id)
+        with timing.phase('validate'):
+            resource = self.validators[resource_type, subpath].validate(data)
+        old_revision = data.get('revision')
+        data = resource
+        subpaths = self._get_subpaths(resource_type)
 
-                elif result.rowcount == 0:
-                    result = await conn.execute(sa.select([table.c.revision]).where(table.c.id == row_id))
-                    row = await result.first()
-                    if row is None:
-                        raise ResourceNotFound("Resource %s not found." % row_id)
-                    else:
-                        raise WrongRevision("Expected revision is %s, got %s." % (row.revision, old_revision),
-                                            current=row.revision, update=old_revision)
+        select = self._get_query(('put_subpath:select', resource_type, subpath), lambda: sa.select(
+            [table.c.revision, table.c.data] +
+            [table.c['data_' + other] for other in subpaths if other != subpath]
+        ).where(table.c.id == sa.bindparam('row_id')))
+        update = self._get_query(('put_subpath', resource_type, subpath), lambda: self._write_query(resource_type, (
+            table.update().
+            where(table.c.id == sa.bindparam('row_id')).
+            where(table.c.revision == sa.bindparam('old_revision')).
+            where(self._unchanged(table)).
+            values({
+                'revision': sa.bindparam('new_revision'),
+                'data_' + subpath: sa.bindparam('new_data'),
+                'search': sa.bindparam('new_search'),
+            }).
+            returning(table.c.id).
+            cte('target')
+        ), 'updated', aux=True))
+
+        async with self._acquire() as conn:
+            # Search data includes resource and all other subpaths, so they are read first. Revision check of the
+            # update makes sure, that they were not changed in between.
+            result = await self._execute(conn, select, row_id=row_id)
+            row = await result.first()
+            self._check_revision(row_id, row and row.revision, old_revision)
 
-                else:
-                    raise UnexpectedError((
-                        "Update query returned %r rowcount, expected values are 0 or 1. Don't know how to handle that."
-                    ) % result.rowcount)
+            with timing.phase('flatten'):
+                search, rows = self.flatteners[resource_type].flatten(row.data, {
+                    other: data if other == subpath else row['data_' + other] for other in subpaths
+                })
+            row = await self._write_unchanged(conn, resource_type, update, row_id=row_id, old_revision=old_revision,
+                                              new_revision=new_revision, new_data=data, new_search=search, rows=rows)
+            if row.written == 0:
+                self._check_revision(row_id, row.current, old_revision)
 
         return dict(data, revision=new_revision)
 
+    def get_resource_paths(self):
+        return sorted(self._resources_by_path)
+
     def is_file(self, resource_path, subpath):
         resource_type = self._get_resource_type(resource_path)
         return subpath in self.schema[resource_type].get('files', [])
@@ -420,7 +1420,7 @@ class PostgreSQLStorage(Storage):
         resource_type = self._get_resource_type(resource_path)
         table = self._get_table(resource_path)
         files_table = self.files_tables[resource_type]
-        async with self.pool.acquire() as conn:
+        async with self._acquire() as conn:
             result = await conn.execute(
                 sa.select([
                     table.c.revision,
@@ -453,95 +1453,420 @@ class PostgreSQLStorage(Storage):
             'content-type': content_type,
         }
 
-        async with self.pool.acquire() as conn:
-            async with conn.begin():
-                result = await conn.execute(
-                    table.update().
-                    where(table.c.id == row_id).
-                    where(table.c.revision == old_revision).
-                    values({
-                        'revision': new_revision,
-                        'data_' + subpath: data,
-                    })
-                )
-
-                if result.rowcount == 1:
-                    data = {
-                        'id': row_id,
-                        'subpath': subpath,
-                        'blob': body,
-                    }
-                    await conn.execute(
-                        insert(files_table).values(data).
-                        on_conflict_do_update(
-                            constraint=self._get_file_unique_idx_name(resource_type),
-                            set_=data
-                        )
-                    )
-
-                elif result.rowcount == 0:
-                    result = await conn.execute(sa.select([table.c.revision]).where(table.c.id == row_id))
-                    row = await result.first()
-                    if row is None:
-                        raise ResourceNotFound("Resource %s not found." % row_id)
-                    else:
-                        raise WrongRevision("Expected revision is %s, got %s." % (row.revision, old_revision),
-                                            current=row.revision, update=old_revision)
+        def build():
+            updated = (
+                table.update().
+                where(table.c.id == sa.bindparam('row_id')).
+                where(table.c.revision == sa.bindparam('old_revision')).
+                values({
+                    'revision': sa.bindparam('new_revision'),
+                    'data_' + subpath: sa.bindparam('new_data'),
+                }).
+                returning(table.c.id).
+                cte('updated')
+            )
+            query = insert(files_table).from_select(
+                ['id', 'subpath', 'blob'],
+                sa.select([updated.c.id, sa.literal(subpath), sa.cast(sa.bindparam('body'), sa.LargeBinary)]),
+            )
+            return self._write_query(resource_type, (
+                query.
+                on_conflict_do_update(
+                    constraint=self._get_file_unique_idx_name(resource_type),
+                    set_={'blob': query.excluded.blob},
+                ).
+                returning(files_table.c.id).
+                cte('target')
+            ), 'updated')
 
-                else:
-                    raise UnexpectedError((
-                        "Update query returned %r rowcount, expected values are 0 or 1. Don't know how to handle that."
-                    ) % result.rowcount)
+        query = self._get_query(('put_file', resource_type, subpath), build)
+        async with self._acquire() as conn:
+            row = await self._write(conn, resource_type, query, row_id=row_id, old_revision=old_revision,
+                                    new_revision=new_revision, new_data=data, body=body)
+            if row.written == 0:
+                self._check_revision(row_id, row.current, old_revision)
 
         return {'id': row_id, 'revision': new_revision}
 
+    @single_flight
     async def list(self, resource_path):
         table = self._get_table(resource_path)
-        async with self.pool.acquire() as conn:
+        async with self._acquire() as conn:
             return [
                 row.id async for row in conn.execute(
                     sa.select([table.c.id])
                 )
             ]
 
-    async def search(self, resource_path, search_path):
-        operator_args = {
-            'contains': 2,
-            'exact': 2,
-            'ge': 2,
-            'gt': 2,
-            'le': 2,
-            'lt': 2,
-            'ne': 2,
-            'startswith': 2,
-            'show': 1,
-            'show_all': 0,
-            'sort': 1,
-            'offset': 1,
-            'limit': 1,
-        }
-        operators = []
-        words = map(urllib.parse.unquote, search_path.split('/'))
-        operator = next(words, None)
-        while operator:
-            if operator not in operator_args:
-                raise Exception("Unknown operator %r." % operator)
-            args_count = operator_args[operator]
+    async def count(self, resource_path, estimate=False):
+        """Return number of resources.
+
+        With estimate, number of rows is estimated from table statistics the same way PostgreSQL planner does, this
+        is instant even on huge tables. Exact count is used for tables, that were never vacuumed or analyzed yet.
+        """
+        table = self._get_table(resource_path)
+        async with self._acquire() as conn:
+            if estimate:
+                # Partitioned tables have no statistics of their own, partitions are summed up.
+                count = await conn.scalar(sa.text(
+                    "SELECT (CASE WHEN min(reltuples) >= 0 THEN sum(CASE WHEN relpages > 0 "
+                    "  THEN reltuples / relpages * (pg_relation_size(oid) / current_setting('block_size')::int) "
+                    "  ELSE reltuples "
+                    "END) END)::bigint "
+                    "FROM pg_class "
+                    "WHERE relkind = 'r' AND ("
+                    "  oid = to_regclass(:table) OR "
+                    "  oid IN (SELECT inhrelid FROM pg_inherits WHERE inhparent = to_regclass(:table))"
+                    ")"
+                ).bindparams(table=table.name))
+                if count is not None and count >= 0:
+                    return count
+            return await conn.scalar(sa.select([sa.func.count()]).select_from(table))
+
+    def export(self, resource_path, files=False, batch_size=EXPORT_BATCH_SIZE):
+        """Return an async iterator over all resources with their subpaths, as of a single snapshot.
+
+        Rows are read through a server-side cursor in a REPEATABLE READ transaction, batch_size rows per round trip,
+        so memory use does not grow with the number of resources. Every item is a dict with the resource, data of its
+        subpaths and, if files is true, contents of its files.
+        """
+        # Resource type is checked right away, not on first iteration.
+        resource_type = self._get_resource_type(resource_path)
+        return self._export(resource_type, files, batch_size)
+
+    async def _export(self, resource_type, files, batch_size):
+        table = self.tables[resource_type]
+        subpaths = sorted(self.schema[resource_type].get('subpaths', {}))
+        file_subpaths = sorted(self.schema[resource_type].get('files', [])) if files else []
+        files_table = self.files_tables.get(resource_type)
+        query = sa.select([table.c.id, table.c.revision, table.c.data] + [
+            table.c['data_' + subpath] for subpath in subpaths
+        ] + [
+            sa.select([files_table.c.blob]).
+            where(files_table.c.id == table.c.id).
+            where(files_table.c.subpath == subpath).
+            as_scalar().label('file_' + subpath)
+            for subpath in file_subpaths
+        ])
+        sql = str(query.compile(dialect=self.pool.dialect, compile_kwargs={'literal_binds': True}))
+        # Cursor is named by its query, so that FETCH statements cached by drivers always return the same columns.
+        cursor = 'qvarn_export_' + hashlib.md5(sql.encode()).hexdigest()
+
+        async with self._acquire() as conn:
             try:
-                args = [next(words) for i in range(args_count)]
-            except StopIteration:
-                raise Exception("Operator %r requires at least %d arguments." % (operator, args_count))
-            operators.append((operator, args))
-            operator = next(words, None)
+                await conn.execute('BEGIN ISOLATION LEVEL REPEATABLE READ READ ONLY')
+                await conn.execute('DECLARE %s NO SCROLL CURSOR FOR %s' % (cursor, sql))
+                while True:
+                    result = await conn.execute('FETCH FORWARD %d FROM %s' % (batch_size, cursor))
+                    rows = await result.fetchall()
+                    for row in rows:
+                        item = {
+                            'resource': dict(row.data, id=row.id, revision=row.revision),
+                            'subpaths': {
+                                subpath: row['data_' + subpath]
+                                for subpath in subpaths if row['data_' + subpath] is not None
+                            },
+                        }
+                        if file_subpaths:
+                            item['files'] = {
+                                subpath: bytes(row['file_' + subpath])
+                                for subpath in file_subpaths if row['file_' + subpath] is not None
+                            }
+                        yield item
+                    if len(rows) < batch_size:
+                        break
+                await conn.execute('COMMIT')
+            except BaseException as e:
+                # Connection is left in the middle of the transaction, it must not go back to the pool. Cancelled
+                # connections are closed already.
+                if not isinstance(e, asyncio.CancelledError):
+                    self._close_connection(conn)
+                raise
+
+    def import_resources(self, resource_path, lines, generate_ids=False, drop_indexes=False, workers=None,
+                         batch_size=IMPORT_BATCH_SIZE):
+        """Import resources from NDJSON lines in export format, yielding the number of resources of each batch.
+
+        Lines are prepared by a pool of worker processes, or by this process if workers is 0. Each batch is copied
+        into temporary staging tables and merged into resource tables in a single transaction, resources that exist
+        already are replaced. With drop_indexes, indexes of the resource type are dropped for the time of the import
+        and built again afterwards.
+        """
+        resource_type = self._get_resource_type(resource_path)
+        schema = self.schema[resource_type]
+        config = ImportConfig(
+            resource_type, schema['prototype'], tuple(
+                (subpath, schema['subpaths'][subpath].get('prototype', {}))
+                for subpath in sorted(schema.get('subpaths', {}))
+            ),
+            tuple(schema.get('files', [])), self.shards[resource_type], generate_ids,
+        )
+        lines = (line for line in lines if line.strip())
+        # Changes of a batch are logged by a single transaction.
+        batch_size = min(batch_size, CHANGES_PER_TRANSACTION)
+        batches = iter(lambda: list(itertools.islice(lines, batch_size)), [])
+        tables = (self.tables[resource_type].name, self.aux_tables[resource_type].name)
+        indexes = [index for index in self.indexes if index.table in tables] if drop_indexes else []
+
+        pool = None if workers == 0 else multiprocessing.Pool(workers)
+        try:
+            if pool is None:
+                prepared = (prepare_import(config, batch) for batch in batches)
+            else:
+                # Only a few batches are handed to workers ahead, so that input is read as fast as it's loaded.
+                prepared = imap_bounded(pool, functools.partial(prepare_import, config), batches,
+                                        2 * (workers or os.cpu_count()))
+            with self.engine.begin() as conn:
+                for index in indexes:
+                    logger.warning("Dropping index %s for import.", index.name)
+                    conn.execute('DROP INDEX IF EXISTS %s' % index.name)
+            for count, main, aux, files in prepared:
+                self._load_import(resource_type, main, aux, files)
+                yield count
+        finally:
+            if pool is not None:
+                pool.terminate()
+            for index in indexes:
+                logger.warning("Building index %s on %s.", index.name, index.table)
+                self._build_index_concurrently(index)
+
+    def _load_import(self, resource_type, main, aux, files):
+        """Copy prepared rows into staging tables and merge them into resource tables in a single transaction."""
+        table = self.tables[resource_type]
+        aux_table = self.aux_tables[resource_type]
+        changes_table = self.changes_tables[resource_type]
+        files_table = self.files_tables.get(resource_type)
+        columns = ', '.join(column.name for column in table.columns)
+        conn = self.engine.raw_connection()
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute('CREATE TEMPORARY TABLE import_main (LIKE %s) ON COMMIT DROP' % table.name)
+                cursor.execute('CREATE TEMPORARY TABLE import_aux (LIKE %s) ON COMMIT DROP' % aux_table.name)
+                cursor.copy_expert('COPY import_main (%s) FROM STDIN' % columns, io.BytesIO(main.encode()))
+                cursor.copy_expert('COPY import_aux (id, data) FROM STDIN', io.BytesIO(aux.encode()))
+
+                # Sequence numbers of changes are assigned the same way as on single writes, see _change_cte.
+                cursor.execute(
+                    "INSERT INTO {changes} (seq, id, revision, change) "
+                    "SELECT txid_current() * %s + row_number() OVER (ORDER BY i.id) - 1, i.id, i.revision, "
+                    "CASE WHEN t.id IS NULL THEN 'created' ELSE 'updated' END "
+                    "FROM import_main i LEFT JOIN {table} t ON t.id = i.id".format(
+                        changes=changes_table.name, table=table.name,
+                    ),
+                    (CHANGES_PER_TRANSACTION,),
+                )
+                cursor.execute('DELETE FROM %s WHERE id IN (SELECT id FROM import_main)' % aux_table.name)
+                cursor.execute(
+                    "INSERT INTO {table} ({columns}) SELECT {columns} FROM import_main "
+                    "ON CONFLICT (id) DO UPDATE SET {updates}".format(
+                        table=table.name, columns=columns, updates=', '.join(
+                            '%s = EXCLUDED.%s' % (column.name, column.name)
+                            for column in table.columns if column.name != 'id'
+                        ),
+                    )
+                )
+                cursor.execute('INSERT INTO %s (id, data) SELECT id, data FROM import_aux' % aux_table.name)
+
+                if files:
+                    cursor.execute('CREATE TEMPORARY TABLE import_files (LIKE %s) ON COMMIT DROP' % files_table.name)
+                    cursor.copy_expert('COPY import_files (id, subpath, blob) FROM STDIN', io.BytesIO(files.encode()))
+                    cursor.execute(
+                        "INSERT INTO {files} (id, subpath, blob) SELECT id, subpath, blob FROM import_files "
+                        "ON CONFLICT ON CONSTRAINT {unique} DO UPDATE SET blob = EXCLUDED.blob".format(
+                            files=files_table.name, unique=self._get_file_unique_idx_name(resource_type),
+                        )
+                    )
+                cursor.execute('SELECT pg_notify(%s, %s)', (CHANGES_CHANNEL, resource_type))
+            conn.commit()
+        finally:
+            conn.close()
+
+    async def reindex(self, resource_path, workers=None, concurrency=REINDEX_CONCURRENCY,
+                      batch_size=REINDEX_BATCH_SIZE, restart=False):
+        """Recompute search column and aux rows of all resources, yielding the number of resources of each round.
+
+        Resources are read in id order, concurrency batches of batch_size resources in each round. Batches are
+        flattened by a pool of worker processes, or by this process if workers is 0, and written back concurrently
+        over separate connections. Resources written in the meantime are skipped, their rows are up to date already.
+        Position is stored after each round, an interrupted reindex goes on from there, unless restart is true.
+        """
+        resource_type = self._get_resource_type(resource_path)
+        table = self.tables[resource_type]
+        subpaths = self._get_subpaths(resource_type)
+        config = ReindexConfig(resource_type, self.schema[resource_type]['prototype'], tuple(
+            (subpath, self.schema[resource_type]['subpaths'][subpath]['prototype']) for subpath in subpaths
+        ))
+        select = self._get_query(('reindex:select', resource_type, batch_size), lambda: (
+            sa.select([table.c.id, table.c.revision, table.c.data] + [table.c['data_' + s] for s in subpaths]).
+            where(table.c.id > sa.bindparam('after')).
+            order_by(table.c.id).
+            limit(batch_size)
+        ))
+        executor = None if workers == 0 else concurrent.futures.ProcessPoolExecutor(workers)
+        loop = asyncio.get_event_loop()
+
+        async def prepare(rows):
+            if executor is None:
+                return prepare_reindex(config, rows)
+            return await loop.run_in_executor(executor, prepare_reindex, config, rows)
 
+        try:
+            after = None if restart else await self._get_reindex_position(resource_type)
+            after = after or ''
+            while True:
+                batches = []
+                async with self._acquire() as conn:
+                    while len(batches) < concurrency:
+                        result = await self._execute(conn, select, after=after)
+                        rows = [
+                            (row.id, row.revision, row.data, {subpath: row['data_' + subpath] for subpath in subpaths})
+                            for row in await result.fetchall()
+                        ]
+                        if not rows:
+                            break
+                        batches.append(rows)
+                        after = rows[-1][0]
+                if not batches:
+                    break
+                prepared = await asyncio.gather(*(prepare(rows) for rows in batches))
+                await asyncio.gather(*(self._write_reindex(resource_type, rows) for rows in prepared))
+                await self._set_reindex_position(resource_type, after)
+                yield sum(len(rows) for rows in batches)
+            await self._set_reindex_position(resource_type, None)
+        finally:
+            if executor is not None:
+                executor.shutdown(wait=False)
+
+    async def _write_reindex(self, resource_type, rows):
+        table = self.tables[resource_type]
+        aux_table = self.aux_tables[resource_type]
+        # Rows are updated only if revision did not change since they were read, so that search and aux rows always
+        # match data. Old aux rows are deleted and new ones inserted in the same statement. Revision is kept, puts,
+        # that waited for this statement, are run again, see _unchanged.
+        query = self._get_query(('reindex', resource_type), lambda: sa.text(
+            "WITH input AS ("
+            "  SELECT item.value ->> 'id' AS id, item.value ->> 'revision' AS revision, "
+            "    item.value -> 'search' AS search, item.value -> 'aux' AS aux "
+            "  FROM jsonb_array_elements(CAST(:rows AS jsonb)) AS item(value)"
+            "), updated AS ("
+            "  UPDATE {table} SET search = input.search FROM input "
+            "  WHERE {table}.id = input.id AND {table}.revision = input.revision "
+            "  RETURNING {table}.id"
+            "), deleted AS ("
+            "  DELETE FROM {aux} WHERE id IN (SELECT id FROM updated) RETURNING id"
+            "), inserted AS ("
+            "  INSERT INTO {aux} (id, data) "
+            "  SELECT input.id, rows.value FROM input JOIN updated ON updated.id = input.id, "
+            "    jsonb_array_elements(input.aux) AS rows(value) "
+            "  RETURNING id"
+            ") "
+            "SELECT (SELECT count(*) FROM updated) AS updated".format(table=table.name, aux=aux_table.name)
+        ).bindparams(sa.bindparam('rows', type_=JSONB)))
+        async with self._acquire() as conn:
+            result = await self._execute(conn, query, rows=rows)
+            return (await result.first()).updated
+
+    async def _get_reindex_position(self, resource_type):
+        async with self._acquire() as conn:
+            return await conn.scalar(
+                sa.select([self.reindex_table.c.last_id]).
+                where(self.reindex_table.c.resource_type == resource_type)
+            )
+
+    async def _set_reindex_position(self, resource_type, last_id):
+        async with self._acquire() as conn:
+            if last_id is None:
+                await conn.execute(
+                    self.reindex_table.delete().
+                    where(self.reindex_table.c.resource_type == resource_type)
+                )
+            else:
+                await conn.execute(
+                    insert(self.reindex_table).
+                    values(resource_type=resource_type, last_id=last_id).
+                    on_conflict_do_update(
+                        index_elements=[self.reindex_table.c.resource_type],
+                        set_={'last_id': last_id},
+                    )
+                )
+            # Search results may have changed, workers drop their search caches.
+            await conn.execute(sa.select([sa.func.pg_notify(CHANGES_CHANNEL, resource_type)]))
+
+    async def changes(self, resource_path, since=0, limit=1000, wait=0):
+        """Return changes with sequence numbers greater than since, in sequence order.
+
+        Only changes of transactions older than the oldest running transaction are returned, changes of running and
+        later transactions get greater sequence numbers, when they are committed. If there are no changes yet, wait up
+        to wait seconds for a notification about new changes.
+        """
+        resource_type = self._get_resource_type(resource_path)
+        changes_table = self.changes_tables[resource_type]
+        horizon = sa.func.txid_snapshot_xmin(sa.func.txid_current_snapshot(), type_=sa.BigInteger)
+        query = (
+            sa.select([changes_table]).
+            where(changes_table.c.seq > since).
+            where(changes_table.c.seq < horizon * CHANGES_PER_TRANSACTION).
+            order_by(changes_table.c.seq).
+            limit(limit)
+        )
+
+        if wait:
+            await self._listen()
+            # Get event before querying, so that notifications sent after the query are not missed.
+            event = self._get_change_event(resource_type)
+
+        async with self._acquire() as conn:
+            result = await conn.execute(query)
+            rows = await result.fetchall()
+
+        if not rows and wait:
+            try:
+                await asyncio.wait_for(event.wait(), wait)
+            except asyncio.TimeoutError:
+                return []
+            async with self._acquire() as conn:
+                result = await conn.execute(query)
+                rows = await result.fetchall()
+
+        return [
+            {'seq': row.seq, 'id': row.id, 'revision': row.revision, 'change': row.change}
+            for row in rows
+        ]
+
+    @single_flight
+    async def search(self, resource_path, search_path):
+        operators = parse_search_path(search_path)
+        resource_type = self._get_resource_type(resource_path)
+        cache = self.search_caches.get(resource_type)
+        if cache is None:
+            return await self._search(resource_path, operators)
+
+        # Cache is only valid while write notifications of other workers are received.
+        await self._listen()
+        key = get_search_key(operators)
+        result = cache.get(key)
+        if result is not None and self._is_listening():
+            search_cache_requests.inc(resource_type=resource_type, result='hit')
+            return copy.deepcopy(result)
+
+        search_cache_requests.inc(resource_type=resource_type, result='miss')
+        generation = cache.generation
+        result = await self._search(resource_path, operators)
+        cache.put(key, generation, result)
+        return copy.deepcopy(result)
+
+    async def _search(self, resource_path, operators):
         sort_keys = []
         show_all = False
         show = []
+        aggregate = None
         offset = None
         limit = None
         where = []
         gin = []
         joins = []
+        # Values of any operators as (key, {normalized value: values as given}) pairs, to report matches of each row.
+        matches = []
 
         table = self._get_table(resource_path)
         resource_type = self._get_resource_type(resource_path)
@@ -565,11 +1890,35 @@ class PostgreSQLStorage(Storage):
             elif operator == 'limit':
                 limit = int(args[0])
 
+            elif operator in ('count', 'exists'):
+                if aggregate is not None and aggregate != operator:
+                    raise Exception("Operators %r and %r can't be used together." % (aggregate, operator))
+                aggregate = operator
+
             elif operator == 'exact':
                 key, value = args
+                self._check_index(self._get_gin_index_name(resource_type))
                 value = schema[key].search(value, cast=False)
                 gin.append({key: value})
 
+            elif operator == 'any':
+                # Values are separated by commas, a single index scan is done for each of them.
+                key, values = args
+                self._check_index(self._get_gin_index_name(resource_type))
+                given = collections.OrderedDict()
+                for value in values.split(','):
+                    given.setdefault(json.dumps(schema[key].search(value, cast=False)), []).append(value)
+                where.append(sa.or_(*(table.c.search.contains([{key: json.loads(value)}]) for value in given)))
+                matches.append((key, given))
+
+            elif operator == 'not_any':
+                # Negation of any, resources without any of the values, including resources without the field.
+                key, values = args
+                values = {json.dumps(schema[key].search(value, cast=False)) for value in values.split(',')}
+                where.append(sa.not_(sa.or_(*(
+                    table.c.search.contains([{key: json.loads(value)}]) for value in sorted(values)
+                ))))
+
             elif operator == 'startswith':
                 key, value = args
                 value = schema[key].search(value, cast=False)
@@ -622,10 +1971,27 @@ class PostgreSQLStorage(Storage):
             else:
                 raise Exception("Operator %r is not yet implemented." % operator)
 
-        if show_all is False and len(show) == 0:
+        if aggregate == 'count':
+            query = sa.select([sa.func.count(sa.distinct(table.c.id))])
+        elif aggregate == 'exists' or (show_all is False and len(show) == 0):
             query = sa.select([table.c.id], distinct=table.c.id)
-        else:
+        elif show_all:
             query = sa.select([table.c.id, table.c.revision, table.c.data], distinct=table.c.id)
+        else:
+            query = sa.select([table.c.id, project(table.c.data, show).label('data')], distinct=table.c.id)
+
+        if aggregate is None:
+            # Items of search column, that matched values of each any operator.
+            element = sa.column('value', type_=JSONB)
+            for i, (key, given) in enumerate(matches):
+                items = sa.cast([{key: json.loads(value)} for value in given], JSONB)
+                query = query.column(
+                    sa.select([sa.func.jsonb_agg(element)]).
+                    select_from(sa.func.jsonb_array_elements(table.c.search).alias('search_items')).
+                    where(items.contains(sa.func.jsonb_build_array(element))).
+                    as_scalar().
+                    label('matched%d' % i)
+                )
 
         for join in joins:
             query = query.select_from(join)
@@ -636,14 +2002,27 @@ class PostgreSQLStorage(Storage):
         if where:
             query = query.where(sa.and_(*where))
 
+        if aggregate == 'count':
+            async with self._acquire() as conn:
+                return {'count': await conn.scalar(query)}
+
+        if aggregate == 'exists':
+            async with self._acquire() as conn:
+                return {'exists': await conn.scalar(sa.select([sa.exists(query)]))}
+
         if sort_keys:
-            db_sort_keys = []
-            for sort_key in sort_keys:
+            # DISTINCT ON (id) only allows ordering by id first, so distinct rows are sorted in an outer query.
+            columns = [column.name for column in query.c]
+            for i, sort_key in enumerate(sort_keys):
                 if sort_key == 'id':
-                    db_sort_keys.append(table.c.id)
+                    query = query.column(table.c.id.label('sort%d' % i))
                 else:
-                    db_sort_keys.append(table.c.data[sort_key])
-            query = query.order_by(*db_sort_keys)
+                    query = query.column(table.c.data[sort_key].label('sort%d' % i))
+            query = query.alias('distinct_rows')
+            query = (
+                sa.select([query.c[column] for column in columns]).
+                order_by(*(query.c['sort%d' % i] for i in range(len(sort_keys))))
+            )
 
         if limit:
             query = query.limit(limit)
@@ -651,15 +2030,20 @@ class PostgreSQLStorage(Storage):
         if offset:
             query = query.offset(offset)
 
-        async with self.pool.acquire() as conn:
+        async with self._acquire() as conn:
             result = conn.execute(query)
 
             if show_all:
-                return [dict(row.data, id=row.id, revision=row.revision) async for row in result]
+                resources = [(dict(row.data, id=row.id, revision=row.revision), row) async for row in result]
             elif show:
-                return [dict({field: row.data[field] for field in show if field in row.data}, id=row.id) async for row in result]
+                resources = [(dict(row.data or {}, id=row.id), row) async for row in result]
             else:
-                return [{'id': row.id} async for row in result]
+                resources = [({'id': row.id}, row) async for row in result]
+
+        if matches:
+            for resource, row in resources:
+                resource['_matched'] = get_matched_values(row, matches)
+        return [resource for resource, row in resources]
 
     def wipe_all_data(self, *resource_paths):
         """A quick way to wipe all data in specified resource paths, mainly used for tests."""
@@ -670,6 +2054,10 @@ class PostgreSQLStorage(Storage):
                 conn.execute(table.delete())
                 aux_table = self.aux_tables[resource_type]
                 conn.execute(aux_table.delete())
+                changes_table = self.changes_tables[resource_type]
+                conn.execute(changes_table.delete())
+                if resource_type in self.search_caches:
+                    self.search_caches[resource_type].invalidate()
 
 
 def settings_to_dsn(settings):
@@ -684,21 +2072,101 @@ def settings_to_dsn(settings):
     return dsn
 
 
-async def init_storage(settings: Settings):
-    dsn = settings_to_dsn(settings['QVARN']['BACKEND'])
+def load_resource_types(resource_types_path, cache_path=None):
+    """Load resource type schemas from all YAML files found in resource_types_path.
+
+    Parsed schemas are cached in a JSON file at cache_path, keyed by file name, modification time and content hash,
+    so YAML files are only parsed if they were changed since the cache was written.
+    """
+    cache = {}
+    if cache_path:
+        try:
+            with open(cache_path) as f:
+                cache = json.load(f)
+        except (OSError, ValueError):
+            cache = {}
+
+    schemas = []
+    entries = {}
+    for path in sorted(pathlib.Path(resource_types_path).glob('*.yaml')):
+        stat = path.stat()
+        entry = cache.get(str(path))
+        if entry is None or entry['mtime'] != stat.st_mtime_ns or entry['size'] != stat.st_size:
+            content = path.read_bytes()
+            checksum = hashlib.sha256(content).hexdigest()
+            if entry is None or entry['sha256'] != checksum:
+                entry = {'sha256': checksum, 'schema': yaml.safe_load(content)}
+            entry = dict(entry, mtime=stat.st_mtime_ns, size=stat.st_size)
+        entries[str(path)] = entry
+        schemas.append(entry['schema'])
+
+    if cache_path and entries != cache:
+        f = None
+        try:
+            with tempfile.NamedTemporaryFile('w', dir=os.path.dirname(cache_path), delete=False) as f:
+                json.dump(entries, f)
+            os.replace(f.name, cache_path)
+        except (OSError, TypeError, ValueError) as e:
+            logger.warning("Could not write resource types cache %s: %s", cache_path, e)
+            if f is not None and os.path.exists(f.name):
+                os.unlink(f.name)
+
+    return schemas
+
+
+async def create_storage(backend):
+    """Create storage of a single database, without any resource types."""
+    dsn = settings_to_dsn(backend)
     engine = sa.create_engine(dsn, echo=False)
     pool = await aiopg.sa.create_engine(dsn)
-    storage = PostgreSQLStorage(engine, pool)
+    # Server-side prepared statements are bound to a server connection, which is not the case with pgbouncer in
+    # transaction pooling mode.
+    return PostgreSQLStorage(engine, pool, prepare=backend.get('PREPARED_STATEMENTS', True))
+
 
+async def init_storage(settings: Settings):
+    return await setup_storage(settings, create_storage)
+
+
+async def setup_storage(settings: Settings, create_storage):
+    """Create storages, add resource types to them and create or migrate database schema, if configured.
+
+    Resource types are stored in the database given in backend settings, unless SHARDS and RESOURCE_TYPE_SHARDS
+    settings assign them to other databases. SHARDS maps shard names to backend settings, that override the default
+    ones. RESOURCE_TYPE_SHARDS maps resource types to a shard name, or to a list of shard names to spread resources of
+    that type over several shards by id. The position of the shard in the list is encoded into ids of all created
+    resources, so a single shard can be turned into a list and shards can be appended to it later on, but shards
+    can't be removed or reordered. Ids created before positions were encoded are looked up in the first shard.
+    """
     resource_types_path = pathlib.Path(settings['QVARN']['RESOURCE_TYPES_PATH'])
     if not resource_types_path.exists():
         raise Exception('RESOURCE_TYPES_PATH not found: ' + settings['QVARN']['RESOURCE_TYPES_PATH'])
 
-    for path in sorted(resource_types_path.glob('*.yaml')):
-        schema = yaml.safe_load(path.read_text())
-        storage.add_resource_type(schema)
-
-    if settings['QVARN']['BACKEND']['INITDB']:
-        storage.init()
-
-    return storage
+    backend = settings['QVARN']['BACKEND']
+    shards = dict(backend.get('SHARDS', {}))
+    shards['default'] = {}
+    storages = {}
+    for name, shard in sorted(shards.items()):
+        storages[name] = await create_storage(dict(backend, **shard))
+
+    resource_shards = {}
+    for schema in load_resource_types(resource_types_path, settings['QVARN'].get('RESOURCE_TYPES_CACHE')):
+        names = backend.get('RESOURCE_TYPE_SHARDS', {}).get(schema['type'], 'default')
+        names = [names] if isinstance(names, str) else names
+        for number, name in enumerate(names):
+            if name not in storages:
+                raise Exception("Unknown shard %r of resource type %r." % (name, schema['type']))
+            storages[name].add_resource_type(schema, shard=number)
+        resource_shards[schema['path'].strip('/')] = [storages[name] for name in names]
+
+    if backend['INITDB']:
+        # DDL goes through the synchronous engine, run it in a thread to keep the event loop free.
+        loop = asyncio.get_event_loop()
+        for storage in storages.values():
+            if await loop.run_in_executor(None, storage.init):
+                # Indexes on existing tables are built in background, while already serving requests.
+                storage.migration = loop.run_in_executor(None, storage.migrate)
+
+    if len(storages) == 1:
+        return storages['default']
+    return ShardedStorage(storages, resource_shards)
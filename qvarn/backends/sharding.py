@@ -0,0 +1,256 @@
+"""
+Storage, that spreads resource types over several databases.
+
+Each shard is a complete storage of its own, with its own tables, connection pool and change log. A resource type is
+either stored in a single shard, or spread over several shards by id. The position of the shard in the list of shards
+of a resource type is stored in the id of every created resource, so reads and writes of a single resource go
+straight to the right shard. Ids created before shard positions were stored don't point to a valid shard, or point to
+a shard at random. These are only created while a resource type had a single shard, that must stay first in the list,
+so resources not found in the shard an id points to are looked up in the first shard. Listing and searching is done on all shards of the resource type concurrently and results
+are merged.
+"""
+
+import asyncio
+import heapq
+import itertools
+import json
+import random
+
+from qvarn import deadlines
+from qvarn.backends import ResourceNotFound
+from qvarn.backends import ResourceTypeNotFound
+from qvarn.backends import Storage
+from qvarn.backends import StorageError
+from qvarn.backends import build_search_path
+from qvarn.backends import parse_search_path
+
+
+def get_id_shard(row_id):
+    """Return shard number stored in a resource id by get_new_id, or None if row_id is not a valid id."""
+    fields = row_id.split('-')
+    if len(fields) != 3 or len(fields[1]) != 32:
+        return None
+    try:
+        return int(fields[1][-2:], 16)
+    except ValueError:
+        return None
+
+
+# Value of fields missing in a resource.
+MISSING = object()
+
+
+def jsonb_sort_key(value):
+    """Sort key, that orders JSON values the way PostgreSQL orders JSONB values.
+
+    Null < string < number < boolean < array < object. Missing fields are SQL NULL, that sorts after all JSONB
+    values. Strings are compared by code points, while PostgreSQL uses collation of the database, so order of
+    non-ASCII strings can differ from order of a single shard.
+    """
+    if value is MISSING:
+        return (6,)
+    if value is None:
+        return (0, '')
+    if isinstance(value, str):
+        return (1, value)
+    if isinstance(value, bool):
+        return (3, value)
+    if isinstance(value, (int, float)):
+        return (2, value)
+    if isinstance(value, list):
+        return (4, len(value), json.dumps(value, sort_keys=True))
+    return (5, len(value), json.dumps(value, sort_keys=True))
+
+
+class ShardedStorage(Storage):
+
+    def __init__(self, storages, resource_shards):
+        # Storages keyed by shard name and list of storages of each resource path.
+        self.storages = storages
+        self.resource_shards = resource_shards
+
+    def _get_shards(self, resource_path):
+        try:
+            return self.resource_shards[resource_path]
+        except KeyError:
+            raise ResourceTypeNotFound("Resource type %r not found." % resource_path)
+
+    def _get_shard(self, resource_path, row_id):
+        shards = self._get_shards(resource_path)
+        shard = get_id_shard(row_id)
+        if shard is None or shard >= len(shards):
+            return shards[0]
+        return shards[shard]
+
+    async def _call(self, resource_path, row_id, method, *args):
+        # Call a method of the shard of a resource, falling back to the first shard for older ids.
+        shards = self._get_shards(resource_path)
+        shard = self._get_shard(resource_path, row_id)
+        try:
+            return await getattr(shard, method)(resource_path, row_id, *args)
+        except ResourceNotFound:
+            if shard is shards[0]:
+                raise
+        return await getattr(shards[0], method)(resource_path, row_id, *args)
+
+    async def create(self, resource_path, data):
+        shards = self._get_shards(resource_path)
+        return await random.choice(shards).create(resource_path, data)
+
+    async def get(self, resource_path, row_id, fields=None):
+        return await self._call(resource_path, row_id, 'get', fields)
+
+    async def get_many(self, resource_path, row_ids, fields=None):
+        shards = self._get_shards(resource_path)
+        groups = {}
+        for row_id in row_ids:
+            groups.setdefault(self._get_shard(resource_path, row_id), []).append(row_id)
+        results = await asyncio.gather(*(
+            deadlines.inherit(shard.get_many(resource_path, groups[shard], fields))
+            for shard in shards if shard in groups
+        ))
+        found = {resource['id']: resource for resources, _ in results for resource in resources}
+        # Older ids, that point to another shard, are looked up in the first shard.
+        missing = [row_id for shard in shards[1:] for row_id in groups.get(shard, []) if row_id not in found]
+        if missing:
+            resources, _ = await shards[0].get_many(resource_path, missing, fields)
+            found.update((resource['id'], resource) for resource in resources)
+        return (
+            [found[row_id] for row_id in row_ids if row_id in found],
+            [row_id for row_id in row_ids if row_id not in found],
+        )
+
+    async def put(self, resource_path, row_id, data):
+        return await self._call(resource_path, row_id, 'put', data)
+
+    async def delete(self, resource_path, row_id):
+        shards = self._get_shards(resource_path)
+        shard = self._get_shard(resource_path, row_id)
+        if shard is not shards[0]:
+            # Deleting a missing resource is not an error, an older id could still be in the first shard.
+            await shards[0].delete(resource_path, row_id)
+        return await shard.delete(resource_path, row_id)
+
+    async def get_subpath(self, resource_path, row_id, subpath):
+        return await self._call(resource_path, row_id, 'get_subpath', subpath)
+
+    async def put_subpath(self, resource_path, row_id, subpath, data):
+        return await self._call(resource_path, row_id, 'put_subpath', subpath, data)
+
+    def is_file(self, resource_path, subpath):
+        return self._get_shards(resource_path)[0].is_file(resource_path, subpath)
+
+    async def get_file(self, resource_path, row_id, subpath):
+        return await self._call(resource_path, row_id, 'get_file', subpath)
+
+    async def put_file(self, resource_path, row_id, subpath, body, revision, content_type):
+        return await self._call(resource_path, row_id, 'put_file', subpath, body, revision, content_type)
+
+    async def list(self, resource_path):
+        results = await asyncio.gather(*(
+            deadlines.inherit(shard.list(resource_path)) for shard in self._get_shards(resource_path)
+        ))
+        return list(itertools.chain.from_iterable(results))
+
+    async def count(self, resource_path, estimate=False):
+        results = await asyncio.gather(*(
+            deadlines.inherit(shard.count(resource_path, estimate)) for shard in self._get_shards(resource_path)
+        ))
+        return sum(results)
+
+    def export(self, resource_path, files=False):
+        return self._export(self._get_shards(resource_path), resource_path, files)
+
+    async def _export(self, shards, resource_path, files):
+        # Shards are exported one after another, each as of its own snapshot.
+        for shard in shards:
+            items = shard.export(resource_path, files)
+            try:
+                async for item in items:
+                    yield item
+            finally:
+                await items.aclose()
+
+    def import_resources(self, resource_path, lines, **kwargs):
+        shards = self._get_shards(resource_path)
+        if len(shards) > 1:
+            # Lines would have to be routed to shards by id before they are prepared in bulk.
+            raise StorageError("Resource type %r is spread over several shards, it can't be imported." % resource_path)
+        return shards[0].import_resources(resource_path, lines, **kwargs)
+
+    async def reindex(self, resource_path, **kwargs):
+        # Every shard stores its own position, an interrupted reindex goes on from there in each shard.
+        for shard in self._get_shards(resource_path):
+            counts = shard.reindex(resource_path, **kwargs)
+            try:
+                async for count in counts:
+                    yield count
+            finally:
+                await counts.aclose()
+
+    def get_resource_paths(self):
+        return sorted(self.resource_shards)
+
+    async def changes(self, resource_path, since=0, limit=1000, wait=0):
+        shards = self._get_shards(resource_path)
+        if len(shards) > 1:
+            # Every shard has its own sequence of changes, a single sequence number can't point into all of them.
+            raise StorageError("Changes of resource type %r are spread over several shards." % resource_path)
+        return await shards[0].changes(resource_path, since, limit, wait)
+
+    async def search(self, resource_path, search_path):
+        shards = self._get_shards(resource_path)
+        if len(shards) == 1:
+            return await shards[0].search(resource_path, search_path)
+
+        operators = parse_search_path(search_path)
+        sort_keys = [arg for operator, args in operators if operator == 'sort' for arg in args]
+        show = [arg for operator, args in operators if operator == 'show' for arg in args]
+        show_all = any(operator == 'show_all' for operator, args in operators)
+        offset = limit = None
+        for operator, args in operators:
+            if operator == 'offset':
+                offset = int(args[0])
+            elif operator == 'limit':
+                limit = int(args[0])
+        offset = offset or 0
+
+        # Every shard returns up to offset + limit first resources, offset and limit are applied after merging. Sort
+        # keys must be in results to merge them, these are removed again afterwards.
+        operators = [(operator, args) for operator, args in operators if operator not in ('offset', 'limit')]
+        if limit:
+            operators.append(('limit', [str(offset + limit)]))
+        hidden = []
+        if not show_all:
+            hidden = [key for key in sort_keys if key != 'id' and key not in show]
+            operators.extend(('show', [key]) for key in hidden)
+
+        results = await asyncio.gather(*(
+            deadlines.inherit(shard.search(resource_path, build_search_path(operators))) for shard in shards
+        ))
+
+        if isinstance(results[0], dict):
+            if 'count' in results[0]:
+                return {'count': sum(result['count'] for result in results)}
+            return {'exists': any(result['exists'] for result in results)}
+
+        if sort_keys:
+            merged = heapq.merge(*results, key=lambda resource: tuple(
+                jsonb_sort_key(resource.get(key, MISSING)) for key in sort_keys
+            ))
+        else:
+            merged = itertools.chain.from_iterable(results)
+        merged = itertools.islice(merged, offset, offset + limit if limit else None)
+
+        if hidden:
+            return [
+                {key: value for key, value in resource.items() if key not in hidden}
+                for resource in merged
+            ]
+        return list(merged)
+
+    def wipe_all_data(self, *resource_paths):
+        """A quick way to wipe all data in specified resource paths, mainly used for tests."""
+        for resource_path in resource_paths:
+            for shard in self._get_shards(resource_path):
+                shard.wipe_all_data(resource_path)
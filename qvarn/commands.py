@@ -1,4 +1,9 @@
+import asyncio
 import base64
+import contextlib
+import gzip
+import sys
+import time
 import urllib.parse
 
 import requests
@@ -7,6 +12,9 @@ from Crypto.Util.number import bytes_to_long
 
 from apistar.interfaces import Console
 
+from qvarn.backends import Storage
+from qvarn.export import export_chunks
+
 
 def _b64toint(value):
     missing_padding = '=' * (4 - len(value) % 4)
@@ -28,3 +36,73 @@ def token_signing_key(console: Console, gluu_url: str) -> None:
             exp = _b64toint(params['e'])
             key = RSA.construct((mod, exp))
             console.echo(key.exportKey('OpenSSH').decode())
+
+
+def export(storage: Storage, resource_type: str, output: str='-', files: bool=False, compress: bool=False) -> None:
+    """
+    Export all resources of a resource type with their subpaths as NDJSON.
+
+    Args:
+        resource_type: Resource type path, for example orgs.
+        output: Output file, standard output by default.
+        files: Include base64 encoded contents of files.
+        compress: Compress output with gzip.
+    """
+    async def write(f):
+        async for chunk in export_chunks(storage.export(resource_type, files=files), compress=compress):
+            f.write(chunk)
+
+    with contextlib.ExitStack() as stack:
+        f = sys.stdout.buffer if output == '-' else stack.enter_context(open(output, 'wb'))
+        asyncio.get_event_loop().run_until_complete(write(f))
+
+
+def import_resources(console: Console, storage: Storage, resource_type: str, input: str='-',
+                     generate_ids: bool=False, drop_indexes: bool=False, workers: int=None) -> None:
+    """
+    Import resources of a resource type from NDJSON in export format.
+
+    Args:
+        resource_type: Resource type path, for example orgs.
+        input: Input file, gzip compressed if its name ends with .gz, standard input by default.
+        generate_ids: Give resources new ids, instead of keeping ids from input.
+        drop_indexes: Drop indexes for the time of the import and build them again afterwards.
+        workers: Number of worker processes, number of CPUs by default.
+    """
+    with contextlib.ExitStack() as stack:
+        if input == '-':
+            f = sys.stdin.buffer
+        elif input.endswith('.gz'):
+            f = stack.enter_context(gzip.open(input))
+        else:
+            f = stack.enter_context(open(input, 'rb'))
+        started = time.monotonic()
+        total = 0
+        for count in storage.import_resources(resource_type, f, generate_ids=generate_ids,
+                                              drop_indexes=drop_indexes, workers=workers):
+            total += count
+            console.echo('Imported %d resources, %d/s.' % (total, total / (time.monotonic() - started)))
+
+
+def reindex(console: Console, storage: Storage, resource_types: str=None, workers: int=None,
+            restart: bool=False) -> None:
+    """
+    Recompute search columns and aux rows of resources, after flattening or prototypes changed.
+
+    Can be run while serving requests. An interrupted reindex goes on from where it was, when run again.
+
+    Args:
+        resource_types: Comma separated resource type paths, all resource types by default.
+        workers: Number of worker processes, number of CPUs by default.
+        restart: Start from the beginning, instead of going on with an interrupted reindex.
+    """
+    async def run(resource_type):
+        started = time.monotonic()
+        total = 0
+        async for count in storage.reindex(resource_type, workers=workers, restart=restart):
+            total += count
+            console.echo('Reindexed %d %s, %d/s.' % (total, resource_type, total / (time.monotonic() - started)))
+
+    resource_types = resource_types.split(',') if resource_types else storage.get_resource_paths()
+    for resource_type in resource_types:
+        asyncio.get_event_loop().run_until_complete(run(resource_type))
@@ -0,0 +1,171 @@
+"""
+Compression of responses.
+
+Responses are compressed with brotli or gzip, whichever the client prefers in Accept-Encoding, brotli only if the
+brotli package is installed. Responses smaller than MIN_SIZE are sent as is, compressing them saves less than it costs.
+Bodies of at least EXECUTOR_MIN_SIZE bytes are compressed in a thread of the default executor, zlib and brotli release
+the GIL, so that compressing a big search result does not stall other requests. Streamed responses are compressed
+chunk by chunk, as they are sent.
+"""
+
+import asyncio
+import zlib
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+# Content types worth compressing, other types, like images in file subpaths, are usually compressed already.
+COMPRESSIBLE_TYPES = ('application/json', 'application/x-ndjson', 'application/javascript', 'text/')
+
+
+def parse_accept_encoding(value):
+    """Return quality of each coding in an Accept-Encoding header value, keyed by lowercase coding."""
+    qualities = {}
+    for item in value.split(','):
+        coding, *params = [part.strip() for part in item.split(';')]
+        if not coding:
+            continue
+        quality = 1.0
+        for param in params:
+            name, _, arg = param.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    quality = float(arg)
+                except ValueError:
+                    quality = 0.0
+        qualities[coding.lower()] = quality
+    return qualities
+
+
+class GzipCompressor:
+
+    def __init__(self, level):
+        self.compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def compress(self, data):
+        return self.compressor.compress(data)
+
+    def flush(self):
+        return self.compressor.flush()
+
+
+class BrotliCompressor:
+
+    def __init__(self, quality):
+        self.compressor = brotli.Compressor(quality=quality)
+
+    def compress(self, data):
+        return self.compressor.process(data)
+
+    def flush(self):
+        return self.compressor.finish()
+
+
+def compress(compressor, data, final):
+    data = compressor.compress(data)
+    if final:
+        data += compressor.flush()
+    return data
+
+
+def get_header(headers, name):
+    for key, value in headers:
+        if key.lower() == name:
+            return value
+    return None
+
+
+class Compression:
+    """Compression settings of responses."""
+
+    def __init__(self, min_size=1024, executor_min_size=256 * 1024, gzip_level=6, brotli_quality=4):
+        self.min_size = min_size
+        self.executor_min_size = executor_min_size
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+        self.encodings = ('br', 'gzip') if brotli else ('gzip',)
+
+    def get_encoding(self, accept_encoding):
+        """Return the encoding preferred by the client, brotli on a tie, or None if no encoding is acceptable."""
+        if not accept_encoding:
+            return None
+        qualities = parse_accept_encoding(accept_encoding)
+        default = qualities.get('*', 0.0)
+        encoding = max(self.encodings, key=lambda encoding: (qualities.get(encoding, default), encoding == 'br'))
+        return encoding if qualities.get(encoding, default) > 0 else None
+
+    def get_compressor(self, encoding):
+        if encoding == 'br':
+            return BrotliCompressor(self.brotli_quality)
+        return GzipCompressor(self.gzip_level)
+
+    def reply_channel(self, message, channel):
+        """Wrap reply channel of a request, so that its response is compressed, if the client accepts it."""
+        accept_encoding = get_header(message.get('headers', []), b'accept-encoding') or b''
+        encoding = self.get_encoding(accept_encoding.decode('latin-1'))
+        if encoding is None:
+            return channel
+        return CompressingReplyChannel(channel, self, encoding)
+
+
+class CompressingReplyChannel:
+    """Reply channel, that compresses content of response messages."""
+
+    def __init__(self, channel, compression, encoding):
+        self.channel = channel
+        self.compression = compression
+        self.encoding = encoding
+        self.compressor = None
+
+    async def send(self, message):
+        if 'status' in message and self._is_compressible(message):
+            # Size of streamed responses is not known in advance, these are always compressed.
+            if message.get('more_content') or len(message.get('content', b'')) >= self.compression.min_size:
+                self.compressor = self.compression.get_compressor(self.encoding)
+                message = dict(message, headers=[
+                    [key, value] for key, value in message['headers'] if key.lower() != b'content-length'
+                ] + [
+                    [b'content-encoding', self.encoding.encode()],
+                    [b'vary', b'Accept-Encoding'],
+                ])
+
+        if self.compressor is not None:
+            content = message.get('content', b'')
+            final = not message.get('more_content')
+            if len(content) >= self.compression.executor_min_size:
+                content = await asyncio.get_event_loop().run_in_executor(
+                    None, compress, self.compressor, content, final,
+                )
+            else:
+                content = compress(self.compressor, content, final)
+            message = dict(message, content=content)
+
+        await self.channel.send(message)
+
+    def _is_compressible(self, message):
+        headers = message.get('headers', [])
+        if message['status'] < 200 or message['status'] in (204, 304):
+            return False
+        if get_header(headers, b'content-encoding') is not None:
+            return False
+        content_type = (get_header(headers, b'content-type') or b'').decode('latin-1').lower()
+        return content_type.startswith(COMPRESSIBLE_TYPES)
+
+
+def get_compression(settings):
+    """Return compression settings of responses.
+
+    Settings are given in COMPRESSION settings, MIN_SIZE is the size of the smallest response body, that is
+    compressed, bodies of at least EXECUTOR_MIN_SIZE bytes are compressed in a thread. GZIP_LEVEL and BROTLI_QUALITY
+    set the trade-off between speed and size.
+    """
+    config = settings['QVARN'].get('COMPRESSION', {})
+    return Compression(
+        min_size=config.get('MIN_SIZE', 1024),
+        executor_min_size=config.get('EXECUTOR_MIN_SIZE', 256 * 1024),
+        gzip_level=config.get('GZIP_LEVEL', 6),
+        brotli_quality=config.get('BROTLI_QUALITY', 4),
+    )
@@ -0,0 +1,88 @@
+"""
+Deadlines of requests.
+
+A deadline is set for the task handling a request, before the view is run. Storage reads the time left until the
+deadline of the current task, and bounds waiting for a connection and running queries by it. Tasks started on behalf
+of a request with inherit() get the same deadline.
+"""
+
+import asyncio
+import weakref
+
+from apistar import Settings
+from apistar import http
+from apistar.types import Handler
+
+from qvarn.exceptions import BadRequest
+
+
+try:
+    current_task = asyncio.current_task
+except AttributeError:  # Python < 3.7
+    current_task = asyncio.Task.current_task
+
+# Deadlines in event loop time, keyed by task.
+_deadlines = weakref.WeakKeyDictionary()
+
+# Values of requests keyed by task, that tasks started with inherit() get too.
+_inherited = [_deadlines]
+
+
+def inherited(values):
+    """Register a dict of values keyed by task, so that tasks started with inherit() get value of their parent."""
+    _inherited.append(values)
+    return values
+
+
+def set_deadline(timeout):
+    """Set deadline of current task to timeout seconds from now, or remove it if timeout is None."""
+    task = current_task()
+    if timeout is None:
+        _deadlines.pop(task, None)
+    else:
+        _deadlines[task] = asyncio.get_event_loop().time() + timeout
+
+
+def get_timeout():
+    """Return seconds left until deadline of current task, or None if there is no deadline."""
+    task = current_task()
+    deadline = None if task is None else _deadlines.get(task)
+    if deadline is None:
+        return None
+    return deadline - asyncio.get_event_loop().time()
+
+
+def inherit(coro, deadline=True):
+    """Schedule coro in a new task, that has the same deadline as the current task, unless deadline is false."""
+    task = current_task()
+    new_task = asyncio.ensure_future(coro)
+    if task is not None:
+        for values in _inherited:
+            if values is _deadlines and not deadline:
+                continue
+            value = values.get(task)
+            if value is not None:
+                values[new_task] = value
+    return new_task
+
+
+def set_request_deadline(handler: Handler, headers: http.Headers, settings: Settings):
+    """Set deadline of a request.
+
+    Deadline of each route class is configured in DEADLINES settings, in seconds. Clients can ask for a shorter
+    deadline with Request-Timeout header.
+    """
+    timeout = settings['QVARN'].get('DEADLINES', {}).get(getattr(handler, 'route_class', '').upper())
+    requested = headers.get('Request-Timeout')
+    if requested:
+        try:
+            requested = float(requested)
+        except ValueError:
+            requested = 0
+        if not requested > 0:
+            raise BadRequest({
+                'error_code': 'InvalidRequestTimeout',
+                'message': 'Request-Timeout should be a positive number of seconds',
+            })
+        timeout = requested if timeout is None else min(timeout, requested)
+    set_deadline(timeout)
@@ -13,6 +13,11 @@ class HTTPException(apistar.exceptions.HTTPException):
         assert self.status_code is not None, '"status_code" is required.'
 
 
+class BadRequest(HTTPException):
+    default_status_code = 400
+    default_detail = 'Bad request'
+
+
 class Unauthorized(HTTPException):
     default_status_code = 401
     default_detail = 'Unauthorized'
@@ -31,3 +36,8 @@ class NotFound(HTTPException):
 class Conflict(HTTPException):
     default_status_code = 409
     default_detail = 'Conflict'
+
+
+class ServiceUnavailable(HTTPException):
+    default_status_code = 503
+    default_detail = 'Service unavailable'
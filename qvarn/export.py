@@ -0,0 +1,53 @@
+"""
+NDJSON export of resource types.
+
+Every line is a JSON object with a resource, data of its subpaths and, if asked for, base64 encoded contents of its
+files:
+
+    {"resource": {"id": ..., "revision": ..., ...}, "subpaths": {...}, "files": {...}}
+
+Lines are encoded as resources are read from storage and sent in chunks, so exports of any size take constant memory.
+"""
+
+import base64
+import json
+import zlib
+
+
+CHUNK_SIZE = 64 * 1024
+
+
+def encode_item(item):
+    """Encode an item of Storage.export() as a line of NDJSON."""
+    if 'files' in item:
+        item = dict(item, files={
+            subpath: base64.b64encode(blob).decode() for subpath, blob in item['files'].items()
+        })
+    return json.dumps(item, ensure_ascii=False, separators=(',', ':')).encode() + b'\n'
+
+
+async def export_chunks(items, compress=False, chunk_size=CHUNK_SIZE):
+    """Encode items of Storage.export() as NDJSON, in chunks of about chunk_size bytes, optionally gzip compressed."""
+    compressor = zlib.compressobj(wbits=16 + zlib.MAX_WBITS) if compress else None
+    lines = []
+    size = 0
+    try:
+        async for item in items:
+            line = encode_item(item)
+            lines.append(line)
+            size += len(line)
+            if size >= chunk_size:
+                chunk = b''.join(lines)
+                lines = []
+                size = 0
+                if compressor:
+                    chunk = compressor.compress(chunk)
+                if chunk:
+                    yield chunk
+    finally:
+        await items.aclose()
+    chunk = b''.join(lines)
+    if compressor:
+        chunk = compressor.compress(chunk) + compressor.flush()
+    if chunk:
+        yield chunk
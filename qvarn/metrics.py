@@ -0,0 +1,76 @@
+"""
+In-process metrics of a single worker, exported in Prometheus text format.
+"""
+
+
+class Metric:
+    type = None
+
+    def __init__(self, name, documentation):
+        self.name = name
+        self.documentation = documentation
+        self.values = {}
+        REGISTRY.append(self)
+
+    def get(self, **labels):
+        return self.values.get(tuple(sorted(labels.items())), 0)
+
+    def samples(self):
+        for labels, value in sorted(self.values.items()):
+            yield self.name, labels, value
+
+    def render(self):
+        lines = [
+            '# HELP %s %s' % (self.name, self.documentation),
+            '# TYPE %s %s' % (self.name, self.type),
+        ]
+        for name, labels, value in self.samples():
+            if labels:
+                labels = '{%s}' % ','.join('%s="%s"' % (k, v) for k, v in labels)
+            else:
+                labels = ''
+            lines.append('%s%s %s' % (name, labels, value))
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, value=1, **labels):
+        key = tuple(sorted(labels.items()))
+        self.values[key] = self.values.get(key, 0) + value
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def set(self, value, **labels):
+        self.values[tuple(sorted(labels.items()))] = value
+
+    def inc(self, value=1, **labels):
+        key = tuple(sorted(labels.items()))
+        self.values[key] = self.values.get(key, 0) + value
+
+    def dec(self, value=1, **labels):
+        self.inc(-value, **labels)
+
+
+class Summary(Metric):
+    type = 'summary'
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        count, total = self.values.get(key, (0, 0))
+        self.values[key] = (count + 1, total + value)
+
+    def samples(self):
+        for labels, (count, total) in sorted(self.values.items()):
+            yield self.name + '_count', labels, count
+            yield self.name + '_sum', labels, total
+
+
+REGISTRY = []
+
+
+def render():
+    return '\n'.join(metric.render() for metric in REGISTRY) + '\n'
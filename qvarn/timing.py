@@ -0,0 +1,176 @@
+"""
+Timing of request phases.
+
+Phases of a request, like authentication, waiting for a database connection, queries and rendering, are timed with
+phase() or record() and reported in Server-Timing response header, summed by phase name. Timing is enabled for all
+requests with ENABLED in TIMING settings, or for a single request with Qvarn-Timing header carrying TOKEN of TIMING
+settings. With TRACE_FILE set, spans of timed requests are appended to that file as JSON lines, to be picked up by a
+local trace collector.
+
+Timers are kept per task like deadlines and tasks started with deadlines.inherit() add to timers of their request,
+so phases of concurrent queries on several shards can add up to more than the whole request took.
+"""
+
+import collections
+import contextlib
+import functools
+import hmac
+import json
+import logging
+import time
+import uuid
+import weakref
+
+from qvarn import deadlines
+
+
+logger = logging.getLogger(__name__)
+
+# Timings of requests, keyed by task.
+_timings = deadlines.inherited(weakref.WeakKeyDictionary())
+
+now = time.perf_counter
+
+
+class Timing:
+    """Timers of phases of a single request."""
+
+    def __init__(self):
+        self.trace_id = uuid.uuid4().hex
+        self.timestamp = time.time()
+        self.start = now()
+        self.spans = []
+        self.status = None
+
+    def add(self, name, start, end):
+        self.spans.append((name, start, end))
+
+    def get_phases(self):
+        phases = collections.OrderedDict()
+        for name, start, end in self.spans:
+            phases[name] = phases.get(name, 0) + end - start
+        phases['total'] = now() - self.start
+        return phases
+
+    def get_header(self):
+        return ', '.join('%s;dur=%.3f' % (name, duration * 1000) for name, duration in self.get_phases().items())
+
+    def get_trace(self, message):
+        return {
+            'trace_id': self.trace_id,
+            'timestamp': self.timestamp,
+            'method': message.get('method'),
+            'path': message.get('path'),
+            'status': self.status,
+            'duration': now() - self.start,
+            'spans': [
+                {'name': name, 'start': start - self.start, 'duration': end - start}
+                for name, start, end in self.spans
+            ],
+        }
+
+
+def get_timing():
+    """Return timing of the request handled by the current task, or None if it is not timed."""
+    task = deadlines.current_task()
+    return None if task is None else _timings.get(task)
+
+
+def record(name, start, end=None):
+    """Record a phase of the current request, that started at start, as given by now()."""
+    timing = get_timing()
+    if timing is not None:
+        timing.add(name, start, now() if end is None else end)
+
+
+@contextlib.contextmanager
+def phase(name):
+    """Time the enclosed block as a phase of the current request."""
+    start = now()
+    try:
+        yield
+    finally:
+        record(name, start)
+
+
+def timed(name):
+    """Decorator, that times calls of a function as a phase of the current request."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with phase(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class TimingReplyChannel:
+    """Reply channel, that adds Server-Timing header to response of a timed request."""
+
+    def __init__(self, channel, timing):
+        self.channel = channel
+        self.timing = timing
+
+    async def send(self, message):
+        if 'status' in message:
+            self.timing.status = message['status']
+            message = dict(message, headers=message.get('headers', []) + [
+                [b'server-timing', self.timing.get_header().encode()],
+            ])
+        await self.channel.send(message)
+
+
+class Tracing:
+    """Timing settings of requests."""
+
+    def __init__(self, enabled=False, token=None, trace_file=None):
+        self.enabled = enabled
+        self.token = token
+        self.trace_file = trace_file
+        self.file = None
+
+    def is_timed(self, message):
+        if self.enabled:
+            return True
+        if not self.token:
+            return False
+        for key, value in message.get('headers', []):
+            if key.lower() == b'qvarn-timing':
+                return hmac.compare_digest(value, self.token.encode())
+        return False
+
+    def start(self, message, channel):
+        """Start timing of a request handled by the current task, if it is timed.
+
+        Returns timing, or None if the request is not timed, and reply channel, that adds Server-Timing header.
+        """
+        if not self.is_timed(message):
+            return None, channel
+        timing = _timings[deadlines.current_task()] = Timing()
+        return timing, TimingReplyChannel(channel, timing)
+
+    def finish(self, timing, message):
+        """Write spans of a request to trace file, once its response is sent."""
+        _timings.pop(deadlines.current_task(), None)
+        if not self.trace_file:
+            return
+        try:
+            if self.file is None:
+                self.file = open(self.trace_file, 'a', buffering=1)
+            self.file.write(json.dumps(timing.get_trace(message)) + '\n')
+        except OSError as e:
+            logger.warning("Could not write trace to %s: %s", self.trace_file, e)
+
+
+def get_tracing(settings):
+    """Return timing settings of requests.
+
+    Settings are given in TIMING settings, ENABLED times all requests, requests with Qvarn-Timing header equal to
+    TOKEN are timed in any case. Spans of timed requests are appended to TRACE_FILE, if it's set.
+    """
+    config = settings['QVARN'].get('TIMING', {})
+    return Tracing(
+        enabled=config.get('ENABLED', False),
+        token=config.get('TOKEN'),
+        trace_file=config.get('TRACE_FILE'),
+    )
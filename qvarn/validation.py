@@ -1,2 +1,139 @@
-def validated(resource_type, schema, data):
-    return {k: v for k, v in data.items() if k not in ('id', 'revision')}
+"""
+Validation of resources against prototypes of resource types.
+
+A prototype is an example resource: dicts list all allowed keys, a list holds the prototype of its items and leaves
+tell the type of values, "" for strings, 0 for integers, 0.0 for numbers and false for booleans. Every key is
+optional and any value can be null.
+
+Validators are compiled into Python source once per prototype, so that validating a typical resource takes a few
+microseconds.
+"""
+
+import json
+
+
+# Keys, that are set by storage and are dropped from validated data.
+IGNORED_KEYS = frozenset(['id', 'revision'])
+
+
+class ValidationError(Exception):
+    """Resource does not match prototype of its resource type."""
+
+    def __init__(self, error_code, field, message):
+        super().__init__(message)
+        self.error_code = error_code
+        self.field = field
+        self.message = message
+
+
+def _wrong_type(field, expected, value):
+    return ValidationError('WrongType', field, 'Field %s should be %s, got %s.' % (
+        field or 'resource', expected, type(value).__name__,
+    ))
+
+
+def _unknown_field(field, data, keys):
+    name = sorted(set(data).difference(keys))[0]
+    field = '%s.%s' % (field, name) if field else name
+    return ValidationError('UnknownField', field, 'Field %s is not allowed.' % field)
+
+
+class Validator:
+    """Validator for resources of a prototype.
+
+    Checks structure and types of values and rejects keys not in prototype. Integral floats are accepted as integers
+    and integers as floats, coerced values are replaced in place. Prototype is turned into Python source with a loop
+    for each list, field names of errors are only formatted when an error is raised.
+    """
+
+    def __init__(self, prototype, ignore=IGNORED_KEYS):
+        self.keys = []
+        lines = []
+        self._compile(lines, prototype, 'data', None, '', [], 1, ignore)
+        source = '\n'.join(
+            ['def validate(data):'] +
+            lines +
+            ['    return {k: v for k, v in data.items() if k not in ignored}']
+        )
+        namespace = {
+            'wrong_type': _wrong_type,
+            'unknown_field': _unknown_field,
+            'ignored': frozenset(ignore),
+        }
+        namespace.update(('keys_%d' % i, keys) for i, keys in enumerate(self.keys))
+        exec(compile(source, '<validator>', 'exec'), namespace)
+        self._validate = namespace['validate']
+        self.source = source
+
+    def _compile(self, lines, proto, var, target, field, indexes, level, ignore=()):
+        indent = '    ' * level
+        # Field name of errors, formatted with indexes of enclosing lists.
+        if indexes:
+            name = '%r %% (%s,)' % (field, ', '.join(indexes))
+        else:
+            name = repr(field % ())
+
+        if isinstance(proto, dict):
+            self.keys.append(frozenset(proto).union(ignore))
+            keys = 'keys_%d' % (len(self.keys) - 1)
+            lines.append(indent + 'if type(%s) is not dict:' % var)
+            lines.append(indent + '    raise wrong_type(%s, %r, %s)' % (name, 'an object', var))
+            lines.append(indent + 'if not %s.issuperset(%s):' % (keys, var))
+            lines.append(indent + '    raise unknown_field(%s, %s, %s)' % (name, var, keys))
+            for i, k in enumerate(sorted(proto)):
+                if k in ignore or proto[k] is None:
+                    continue
+                value = '%s_%d' % (var, i)
+                child = k.replace('%', '%%')
+                lines.append(indent + '%s = %s.get(%r)' % (value, var, k))
+                lines.append(indent + 'if %s is not None:' % value)
+                self._compile(
+                    lines, proto[k], value, '%s[%r]' % (var, k), '%s.%s' % (field, child) if field else child,
+                    indexes, level + 1,
+                )
+        elif isinstance(proto, list):
+            lines.append(indent + 'if type(%s) is not list:' % var)
+            lines.append(indent + '    raise wrong_type(%s, %r, %s)' % (name, 'a list', var))
+            if proto and proto[0] is not None:
+                item = var + '_i'
+                index = var + '_n'
+                lines.append(indent + 'for %s, %s in enumerate(%s):' % (index, item, var))
+                lines.append(indent + '    if %s is not None:' % item)
+                self._compile(
+                    lines, proto[0], item, '%s[%s]' % (var, index), field + '[%d]', indexes + [index], level + 2,
+                )
+        elif isinstance(proto, bool):
+            lines.append(indent + 'if type(%s) is not bool:' % var)
+            lines.append(indent + '    raise wrong_type(%s, %r, %s)' % (name, 'a boolean', var))
+        elif isinstance(proto, int):
+            lines.append(indent + 'if type(%s) is not int:' % var)
+            lines.append(indent + '    if type(%s) is float and %s.is_integer():' % (var, var))
+            lines.append(indent + '        %s = int(%s)' % (target, var))
+            lines.append(indent + '    else:')
+            lines.append(indent + '        raise wrong_type(%s, %r, %s)' % (name, 'an integer', var))
+        elif isinstance(proto, float):
+            lines.append(indent + 'if type(%s) is not float:' % var)
+            lines.append(indent + '    if type(%s) is int:' % var)
+            lines.append(indent + '        %s = float(%s)' % (target, var))
+            lines.append(indent + '    else:')
+            lines.append(indent + '        raise wrong_type(%s, %r, %s)' % (name, 'a number', var))
+        else:
+            lines.append(indent + 'if type(%s) is not str:' % var)
+            lines.append(indent + '    raise wrong_type(%s, %r, %s)' % (name, 'a string', var))
+
+    def validate(self, data):
+        """Return validated data without ignored keys, raise ValidationError if data does not match prototype."""
+        return self._validate(data)
+
+
+# Validators of each prototype, shared by resource types and worker processes with the same prototype.
+_validators = {}
+
+
+def get_validator(prototype):
+    """Return validator of a prototype, compiled on first use."""
+    key = json.dumps(prototype, sort_keys=True)
+    validator = _validators.get(key)
+    if validator is None:
+        validator = _validators[key] = Validator(prototype)
+    return validator
@@ -1,3 +1,4 @@
+import collections
 import urllib.parse
 
 import aiohttp
@@ -10,15 +11,28 @@ from apistar import Settings
 from apistar.types import PathWildcard
 from apistar.parsers import JSONParser
 
+from qvarn import metrics
 from qvarn.backends import Storage
+from qvarn.backends import IndexNotReady
 from qvarn.backends import ResourceNotFound
 from qvarn.backends import ResourceTypeNotFound
 from qvarn.backends import WrongRevision
+from qvarn.exceptions import BadRequest
 from qvarn.exceptions import NotFound
 from qvarn.exceptions import Conflict
+from qvarn.exceptions import ServiceUnavailable
+from qvarn.export import export_chunks
+from qvarn.validation import ValidationError
 from qvarn.auth import CheckScopes
 
 
+CHANGES_LIMIT = 1000
+
+CHANGES_MAX_WAIT = 60
+
+BATCH_LIMIT = 1000
+
+
 async def version():
     return {
         "api": {
@@ -31,6 +45,13 @@ async def version():
     }
 
 
+async def prometheus_metrics():
+    """
+    Metrics of this worker in Prometheus text format.
+    """
+    return http.Response(metrics.render().encode(), content_type='text/plain; version=0.0.4')
+
+
 async def auth_token(headers: http.Headers, body: http.Body, settings: Settings):
     """
     Simple proxy to Gluu.
@@ -58,9 +79,26 @@ async def auth_token(headers: http.Headers, body: http.Body, settings: Settings)
 
 @annotate(
     permissions=[CheckScopes('uapi_{resource_type}_get')],
+    route_class='reads',
 )
-async def resource_get(resource_type, storage: Storage):
+async def resource_get(resource_type, count, storage: Storage):
+    """
+    List ids of all resources.
+
+    With `count=exact` or `count=estimate` only the number of resources is returned, estimate is taken from table
+    statistics and is instant even on huge tables.
+    """
     try:
+        if count is not None:
+            if count not in ('exact', 'estimate'):
+                raise BadRequest({
+                    'error_code': 'InvalidCountMode',
+                    'count': count,
+                    'message': 'Count should be "exact" or "estimate"',
+                })
+            return {
+                'count': await storage.count(resource_type, estimate=(count == 'estimate')),
+            }
         return {
             'resources': [
                 {'id': resource_id} for resource_id in await storage.list(resource_type)
@@ -74,8 +112,74 @@ async def resource_get(resource_type, storage: Storage):
         })
 
 
+# Changes have no route class: long polling waits without holding a database connection, so it's neither limited by
+# admission, nor bound by a deadline.
+@annotate(
+    permissions=[CheckScopes('uapi_{resource_type}_changes_get')],
+)
+async def resource_changes(resource_type, since: int, wait: float, limit: int, storage: Storage):
+    """
+    Changes of resources, that happened after given sequence number.
+
+    Pass `last` from the response as `since` to get next changes. If there are no changes yet, wait up to `wait`
+    seconds for a new change.
+
+    Example:
+
+        http get /orgs/_changes since==42 wait==30
+
+    """
+    since = since or 0
+    try:
+        changes = await storage.changes(
+            resource_type, since,
+            limit=min(limit or CHANGES_LIMIT, CHANGES_LIMIT),
+            wait=min(wait or 0, CHANGES_MAX_WAIT),
+        )
+    except ResourceTypeNotFound:
+        raise NotFound({
+            'error_code': 'ResourceTypeDoesNotExist',
+            'resource_type': resource_type,
+            'message': 'Resource type does not exist',
+        })
+    return {
+        'changes': changes,
+        'last': changes[-1]['seq'] if changes else since,
+    }
+
+
+# Exports have a route class of their own, without a deadline: an export streams for as long as it takes to send all
+# resources, bounding it by a deadline would make exports of big resource types impossible.
+@annotate(
+    permissions=[CheckScopes('uapi_{resource_type}_export_get')],
+    route_class='exports',
+)
+async def resource_export(resource_type, files: bool, storage: Storage):
+    """
+    Export all resources with their subpaths as NDJSON, one resource per line, as of a single snapshot.
+
+    With `files=true` contents of files are included, base64 encoded. Response is compressed as it's streamed, if the
+    client accepts it.
+
+    Example:
+
+        http get /orgs/_export files==true Accept-Encoding:gzip
+
+    """
+    try:
+        items = storage.export(resource_type, files=bool(files))
+    except ResourceTypeNotFound:
+        raise NotFound({
+            'error_code': 'ResourceTypeDoesNotExist',
+            'resource_type': resource_type,
+            'message': 'Resource type does not exist',
+        })
+    return Response(export_chunks(items), status=200, content_type='application/x-ndjson')
+
+
 @annotate(
     permissions=[CheckScopes('uapi_{resource_type}_post')],
+    route_class='writes',
 )
 async def resource_post(resource_type, data: http.RequestData, storage: Storage):
     try:
@@ -86,14 +190,30 @@ async def resource_post(resource_type, data: http.RequestData, storage: Storage)
             'resource_type': resource_type,
             'message': 'Resource type does not exist',
         })
+    except ValidationError as e:
+        raise BadRequest({
+            'error_code': e.error_code,
+            'field': e.field,
+            'message': e.message,
+        })
 
 
 @annotate(
     permissions=[CheckScopes('uapi_{resource_type}_id_get')],
+    route_class='reads',
 )
-async def resource_id_get(resource_type, resource_id, storage: Storage):
+async def resource_id_get(resource_type, resource_id, fields, storage: Storage):
+    """
+    Get a resource, optionally only with given comma separated list of fields.
+
+    Example:
+
+        http get /orgs/ID fields==names,country
+
+    """
+    fields = [x for x in fields.split(',') if x] if fields else None
     try:
-        return await storage.get(resource_type, resource_id)
+        return await storage.get(resource_type, resource_id, fields)
     except ResourceTypeNotFound:
         raise NotFound({
             'error_code': 'ResourceTypeDoesNotExist',
@@ -108,8 +228,78 @@ async def resource_id_get(resource_type, resource_id, storage: Storage):
         })
 
 
+async def _get_many(resource_type, ids, fields, storage):
+    ids = list(collections.OrderedDict.fromkeys(ids))
+    if len(ids) > BATCH_LIMIT:
+        raise BadRequest({
+            'error_code': 'TooManyIds',
+            'limit': BATCH_LIMIT,
+            'message': 'Too many ids, at most {limit} resources can be requested at once',
+        })
+    try:
+        resources, missing = await storage.get_many(resource_type, ids, fields)
+    except ResourceTypeNotFound:
+        raise NotFound({
+            'error_code': 'ResourceTypeDoesNotExist',
+            'resource_type': resource_type,
+            'message': 'Resource type does not exist',
+        })
+    return {
+        'resources': resources,
+        'missing': missing,
+    }
+
+
+@annotate(
+    permissions=[CheckScopes('uapi_{resource_type}_id_get')],
+    route_class='reads',
+)
+async def resource_batch_get(resource_type, ids, fields, storage: Storage):
+    """
+    Get many resources by id in one request.
+
+    Example:
+
+        http get /orgs/_batch ids==id1,id2,id3 fields==names,country
+
+    """
+    ids = [x for x in (ids or '').split(',') if x]
+    fields = [x for x in fields.split(',') if x] if fields else None
+    return await _get_many(resource_type, ids, fields, storage)
+
+
+@annotate(
+    permissions=[CheckScopes('uapi_{resource_type}_id_get')],
+    route_class='reads',
+)
+async def resource_batch_post(resource_type, data: http.RequestData, storage: Storage):
+    """
+    Get many resources by id in one request, ids and optional fields are given in request body.
+
+    Example:
+
+        http post /orgs/_batch ids:='["id1", "id2"]' fields:='["names"]'
+
+    """
+    if (
+        not isinstance(data, dict) or
+        not _is_list_of_strings(data.get('ids')) or
+        not (data.get('fields') is None or _is_list_of_strings(data['fields']))
+    ):
+        raise BadRequest({
+            'error_code': 'InvalidBatchRequest',
+            'message': 'Request body should be an object with a list of ids and an optional list of fields',
+        })
+    return await _get_many(resource_type, data['ids'], data.get('fields'), storage)
+
+
+def _is_list_of_strings(value):
+    return isinstance(value, list) and all(isinstance(item, str) for item in value)
+
+
 @annotate(
     permissions=[CheckScopes('uapi_{resource_type}_id_put')],
+    route_class='writes',
 )
 async def resource_id_put(resource_type, resource_id, data: http.RequestData, storage: Storage):
     try:
@@ -126,6 +316,12 @@ async def resource_id_put(resource_type, resource_id, data: http.RequestData, st
             'item_id': resource_id,
             'message': "Item does not exist",
         })
+    except ValidationError as e:
+        raise BadRequest({
+            'error_code': e.error_code,
+            'field': e.field,
+            'message': e.message,
+        })
     except WrongRevision as e:
         raise Conflict({
             'error_code': 'WrongRevision',
@@ -141,6 +337,7 @@ async def resource_id_put(resource_type, resource_id, data: http.RequestData, st
 
 @annotate(
     permissions=[CheckScopes('uapi_{resource_type}_id_delete')],
+    route_class='writes',
 )
 async def resource_id_delete(resource_type, resource_id, storage: Storage):
     try:
@@ -172,6 +369,7 @@ async def resource_id_delete(resource_type, resource_id, storage: Storage):
 
 @annotate(
     permissions=[CheckScopes('uapi_{resource_type}_{subpath}_id_get')],
+    route_class='reads',
 )
 async def resource_id_subpath_get(resource_type, resource_id, subpath, storage: Storage):
     try:
@@ -199,6 +397,7 @@ async def resource_id_subpath_get(resource_type, resource_id, subpath, storage:
 
 @annotate(
     permissions=[CheckScopes('uapi_{resource_type}_{subpath}_id_put')],
+    route_class='writes',
 )
 async def resource_id_subpath_put(resource_type, resource_id, subpath, body: http.Body, headers: http.Headers,
                                   storage: Storage):
@@ -222,6 +421,12 @@ async def resource_id_subpath_put(resource_type, resource_id, subpath, body: htt
             'item_id': resource_id,
             'message': "Item does not exist",
         })
+    except ValidationError as e:
+        raise BadRequest({
+            'error_code': e.error_code,
+            'field': e.field,
+            'message': e.message,
+        })
     except WrongRevision as e:
         raise Conflict({
             'error_code': 'WrongRevision',
@@ -237,12 +442,17 @@ async def resource_id_subpath_put(resource_type, resource_id, subpath, body: htt
 
 @annotate(
     permissions=[CheckScopes('uapi_{resource_type}_search_id_get')],
+    route_class='searches',
 )
 async def resource_search(resource_type, query: PathWildcard, storage: Storage):
     try:
+        result = await storage.search(resource_type, query)
+        if isinstance(result, dict):
+            # Result of count or exists operators.
+            return result
         return {
             'resources': [
-                resource for resource in await storage.search(resource_type, query)
+                resource for resource in result
             ],
         }
     except ResourceTypeNotFound:
@@ -251,3 +461,9 @@ async def resource_search(resource_type, query: PathWildcard, storage: Storage):
             'resource_type': resource_type,
             'message': 'Resource type does not exist',
         })
+    except IndexNotReady:
+        raise ServiceUnavailable({
+            'error_code': 'SearchIndexNotReady',
+            'resource_type': resource_type,
+            'message': 'Search index is being built, try again later',
+        }, headers={'Retry-After': '60'})
@@ -1,13 +1,66 @@
+import asyncio
+import itertools
+import json
+import pathlib
+import random
+import time
+
+import pytest
+import sqlalchemy as sa
+
+from qvarn import deadlines
+from qvarn.backends import IndexNotReady
+from qvarn.backends import QueryTimeout
+from qvarn.backends import ResourceNotFound
+from qvarn.backends import ResourceTypeNotFound
+from qvarn.backends import coalesced_reads
+from qvarn.backends.postgresql import CHANGES_PER_TRANSACTION
+from qvarn.backends.postgresql import Catalog
+from qvarn.backends.postgresql import CompiledQuery
+from qvarn.backends.postgresql import Flattener
+from qvarn.backends.postgresql import Migration
+from qvarn.backends.postgresql import PostgreSQLStorage
+from qvarn.backends.postgresql import SearchCache
+from qvarn.backends.postgresql import aux_rows_written as aux_rows_written_metric
 from qvarn.backends.postgresql import chop_long_name
 from qvarn.backends.postgresql import get_new_id
+from qvarn.backends.postgresql import get_search_key
 from qvarn.backends.postgresql import flatten_for_lists
 from qvarn.backends.postgresql import flatten_for_gin
+from qvarn.backends.postgresql import load_resource_types
+from qvarn.backends.postgresql import search_cache_requests
+from qvarn.export import encode_item
 
 
 def test_get_new_id():
     random_field = '448134794a2f6da110a178def79d1d8f'
     assert get_new_id('test', random_field) == 'ee26-448134794a2f6da110a178def79d1d8f-e954e909'
 
+    # New ids are ordered by time of creation.
+    ids = [get_new_id('test') for i in range(3)]
+    time.sleep(0.001)
+    ids.append(get_new_id('test', shard=1))
+    assert [row_id[:19] for row_id in ids] == sorted(row_id[:19] for row_id in ids)
+    assert ids[-1] == max(ids)
+
+
+def test_compiled_query(storage):
+    table = storage.tables['test']
+    query = CompiledQuery(
+        sa.select([table.c.id]).
+        where(table.c.revision == sa.bindparam('revision')).
+        where(table.c.data['string'].astext.like('a%')).
+        where(table.c.id != sa.bindparam('revision')),
+        storage.pool.dialect,
+    )
+    assert query.prepare == (
+        'PREPARE %s AS SELECT test.id \n'
+        'FROM test \n'
+        'WHERE test.revision = $1 AND test.data ->> $2 LIKE $3 AND test.id != $1'
+    ) % query.name
+    assert query.execute == 'EXECUTE %s (%%(revision)s, %%(data_1)s, %%(param_1)s)' % query.name
+    assert query.params({'revision': 'x'}) == {'revision': 'x', 'data_1': 'string', 'param_1': 'a%'}
+
 
 def test_chop_long_name():
     name = 'foo_bar_baz_' * 10
@@ -61,3 +114,638 @@ def test_flatten_for_gin():
         {'d': 5},
         {'f': 6},
     ]
+
+
+def test_load_resource_types(tmpdir):
+    resources = tmpdir.mkdir('resources')
+    resources.join('test.yaml').write('type: test\npath: /original\n')
+    cache = str(tmpdir.join('cache.json'))
+
+    assert load_resource_types(str(resources), cache) == [{'type': 'test', 'path': '/original'}]
+    assert json.loads(tmpdir.join('cache.json').read())[str(resources.join('test.yaml'))]['schema'] == {
+        'type': 'test',
+        'path': '/original',
+    }
+
+    # Cached schema is used as long as file is not changed.
+    tmpdir.join('cache.json').write(tmpdir.join('cache.json').read().replace('/original', '/cached'))
+    assert load_resource_types(str(resources), cache) == [{'type': 'test', 'path': '/cached'}]
+
+    # Changed file is parsed again.
+    resources.join('test.yaml').write('type: test\npath: /changed\n')
+    assert load_resource_types(str(resources), cache) == [{'type': 'test', 'path': '/changed'}]
+
+    # Schemas, that can't be cached, don't leave temporary files behind.
+    resources.join('test.yaml').write('type: test\npath: /dated\ncreated: 2018-01-01\n')
+    assert load_resource_types(str(resources), cache)[0]['path'] == '/dated'
+    assert sorted(path.basename for path in tmpdir.listdir()) == ['cache.json', 'resources']
+
+
+def test_plan_migrations():
+    storage = PostgreSQLStorage(None, None)
+    storage.add_resource_type({
+        'type': 'test',
+        'path': '/test',
+        'versions': [
+            {
+                'version': 'v0',
+                'prototype': {'id': '', 'revision': ''},
+                'subpaths': {'sub': {'prototype': {'a': ''}}},
+            },
+        ],
+    })
+    catalog = Catalog(
+        tables={
+            'test': {'id', 'revision', 'search', 'data'},
+            'test__aux': {'id', 'data'},
+        },
+        indexes={
+            'gin_idx_test': False,
+        },
+    )
+    assert storage.plan_migrations(catalog) == [
+        Migration('add_column', 'test', 'data_sub'),
+        Migration('drop_index', 'test', 'gin_idx_test'),
+        Migration('create_index', 'test', 'gin_idx_test'),
+    ]
+
+
+def test_single_flight(storage):
+    loop = asyncio.get_event_loop()
+    storage.wipe_all_data('test')
+    resource = loop.run_until_complete(storage.create('test', {'string': 'x'}))
+
+    before = coalesced_reads.get(method='get')
+    results = loop.run_until_complete(asyncio.gather(*(
+        storage.get('test', resource['id'], ['string']) for i in range(10)
+    )))
+    assert coalesced_reads.get(method='get') == before + 9
+    assert results == [{'id': resource['id'], 'revision': resource['revision'], 'string': 'x'}] * 10
+    assert len({id(result) for result in results}) == 10
+
+    # Different arguments are different queries.
+    before = coalesced_reads.get(method='search')
+    results = loop.run_until_complete(asyncio.gather(
+        storage.search('test', 'exact/string/x'),
+        storage.search('test', 'exact/string/x'),
+        storage.search('test', 'exact/string/y'),
+    ))
+    assert coalesced_reads.get(method='search') == before + 1
+    assert results == [[{'id': resource['id']}], [{'id': resource['id']}], []]
+
+    results = loop.run_until_complete(asyncio.gather(*(
+        storage.get('test', 'nope') for i in range(3)
+    ), return_exceptions=True))
+    assert all(isinstance(result, ResourceNotFound) for result in results)
+
+    # Nothing is cached after reads are done.
+    loop.run_until_complete(storage.delete('test', resource['id']))
+    with pytest.raises(ResourceNotFound):
+        loop.run_until_complete(storage.get('test', resource['id'], ['string']))
+
+
+def test_search_cache(storage):
+    loop = asyncio.get_event_loop()
+    storage.wipe_all_data('test')
+    # Another worker, that writes to the same database.
+    other = PostgreSQLStorage(storage.engine, storage.pool, prepare=False)
+    for schema in load_resource_types(pathlib.Path(__file__).parents[1] / 'resources'):
+        other.add_resource_type(schema)
+
+    assert get_search_key([('exact', ['a', 'x']), ('sort', ['a']), ('ge', ['b', '1'])]) == get_search_key(
+        [('ge', ['b', '1']), ('exact', ['a', 'x']), ('sort', ['a'])]
+    )
+
+    storage.search_caches['test'] = SearchCache(2)
+    try:
+        def search(query):
+            return loop.run_until_complete(storage.search('test', query))
+
+        def requests(result):
+            return search_cache_requests.get(resource_type='test', result=result)
+
+        hits, misses = requests('hit'), requests('miss')
+        assert search('exact/string/x/count') == {'count': 0}
+        assert search('exact/string/x/count') == {'count': 0}
+        assert (requests('hit'), requests('miss')) == (hits + 1, misses + 1)
+
+        # Own writes invalidate the cache right away.
+        resource = loop.run_until_complete(storage.create('test', {'string': 'x'}))
+        assert search('exact/string/x/count') == {'count': 1}
+        assert requests('miss') == misses + 2
+
+        # Writes of other workers invalidate the cache, when their notification arrives.
+        loop.run_until_complete(other.create('test', {'string': 'x'}))
+        loop.run_until_complete(asyncio.sleep(0.2))
+        assert search('exact/string/x/count') == {'count': 2}
+        assert requests('miss') == misses + 3
+
+        # Cached results can't be changed by callers.
+        result = search('exact/string/x/show/string')
+        result[0]['string'] = 'y'
+        assert search('exact/string/x/show/string')[0]['string'] == 'x'
+
+        # Least recently used entries are dropped.
+        search('exact/string/a')
+        search('exact/string/b')
+        misses = requests('miss')
+        search('exact/string/x/show/string')
+        assert requests('miss') == misses + 1
+
+        loop.run_until_complete(storage.delete('test', resource['id']))
+        assert search('exact/string/x/count') == {'count': 1}
+    finally:
+        del storage.search_caches['test']
+
+
+def test_deadline(storage):
+    loop = asyncio.get_event_loop()
+
+    async def sleep():
+        async with storage._acquire() as conn:
+            await conn.execute('SELECT pg_sleep(5)')
+
+    async def running():
+        async with storage._acquire() as conn:
+            return await conn.scalar(
+                "SELECT count(*) FROM pg_stat_activity WHERE query = 'SELECT pg_sleep(5)' AND state = 'active'"
+            )
+
+    async def run():
+        # Queries are cancelled by statement_timeout at the deadline.
+        deadlines.set_deadline(0.2)
+        with pytest.raises(QueryTimeout):
+            await sleep()
+        deadlines.set_deadline(None)
+        async with storage._acquire() as conn:
+            assert await conn.scalar('SHOW statement_timeout') == '0'
+
+        # Queries of cancelled tasks are cancelled in the database.
+        task = asyncio.ensure_future(sleep())
+        await asyncio.sleep(0.2)
+        assert await running() == 1
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        await asyncio.sleep(0.2)
+        assert await running() == 0
+
+    loop.run_until_complete(run())
+
+
+def test_cancel_coalesced_read(backend_storage):
+    storage = backend_storage
+    loop = asyncio.get_event_loop()
+    storage.wipe_all_data('test')
+    resource = loop.run_until_complete(storage.create('test', {'string': 'x'}))
+    conn = storage.engine.connect()
+
+    def waiting():
+        # Activity is read outside of the transaction holding the lock, which would only see a snapshot of it.
+        return [row.pid for row in storage.engine.execute(
+            "SELECT pid FROM pg_stat_activity WHERE wait_event_type = 'Lock' AND datname = current_database()"
+        )]
+
+    async def get():
+        deadlines.set_deadline(10)
+        return await storage.get('test', resource['id'])
+
+    async def run():
+        # Reads wait for the lock, until they are cancelled.
+        trans = conn.begin()
+        conn.execute('LOCK TABLE %s IN ACCESS EXCLUSIVE MODE' % storage.tables['test'].name)
+        tasks = [asyncio.ensure_future(get()) for i in range(2)]
+        await asyncio.sleep(0.2)
+        pids = waiting()
+        assert len(pids) == 1
+
+        # Query goes on while somebody waits for it.
+        tasks[0].cancel()
+        await asyncio.sleep(0.2)
+        assert waiting() == pids
+
+        # Query of the last cancelled caller is cancelled and its connection, with statement_timeout set, is not
+        # returned to the pool.
+        tasks[1].cancel()
+        for task in tasks:
+            with pytest.raises(asyncio.CancelledError):
+                await task
+        await asyncio.sleep(0.2)
+        assert waiting() == []
+        assert storage.engine.scalar('SELECT count(*) FROM pg_stat_activity WHERE pid = %d' % pids[0]) == 0
+        trans.rollback()
+
+        assert await storage.get('test', resource['id']) == resource
+        async with storage._acquire() as aconn:
+            assert await aconn.scalar('SHOW statement_timeout') == '0'
+
+        # Searches are cancelled too.
+        trans = conn.begin()
+        conn.execute('LOCK TABLE %s IN ACCESS EXCLUSIVE MODE' % storage.tables['test'].name)
+        task = asyncio.ensure_future(storage.search('test', 'exact/string/x'))
+        await asyncio.sleep(0.2)
+        assert len(waiting()) == 1
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        await asyncio.sleep(0.2)
+        assert waiting() == []
+        trans.rollback()
+
+    try:
+        loop.run_until_complete(run())
+    finally:
+        conn.close()
+
+
+def test_coalesced_read_deadlines(backend_storage):
+    storage = backend_storage
+    loop = asyncio.get_event_loop()
+    storage.wipe_all_data('test')
+    resource = loop.run_until_complete(storage.create('test', {'string': 'x'}))
+    conn = storage.engine.connect()
+
+    async def get(timeout):
+        deadlines.set_deadline(timeout)
+        return await storage.get('test', resource['id'])
+
+    async def run():
+        # Query waits for the lock longer, than the first caller is willing to wait.
+        trans = conn.begin()
+        conn.execute('LOCK TABLE %s IN ACCESS EXCLUSIVE MODE' % storage.tables['test'].name)
+        tasks = [asyncio.ensure_future(get(timeout)) for timeout in (0.2, None, 10)]
+        await asyncio.sleep(0.5)
+        trans.rollback()
+        return await asyncio.gather(*tasks, return_exceptions=True)
+
+    try:
+        results = loop.run_until_complete(run())
+    finally:
+        conn.close()
+    assert isinstance(results[0], QueryTimeout)
+    assert results[1:] == [resource, resource]
+
+
+def test_export(storage):
+    loop = asyncio.get_event_loop()
+    storage.wipe_all_data('test')
+    created = [loop.run_until_complete(storage.create('test', {'string': str(i)})) for i in range(5)]
+
+    async def export(stop=None):
+        items = []
+        async for item in storage.export('test', batch_size=2):
+            items.append(item)
+            if len(items) == 1:
+                # Export reads a snapshot, resources created after it started are not exported.
+                await storage.create('test', {'string': 'new'})
+            if len(items) == stop:
+                break
+        return items
+
+    items = loop.run_until_complete(export())
+    assert sorted(item['resource']['id'] for item in items) == sorted(resource['id'] for resource in created)
+    assert {item['resource']['id']: item['resource'] for item in items}[created[0]['id']] == created[0]
+
+    # Connection of an abandoned export is not reused in the middle of its transaction.
+    loop.run_until_complete(export(stop=3))
+
+    async def in_transaction():
+        async with storage._acquire() as conn:
+            return await conn.scalar("SELECT now() != statement_timestamp()")
+
+    assert not any(loop.run_until_complete(asyncio.gather(*(in_transaction() for i in range(5)))))
+
+    with pytest.raises(ResourceTypeNotFound):
+        storage.export('nope')
+
+
+def test_import(storage):
+    loop = asyncio.get_event_loop()
+    storage.wipe_all_data('persons')
+    person = loop.run_until_complete(storage.create('persons', {'names': [{'full_name': 'James\tBond\\007'}]}))
+    private = loop.run_until_complete(storage.put_subpath('persons', person['id'], 'private', {
+        'revision': person['revision'],
+        'date_of_birth': '1920-11-11',
+        'gov_ids': [{'country': 'GB', 'gov_id': 'SN 00 70 07'}],
+    }))
+    photo = loop.run_until_complete(storage.put_file(
+        'persons', person['id'], 'photo', b'\x00image', private['revision'], 'image/png',
+    ))
+
+    async def export():
+        return [encode_item(item) async for item in storage.export('persons', files=True)]
+
+    lines = loop.run_until_complete(export())
+    since = loop.run_until_complete(storage.changes('persons'))[-1]['seq']
+
+    # Importing an exported resource replaces it with the same data.
+    assert list(storage.import_resources('persons', lines, workers=0)) == [1]
+    assert loop.run_until_complete(export()) == lines
+    assert [change['change'] for change in loop.run_until_complete(storage.changes('persons', since))] == ['updated']
+    assert loop.run_until_complete(storage.get_file('persons', person['id'], 'photo'))['blob'] == b'\x00image'
+    assert loop.run_until_complete(storage.search('persons', 'exact/country/GB/exact/full_name/james\tbond\\007')) == [
+        {'id': person['id']},
+    ]
+
+    # Imported with new ids, in worker processes and without indexes during the import.
+    counts = storage.import_resources('persons', lines * 3, generate_ids=True, drop_indexes=True, workers=2,
+                                      batch_size=2)
+    assert list(counts) == [2, 1]
+    with storage.engine.connect() as conn:
+        assert storage._get_catalog(conn).indexes['gin_idx_person'] is True
+    result = loop.run_until_complete(storage.search('persons', 'exact/gov_id/SN 00 70 07/show_all'))
+    assert len({resource['id'] for resource in result}) == 4
+    assert all(resource['names'] == person['names'] for resource in result)
+    assert loop.run_until_complete(storage.get_subpath('persons', result[0]['id'], 'private'))['date_of_birth'] == (
+        '1920-11-11'
+    )
+    assert photo['revision'] in {resource['revision'] for resource in result}
+
+    with pytest.raises(ValueError):
+        list(storage.import_resources('persons', ['{"resource": {}, "subpaths": {"nope": {}}}'], workers=0))
+
+
+def test_reindex(storage):
+    loop = asyncio.get_event_loop()
+    storage.wipe_all_data('test')
+    created = sorted((
+        loop.run_until_complete(storage.create('test', {'string': 'x', 'list': [{'foo': 'a%d' % i}]}))
+        for i in range(5)
+    ), key=lambda resource: resource['id'])
+
+    def corrupt():
+        with storage.engine.begin() as conn:
+            conn.execute("UPDATE test SET search = '[]'")
+            conn.execute("DELETE FROM test__aux")
+
+    async def reindex(**kwargs):
+        return [count async for count in storage.reindex('test', workers=0, concurrency=2, batch_size=2, **kwargs)]
+
+    def search(query):
+        storage.search_caches.clear()
+        return sorted(resource['id'] for resource in loop.run_until_complete(storage.search('test', query)))
+
+    corrupt()
+    assert search('exact/string/x') == []
+    assert loop.run_until_complete(reindex()) == [4, 1]
+    assert search('exact/string/x') == [resource['id'] for resource in created]
+    assert search('exact/foo/a3') == [resource['id'] for resource in created if resource['list'] == [{'foo': 'a3'}]]
+
+    # Interrupted reindex goes on after the last stored position.
+    corrupt()
+    loop.run_until_complete(storage._set_reindex_position('test', created[2]['id']))
+    assert loop.run_until_complete(reindex()) == [2]
+    assert search('exact/string/x') == [resource['id'] for resource in created[3:]]
+    assert loop.run_until_complete(storage._get_reindex_position('test')) is None
+    assert loop.run_until_complete(reindex(restart=True)) == [4, 1]
+    assert search('exact/string/x') == [resource['id'] for resource in created]
+
+    # Resources written after they were read are not overwritten with stale rows.
+    rows = [{'id': created[0]['id'], 'revision': 'stale', 'search': [], 'aux': []}]
+    assert loop.run_until_complete(storage._write_reindex('test', rows)) == 0
+    assert search('exact/string/x') == [resource['id'] for resource in created]
+
+
+def test_reindex_concurrent_put(storage):
+    loop = asyncio.get_event_loop()
+    storage.wipe_all_data('test')
+    resource = loop.run_until_complete(storage.create('test', {'string': 'a'}))
+    search, aux = storage.flatteners['test'].flatten({'string': 'a'}, {})
+    rows = [{'id': resource['id'], 'revision': resource['revision'], 'search': search, 'aux': aux}]
+    conn = storage.engine.connect()
+
+    async def run():
+        # Row is locked, so that a reindex batch writes it after a put started and before it is done.
+        trans = conn.begin()
+        conn.execute("SELECT id FROM test WHERE id = '%s' FOR UPDATE" % resource['id'])
+        reindex = asyncio.ensure_future(storage._write_reindex('test', rows))
+        await asyncio.sleep(0.2)
+        put = asyncio.ensure_future(storage.put('test', resource['id'], dict(resource, string='b')))
+        await asyncio.sleep(0.2)
+        trans.rollback()
+        return await reindex, await put
+
+    try:
+        updated, _ = loop.run_until_complete(run())
+    finally:
+        conn.close()
+    assert updated == 1
+    # Aux rows written by reindex are replaced by the put, not left behind.
+    aux_table = storage.aux_tables['test']
+    assert [row.data for row in storage.engine.execute(
+        sa.select([aux_table.c.data]).where(aux_table.c.id == resource['id'])
+    )] == storage.flatteners['test'].flatten({'string': 'b'}, {})[1]
+
+
+def test_concurrent_puts(storage):
+    loop = asyncio.get_event_loop()
+    storage.wipe_all_data('test')
+    resource = loop.run_until_complete(storage.create('test', {'string': 'a'}))
+    conn = storage.engine.connect()
+
+    async def run():
+        # Both puts wait for the lock, the one, that is run second, finds that revision has changed.
+        trans = conn.begin()
+        conn.execute("SELECT id FROM test WHERE id = '%s' FOR UPDATE" % resource['id'])
+        puts = [asyncio.ensure_future(storage.put('test', resource['id'], dict(resource, string=s))) for s in 'bc']
+        await asyncio.sleep(0.2)
+        trans.rollback()
+        return await asyncio.gather(*puts, return_exceptions=True)
+
+    try:
+        results = loop.run_until_complete(run())
+    finally:
+        conn.close()
+    assert sorted(type(result).__name__ for result in results) == ['WrongRevision', 'dict']
+
+
+def test_changes_of_running_transactions(storage):
+    loop = asyncio.get_event_loop()
+    storage.wipe_all_data('test')
+    changes_table = storage.changes_tables['test']
+    conn = storage.engine.connect()
+    try:
+        # A write, that is logged first, but committed last.
+        trans = conn.begin()
+        conn.execute(changes_table.insert().values(
+            seq=sa.func.txid_current() * CHANGES_PER_TRANSACTION, id='running', revision=None, change='deleted',
+        ))
+        # Writes don't wait for each other, but their changes are not returned until the running one is committed.
+        resource = loop.run_until_complete(asyncio.wait_for(storage.create('test', {'string': 'a'}), 1))
+        assert loop.run_until_complete(storage.changes('test')) == []
+        trans.commit()
+    finally:
+        conn.close()
+    changes = loop.run_until_complete(storage.changes('test'))
+    assert [change['id'] for change in changes] == ['running', resource['id']]
+
+
+def test_migrate(storage):
+    with storage.engine.begin() as conn:
+        conn.execute('DROP INDEX gin_idx_test')
+        conn.execute(storage.schema_table.delete())
+
+    assert storage.init() == ['gin_idx_test']
+    with pytest.raises(IndexNotReady):
+        asyncio.get_event_loop().run_until_complete(storage.search('test', 'exact/string/foo'))
+
+    storage.migrate()
+    assert storage.pending_indexes == set()
+    with storage.engine.connect() as conn:
+        assert storage._get_catalog(conn).indexes['gin_idx_test'] is True
+    asyncio.get_event_loop().run_until_complete(storage.search('test', 'exact/string/foo'))
+
+
+def test_partitions(storage):
+    loop = asyncio.get_event_loop()
+    partitioned = PostgreSQLStorage(storage.engine, storage.pool)
+    partitioned.add_resource_type({
+        'type': 'partitioned',
+        'path': '/partitioned',
+        'partitions': 4,
+        'versions': [
+            {
+                'version': 'v0',
+                'prototype': {'id': '', 'revision': '', 'name': '', 'list': [{'foo': ''}]},
+                'subpaths': {'file': {'prototype': {'blob': 'blob', 'content_type': ''}}},
+                'files': ['file'],
+            },
+        ],
+    })
+    with storage.engine.begin() as conn:
+        for table in reversed(partitioned.metadata.sorted_tables):
+            if table is not partitioned.schema_table:
+                conn.execute('DROP TABLE IF EXISTS %s CASCADE' % table.name)
+    partitioned.init()
+
+    with storage.engine.connect() as conn:
+        catalog = partitioned._get_catalog(conn)
+    assert {'partitioned__p%d' % i for i in range(4)} <= set(catalog.tables)
+    assert {'partitioned__aux__p%d' % i for i in range(4)} <= set(catalog.tables)
+    assert {'partitioned__files__p%d' % i for i in range(4)} <= set(catalog.tables)
+
+    rows = [
+        loop.run_until_complete(partitioned.create('partitioned', {'name': str(i), 'list': [{'foo': 'x'}]}))
+        for i in range(20)
+    ]
+    row = loop.run_until_complete(partitioned.put('partitioned', rows[0]['id'], dict(rows[0], list=[{'foo': 'y'}])))
+    row = loop.run_until_complete(partitioned.put_file('partitioned', row['id'], 'file', b'x', row['revision'], 'a/b'))
+    assert loop.run_until_complete(partitioned.get_file('partitioned', row['id'], 'file'))['blob'] == b'x'
+    assert loop.run_until_complete(partitioned.search('partitioned', 'exact/foo/x/count')) == {'count': 19}
+    assert loop.run_until_complete(partitioned.search('partitioned', 'contains/foo/y/show/name')) == [
+        {'id': row['id'], 'name': '0'},
+    ]
+    assert loop.run_until_complete(partitioned.count('partitioned')) == 20
+
+    # Lookups by id only scan a single partition.
+    with storage.engine.connect() as conn:
+        plan = conn.execute(
+            sa.text('EXPLAIN SELECT * FROM partitioned WHERE id = :id'), id=row['id']
+        ).fetchall()
+    assert len([line for line in plan if 'partitioned__p' in line[0]]) == 1
+
+    # Indexes of partitioned tables are built concurrently partition by partition.
+    with storage.engine.begin() as conn:
+        conn.execute('DROP INDEX gin_idx_partitioned')
+        conn.execute('CREATE INDEX gin_idx_partitioned__p1 ON partitioned__p1 USING gin (search)')
+        conn.execute(partitioned.schema_table.delete())
+    assert partitioned.init() == ['gin_idx_partitioned']
+    partitioned.migrate()
+    with storage.engine.connect() as conn:
+        indexes = partitioned._get_catalog(conn).indexes
+    assert indexes['gin_idx_partitioned'] is True
+    assert all(indexes['gin_idx_partitioned__p%d' % i] for i in range(4))
+    assert loop.run_until_complete(partitioned.search('partitioned', 'exact/foo/x/count')) == {'count': 19}
+
+    with storage.engine.begin() as conn:
+        for table in reversed(partitioned.metadata.sorted_tables):
+            if table is not partitioned.schema_table:
+                conn.execute('DROP TABLE %s CASCADE' % table.name)
+        conn.execute(partitioned.schema_table.delete())
+
+
+def generate_resource(prototype, rnd, mismatch=0.02):
+    """Generate random data in shape of given prototype, nested values sometimes deviate from prototype shape."""
+
+    def generate(prototype):
+        if rnd.random() < mismatch:
+            return rnd.choice([None, 'X', 42, {'unknown': 'X'}, ['X'], []])
+        return generate_resource(prototype, rnd, mismatch)
+
+    if isinstance(prototype, dict):
+        data = {key: generate(value) for key, value in prototype.items() if rnd.random() < 0.8}
+        if rnd.random() < mismatch:
+            data['unknown'] = 'X'
+        return data
+    elif isinstance(prototype, list):
+        return [generate(prototype[0]) for i in range(rnd.randint(0, 3))]
+    else:
+        return rnd.choice(['Foo', 'bar', 'ŠĄ', '', 0, 42, 4.2, True, False, None])
+
+
+def test_flattener():
+    rnd = random.Random(42)
+    sort_key = lambda x: repr(list(x.items())[0])  # noqa
+    for schema in load_resource_types(pathlib.Path(__file__).parents[1] / 'resources'):
+        version = schema['versions'][-1]
+        files = version.get('files', [])
+        subpaths = {
+            subpath: version['subpaths'][subpath]['prototype']
+            for subpath in version.get('subpaths', {}) if subpath not in files
+        }
+        flattener = Flattener(version['prototype'], subpaths)
+        for i in range(200):
+            data = generate_resource(version['prototype'], rnd)
+            subpaths_data = {
+                subpath: generate_resource(prototype, rnd)
+                for subpath, prototype in subpaths.items() if rnd.random() < 0.5
+            }
+            gin, rows = flattener.flatten(data, subpaths_data)
+
+            if subpaths_data:
+                data = [data] + [subpaths_data[x] for x in sorted(subpaths_data) if subpaths_data[x]]
+            assert rows == flatten_for_lists(data)
+            if isinstance(data, list):
+                assert sorted(gin, key=sort_key) == sorted(itertools.chain.from_iterable(
+                    flatten_for_gin(x) for x in data
+                ), key=sort_key)
+            else:
+                assert sorted(gin, key=sort_key) == sorted(flatten_for_gin(data), key=sort_key)
+
+
+def test_update_aux_tables(storage):
+    storage.wipe_all_data('test')
+    loop = asyncio.get_event_loop()
+    aux_table = storage.aux_tables['test']
+
+    def aux_rows_written():
+        return aux_rows_written_metric.get(resource_type='test')[1]
+
+    def aux_rows(row_id):
+        with storage.engine.connect() as conn:
+            query = sa.select([aux_table.c.data]).where(aux_table.c.id == row_id)
+            return sorted((row.data for row in conn.execute(query)), key=repr)
+
+    row = loop.run_until_complete(storage.create('test', {'string': 'a', 'list': [{'foo': 'x'}, {'foo': 'y'}]}))
+    assert aux_rows(row['id']) == [{'foo': 'x', 'string': 'a'}, {'foo': 'y'}]
+
+    # Nothing searchable changed, nothing is written.
+    written = aux_rows_written()
+    row = loop.run_until_complete(storage.put('test', row['id'], row))
+    assert aux_rows_written() == written
+    assert aux_rows(row['id']) == [{'foo': 'x', 'string': 'a'}, {'foo': 'y'}]
+
+    # Only changed row is replaced.
+    row = loop.run_until_complete(storage.put('test', row['id'], dict(row, string='b')))
+    assert aux_rows_written() == written + 2
+    assert aux_rows(row['id']) == [{'foo': 'x', 'string': 'b'}, {'foo': 'y'}]
+
+    # Duplicate rows are matched one by one.
+    row = loop.run_until_complete(storage.put('test', row['id'], dict(row, list=[
+        {'foo': 'x'}, {'foo': 'y'}, {'foo': 'y'},
+    ])))
+    assert aux_rows_written() == written + 3
+    assert aux_rows(row['id']) == [{'foo': 'x', 'string': 'b'}, {'foo': 'y'}, {'foo': 'y'}]
+    row = loop.run_until_complete(storage.put('test', row['id'], dict(row, list=[{'foo': 'x'}, {'foo': 'y'}])))
+    assert aux_rows_written() == written + 4
+    assert aux_rows(row['id']) == [{'foo': 'x', 'string': 'b'}, {'foo': 'y'}]
@@ -0,0 +1,144 @@
+import asyncio
+import copy
+
+import pytest
+import sqlalchemy as sa
+
+from qvarn import backends
+from qvarn.backends import ResourceNotFound
+from qvarn.backends import StorageError
+from qvarn.backends.postgresql import get_new_id
+from qvarn.backends.postgresql import settings_to_dsn
+from qvarn.backends.sharding import MISSING
+from qvarn.backends.sharding import ShardedStorage
+from qvarn.backends.sharding import get_id_shard
+from qvarn.backends.sharding import jsonb_sort_key
+
+from tests.conftest import SETTINGS
+
+
+@pytest.fixture(scope='module')
+def sharded():
+    settings = copy.deepcopy(SETTINGS)
+    backend = settings['QVARN']['BACKEND']
+    engine = sa.create_engine(settings_to_dsn(backend), isolation_level='AUTOCOMMIT')
+    with engine.connect() as conn:
+        for dbname in ('planbtest_shard1', 'planbtest_shard2'):
+            if not conn.scalar(sa.text('SELECT 1 FROM pg_database WHERE datname = :dbname'), dbname=dbname):
+                conn.execute('CREATE DATABASE %s' % dbname)
+    backend['SHARDS'] = {
+        'shard1': {'DBNAME': 'planbtest_shard1'},
+        'shard2': {'DBNAME': 'planbtest_shard2'},
+    }
+    backend['RESOURCE_TYPE_SHARDS'] = {
+        'test': ['default', 'shard1', 'shard2'],
+        'org': 'shard2',
+    }
+    storage = asyncio.get_event_loop().run_until_complete(backends.init(settings))
+    storage.wipe_all_data('test', 'orgs')
+    yield storage
+    storage.wipe_all_data('test', 'orgs')
+
+
+def test_get_id_shard():
+    assert get_id_shard(get_new_id('test', shard=2)) == 2
+    assert get_id_shard(get_new_id('test', '448134794a2f6da110a178def79d1d8f', shard=0)) == 0
+    assert get_new_id('test', '448134794a2f6da110a178def79d1d8f', shard=0)[:37] == (
+        'ee26-448134794a2f6da110a178def79d1d00'
+    )
+    assert get_id_shard('nope') is None
+    assert get_id_shard('ee26-xx8134794a2f6da110a178def79d1dxx-e954e909') is None
+
+
+def test_jsonb_sort_key():
+    values = [{}, [1, 2], MISSING, [], True, False, 42, 4.2, 'b', 'a', None]
+    assert sorted(values, key=jsonb_sort_key) == [None, 'a', 'b', 4.2, 42, False, True, [], [1, 2], {}, MISSING]
+
+
+def test_sharded_storage(sharded):
+    loop = asyncio.get_event_loop()
+    run = loop.run_until_complete
+    assert isinstance(sharded, ShardedStorage)
+
+    created = [
+        run(sharded.create('test', {'string': 'x%d' % (i % 7), 'integer': i, 'list': [{'foo': 'ab'[i % 2 == 0]}]}))
+        for i in range(30)
+    ]
+    counts = [run(sharded.storages[name].count('test')) for name in ('default', 'shard1', 'shard2')]
+    assert sum(counts) == 30
+    assert all(counts)
+    for resource in created:
+        assert run(sharded.get('test', resource['id'])) == resource
+    assert run(sharded.count('test')) == 30
+    assert sorted(run(sharded.list('test'))) == sorted(resource['id'] for resource in created)
+
+    ids = [created[5]['id'], 'nope', created[3]['id'], get_new_id('test', shard=7)]
+    resources, missing = run(sharded.get_many('test', ids, ['integer']))
+    assert [resource['integer'] for resource in resources] == [5, 3]
+    assert missing == ids[1::2]
+
+    resource = run(sharded.put('test', created[0]['id'], dict(created[0], integer=100)))
+    assert run(sharded.get('test', created[0]['id']))['revision'] == resource['revision']
+    run(sharded.delete('test', created[1]['id']))
+    with pytest.raises(ResourceNotFound):
+        run(sharded.get('test', created[1]['id']))
+    with pytest.raises(ResourceNotFound):
+        run(sharded.get('test', 'nope'))
+
+    # Results of shards are merged in sort order and offset and limit apply to the merged results.
+    expected = sorted(
+        [resource for resource in created[2:] if resource['integer'] % 2],
+        key=lambda resource: (resource['string'], resource['integer']),
+    )
+    assert run(sharded.search('test', 'exact/foo/a/sort/string/sort/integer/count')) == {'count': 14}
+    assert run(sharded.search('test', 'exact/foo/a/exists')) == {'exists': True}
+    result = run(sharded.search('test', 'exact/foo/a/sort/string/sort/integer/offset/3/limit/5'))
+    assert result == [{'id': resource['id']} for resource in expected[3:8]]
+    result = run(sharded.search('test', 'exact/foo/a/show/integer/sort/string/sort/integer/offset/10'))
+    assert result == [{'id': resource['id'], 'integer': resource['integer']} for resource in expected[10:]]
+    result = run(sharded.search('test', 'ge/integer/28/show_all/sort/integer'))
+    assert result == [dict(resource) for resource in created[28:]] + [run(sharded.get('test', created[0]['id']))]
+    result = run(sharded.search('test', 'any/integer/3,5,7/sort/integer'))
+    assert result == [{'id': created[i]['id'], '_matched': {'integer': [str(i)]}} for i in (3, 5, 7)]
+
+    async def export():
+        return [item['resource'] async for item in sharded.export('test')]
+
+    assert sorted(resource['id'] for resource in run(export())) == sorted(
+        resource['id'] for resource in created if resource['id'] != created[1]['id']
+    )
+
+    # Stored nulls sort first and missing fields last, like in a single shard.
+    for integer in (2, None, MISSING, 1, MISSING, None):
+        run(sharded.create('test', {'string': 'm'} if integer is MISSING else {'string': 'm', 'integer': integer}))
+    result = run(sharded.search('test', 'exact/string/m/show_all/sort/integer'))
+    assert [resource.get('integer', MISSING) for resource in result] == [None, None, 1, 2, MISSING, MISSING]
+    result = run(sharded.search('test', 'exact/string/m/show_all/sort/integer/offset/3/limit/2'))
+    assert [resource.get('integer', MISSING) for resource in result] == [2, MISSING]
+
+    # Single shard resource types are stored only in their shard.
+    org = run(sharded.create('orgs', {'names': ['Orgtra']}))
+    assert run(sharded.storages['shard2'].count('orgs')) == 1
+    assert 'org' not in sharded.storages['default'].tables
+    assert [change['id'] for change in run(sharded.changes('orgs'))] == [org['id']]
+    with pytest.raises(StorageError):
+        run(sharded.changes('test'))
+
+    # Ids created while a resource type had a single shard are looked up in the first shard.
+    default = sharded.storages['default']
+    legacy = []
+    for shard in (1, 2, 200):
+        default.shards['test'] = shard
+        legacy.append(run(default.create('test', {'string': 'legacy', 'integer': shard})))
+    default.shards['test'] = 0
+    for resource in legacy:
+        assert run(sharded.get('test', resource['id'])) == resource
+    resource = run(sharded.put('test', legacy[0]['id'], dict(legacy[0], integer=101)))
+    assert run(default.get('test', legacy[0]['id']))['revision'] == resource['revision']
+    ids = [resource['id'] for resource in legacy] + [created[5]['id']]
+    resources, missing = run(sharded.get_many('test', ids, ['integer']))
+    assert [resource['integer'] for resource in resources] == [101, 2, 200, 5]
+    assert missing == []
+    run(sharded.delete('test', legacy[1]['id']))
+    with pytest.raises(ResourceNotFound):
+        run(default.get('test', legacy[1]['id']))
@@ -1,4 +1,5 @@
 import asyncio
+import copy
 import datetime
 import pathlib
 
@@ -89,10 +90,20 @@ def storage():
     return loop.run_until_complete(backends.init(SETTINGS))
 
 
-@pytest.fixture(scope='session')
-def app():
+@pytest.fixture(scope='session', params=['qvarn.backends.postgresql', 'qvarn.backends.asyncpg'])
+def backend_storage(request):
+    settings = copy.deepcopy(SETTINGS)
+    settings['QVARN']['BACKEND']['MODULE'] = request.param
+    loop = asyncio.get_event_loop()
+    return loop.run_until_complete(backends.init(settings))
+
+
+@pytest.fixture(scope='session', params=['qvarn.backends.postgresql', 'qvarn.backends.asyncpg'])
+def app(request):
+    settings = copy.deepcopy(SETTINGS)
+    settings['QVARN']['BACKEND']['MODULE'] = request.param
     loop = asyncio.get_event_loop()
-    return loop.run_until_complete(get_app(settings=SETTINGS))
+    return loop.run_until_complete(get_app(settings=settings))
 
 
 @pytest.fixture()
@@ -0,0 +1,118 @@
+import asyncio
+import copy
+
+import pytest
+
+from apistar import Response
+
+from qvarn.admission import Admission
+from qvarn.admission import admission_queue_depth
+from qvarn.admission import admission_rejected
+from qvarn.admission import admitted
+from qvarn.app import get_app
+from qvarn.exceptions import ServiceUnavailable
+
+from tests.conftest import SETTINGS
+from tests.conftest import TestClient
+
+
+def test_admission():
+    loop = asyncio.get_event_loop()
+    admission = Admission('test', limit=2, queue=2, retry_after=5)
+    handled = []
+
+    async def handle(i, release):
+        async with admission:
+            handled.append(i)
+            await release.wait()
+
+    async def run():
+        release = asyncio.Event()
+        tasks = [asyncio.ensure_future(handle(i, release)) for i in range(4)]
+        await asyncio.sleep(0)
+        assert handled == [0, 1]
+        assert admission_queue_depth.get(route_class='test') == 2
+
+        # Queue is full, more requests are rejected.
+        rejected = admission_rejected.get(route_class='test')
+        with pytest.raises(ServiceUnavailable) as e:
+            await handle(4, release)
+        assert e.value.headers == {'Retry-After': '5'}
+        assert admission_rejected.get(route_class='test') == rejected + 1
+
+        # Cancelled waiters leave the queue.
+        tasks[2].cancel()
+        await asyncio.sleep(0)
+        assert list(admission.waiters) == [admission.waiters[0]]
+
+        release.set()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        assert handled == [0, 1, 3]
+        assert admission.active == 0
+        assert admission_queue_depth.get(route_class='test') == 0
+
+    loop.run_until_complete(run())
+
+
+def test_admission_rejects():
+    settings = copy.deepcopy(SETTINGS)
+    settings['QVARN']['ADMISSION'] = {
+        'READS': {'LIMIT': 0, 'QUEUE': 0},
+        'RETRY_AFTER': 3,
+    }
+    client = TestClient(asyncio.get_event_loop().run_until_complete(get_app(settings)), 'http', 'testserver')
+    client.scopes(['uapi_test_get', 'uapi_test_search_id_get'])
+    resp = client.get('/test')
+    assert resp.status_code == 503
+    assert resp.headers['retry-after'] == '3'
+    assert resp.json()['error_code'] == 'TooManyRequests'
+    assert client.get('/test/search/exact/string/x').status_code == 200
+
+
+def test_admitted_streaming():
+    loop = asyncio.get_event_loop()
+    admission = Admission('exports', limit=1, queue=0)
+
+    async def chunks():
+        yield b'a'
+        yield b'b'
+
+    async def export():
+        return Response(chunks())
+    export.route_class = 'exports'
+
+    view = admitted({'exports': admission}, export)
+
+    async def run():
+        # Streamed response is admitted until its content is sent.
+        response = await view()
+        assert admission.active == 1
+        with pytest.raises(ServiceUnavailable):
+            await view()
+        assert [chunk async for chunk in response.content] == [b'a', b'b']
+        assert admission.active == 0
+
+        # Or until it's closed, even if nothing was sent.
+        response = await view()
+        await response.content.aclose()
+        assert admission.active == 0
+
+    loop.run_until_complete(run())
+
+
+def test_admission_exports():
+    settings = copy.deepcopy(SETTINGS)
+    settings['QVARN']['ADMISSION'] = {
+        'EXPORTS': {'LIMIT': 0, 'QUEUE': 0},
+    }
+    client = TestClient(asyncio.get_event_loop().run_until_complete(get_app(settings)), 'http', 'testserver')
+    client.scopes(['uapi_test_export_get'])
+    resp = client.get('/test/_export')
+    assert resp.status_code == 503
+    assert resp.json()['error_code'] == 'TooManyRequests'
+
+    # Admission is released once an export is sent.
+    settings['QVARN']['ADMISSION']['EXPORTS'] = {'LIMIT': 1, 'QUEUE': 0}
+    client = TestClient(asyncio.get_event_loop().run_until_complete(get_app(settings)), 'http', 'testserver')
+    client.scopes(['uapi_test_export_get'])
+    assert [client.get('/test/_export').status_code for i in range(3)] == [200] * 3
@@ -1,3 +1,7 @@
+import base64
+import json
+
+
 def org(name, gov_org_id):
     return {
         'names': [name],
@@ -58,6 +62,15 @@ def test_create_get_list_put(client):
     row = client.get('/contracts/' + data['id']).json()
     assert row == data
 
+    # get only some fields
+    row = client.get('/contracts/' + data['id'] + '?fields=contract_type,preferred_language,unknown').json()
+    assert row == {
+        'id': data['id'],
+        'revision': data['revision'],
+        'contract_type': 'tilaajavastuu_account',
+        'preferred_language': 'lt',
+    }
+
     # list
     resp = client.get('/contracts').json()
     ids = {x['id'] for x in resp['resources']}
@@ -143,6 +156,33 @@ def test_wrong_revision(client):
     assert row == data
 
 
+def test_validation(client):
+    client.scopes([
+        'uapi_contracts_post',
+        'uapi_contracts_id_put',
+        'uapi_persons_post',
+        'uapi_persons_private_id_put',
+    ])
+
+    resp = client.post('/contracts', json={'type': 'contract', 'contract_type': 1})
+    assert resp.status_code == 400
+    assert resp.json() == {
+        'error_code': 'WrongType',
+        'field': 'contract_type',
+        'message': 'Field contract_type should be a string, got int.',
+    }
+
+    row = client.post('/contracts', json={'type': 'contract', 'contract_type': 'original'}).json()
+    resp = client.put('/contracts/' + row['id'], json={'revision': row['revision'], 'wrong': 'x'})
+    assert resp.status_code == 400
+    assert resp.json()['error_code'] == 'UnknownField'
+
+    row = client.post('/persons', json={'names': [{'full_name': 'James Bond'}]}).json()
+    resp = client.put('/persons/%s/private' % row['id'], json={'revision': row['revision'], 'gov_ids': {}})
+    assert resp.status_code == 400
+    assert resp.json()['field'] == 'gov_ids'
+
+
 def test_subresource(client):
     client.scopes([
         'uapi_persons_post',
@@ -275,6 +315,49 @@ def test_files(client, storage):
     assert resp.headers['content-type'] == 'image/png'
 
 
+def test_export(client, storage):
+    storage.wipe_all_data('persons')
+
+    client.scopes([
+        'uapi_persons_post',
+        'uapi_persons_private_id_put',
+        'uapi_persons_photo_id_put',
+        'uapi_persons_export_get',
+    ])
+
+    a = client.post('/persons', json={'names': [{'full_name': 'James Bond'}]}).json()
+    b = client.post('/persons', json={'names': [{'full_name': 'Miss Moneypenny'}]}).json()
+    private = client.put(f'/persons/{a["id"]}/private', json={
+        'revision': a['revision'],
+        'date_of_birth': '1920-11-11',
+    }).json()
+    photo = client.put(f'/persons/{b["id"]}/photo', data=b'image', headers={
+        'content-type': 'image/png',
+        'revision': b['revision'],
+    }).json()
+
+    resp = client.get('/persons/_export', headers={'accept-encoding': 'identity'})
+    assert resp.headers['content-type'] == 'application/x-ndjson'
+    assert 'content-encoding' not in resp.headers
+    lines = sorted(
+        (json.loads(line) for line in resp.content.splitlines()),
+        key=lambda line: line['resource']['id'] != a['id'],
+    )
+    assert [line['resource']['id'] for line in lines] == [a['id'], b['id']]
+    assert lines[0]['resource']['revision'] == private['revision']
+    assert lines[0]['resource']['names'][0]['full_name'] == 'James Bond'
+    assert lines[0]['subpaths']['private']['date_of_birth'] == '1920-11-11'
+    assert lines[1]['resource']['revision'] == photo['revision']
+    assert lines[1]['subpaths']['photo'] == {'content-type': 'image/png'}
+    assert 'files' not in lines[1]
+
+    # Response is decompressed by requests.
+    resp = client.get('/persons/_export?files=true', headers={'accept-encoding': 'gzip'})
+    assert resp.headers['content-encoding'] == 'gzip'
+    lines = [json.loads(line) for line in resp.content.splitlines()]
+    assert sorted(line['files'].get('photo', '') for line in lines) == ['', base64.b64encode(b'image').decode()]
+
+
 def test_search_exact(client, storage):
     storage.wipe_all_data('orgs')
 
@@ -313,6 +396,52 @@ def test_search_exact(client, storage):
     }
 
 
+def test_search_any(client, storage):
+    storage.wipe_all_data('orgs')
+
+    client.scopes([
+        'uapi_orgs_post',
+        'uapi_orgs_search_id_get',
+    ])
+
+    ids = [
+        client.post('/orgs', json={
+            'names': ['Company %d' % i],
+            'gov_org_ids': [{'country': 'FI', 'gov_org_id': '123-%d' % i}, {'country': 'FI', 'gov_org_id': 'x-%d' % i}],
+        }).json()['id']
+        for i in range(4)
+    ]
+
+    resp = client.get('/orgs/search/any/gov_org_id/123-1,X-2,x-1,nope/sort/names')
+    assert resp.json() == {
+        'resources': [
+            {'id': ids[1], '_matched': {'gov_org_id': ['123-1', 'x-1']}},
+            {'id': ids[2], '_matched': {'gov_org_id': ['X-2']}},
+        ],
+    }
+
+    resp = client.get('/orgs/search/any/gov_org_id/123-0/show/names')
+    assert resp.json() == {
+        'resources': [
+            {'id': ids[0], 'names': ['Company 0'], '_matched': {'gov_org_id': ['123-0']}},
+        ],
+    }
+
+    assert client.get('/orgs/search/any/gov_org_id/123-0,123-3/count').json() == {'count': 2}
+
+    resp = client.get('/orgs/search/any/names/company 0,company 1,company 2/not_any/gov_org_id/123-1,x-1')
+    assert sorted(resource['id'] for resource in resp.json()['resources']) == sorted(ids[0:3:2])
+
+    # A resource with one of the values is not found, even if it has other values too.
+    resp = client.get('/orgs/search/any/names/company 0,company 1,company 2/not_any/gov_org_id/123-1')
+    assert sorted(resource['id'] for resource in resp.json()['resources']) == sorted(ids[0:3:2])
+
+    # Resources without the field are found.
+    other = client.post('/orgs', json={'names': ['Company 4']}).json()['id']
+    resp = client.get('/orgs/search/any/names/company 3,company 4/not_any/gov_org_id/123-3')
+    assert [resource['id'] for resource in resp.json()['resources']] == [other]
+
+
 def test_search_startswith(client, storage):
     storage.wipe_all_data('orgs')
 
@@ -448,3 +577,119 @@ def test_search_show_all(client, storage):
             },
         ],
     }
+
+
+def test_changes(client, storage):
+    storage.wipe_all_data('test')
+
+    client.scopes([
+        'uapi_test_post',
+        'uapi_test_id_put',
+        'uapi_test_id_delete',
+        'uapi_test_changes_get',
+    ])
+
+    since = client.get('/test/_changes').json()['last']
+
+    a = client.post('/test', json={'string': 'a'}).json()
+    b = client.put('/test/' + a['id'], json=dict(a, string='b')).json()
+    client.delete('/test/' + a['id'])
+
+    resp = client.get(f'/test/_changes?since={since}').json()
+    assert [(x['id'], x['revision'], x['change']) for x in resp['changes']] == [
+        (a['id'], a['revision'], 'created'),
+        (a['id'], b['revision'], 'updated'),
+        (a['id'], None, 'deleted'),
+    ]
+    assert resp['last'] == resp['changes'][-1]['seq']
+    assert since < resp['changes'][0]['seq'] < resp['changes'][1]['seq'] < resp['changes'][2]['seq']
+
+    # Nothing new happened, wait for changes times out.
+    assert client.get(f'/test/_changes?since={resp["last"]}&wait=0.1').json() == {
+        'changes': [],
+        'last': resp['last'],
+    }
+
+    resp = client.get(f'/test/_changes?since={resp["changes"][0]["seq"]}&limit=1').json()
+    assert [x['change'] for x in resp['changes']] == ['updated']
+
+
+def test_search_count_exists(client, storage):
+    storage.wipe_all_data('orgs')
+
+    client.scopes([
+        'uapi_orgs_post',
+        'uapi_orgs_search_id_get',
+    ])
+
+    client.post('/orgs', json=org('foo', '123'))
+    client.post('/orgs', json=org('bar', '456'))
+    client.post('/orgs', json=org('baz', '123'))
+
+    assert client.get('/orgs/search/exact/gov_org_id/123/count').json() == {'count': 2}
+    assert client.get('/orgs/search/count/startswith/names/ba').json() == {'count': 2}
+    assert client.get('/orgs/search/count').json() == {'count': 3}
+    assert client.get('/orgs/search/exact/names/foo/exists').json() == {'exists': True}
+    assert client.get('/orgs/search/exact/names/qux/exists').json() == {'exists': False}
+
+
+def test_list_count(client, storage):
+    storage.wipe_all_data('orgs')
+
+    client.scopes([
+        'uapi_orgs_get',
+        'uapi_orgs_post',
+    ])
+
+    client.post('/orgs', json=org('foo', '123'))
+    client.post('/orgs', json=org('bar', '456'))
+
+    assert client.get('/orgs?count=exact').json() == {'count': 2}
+    assert client.get('/orgs?count=estimate').json()['count'] >= 0
+    assert client.get('/orgs?count=wrong').status_code == 400
+
+
+def test_batch_get(client, storage):
+    storage.wipe_all_data('orgs')
+
+    client.scopes([
+        'uapi_orgs_post',
+        'uapi_orgs_id_get',
+    ])
+
+    a = client.post('/orgs', json=org('foo', '123')).json()
+    b = client.post('/orgs', json=org('bar', '456')).json()
+
+    assert client.get(f'/orgs/_batch?ids={b["id"]},missing,{a["id"]}').json() == {
+        'resources': [b, a],
+        'missing': ['missing'],
+    }
+
+    assert client.get(f'/orgs/_batch?ids={a["id"]}&fields=names,unknown').json() == {
+        'resources': [{'id': a['id'], 'revision': a['revision'], 'names': ['foo']}],
+        'missing': [],
+    }
+
+    assert client.post('/orgs/_batch', json={'ids': [a['id'], 'missing'], 'fields': ['country']}).json() == {
+        'resources': [{'id': a['id'], 'revision': a['revision'], 'country': 'FI'}],
+        'missing': ['missing'],
+    }
+
+    assert client.post('/orgs/_batch', json={'wrong': []}).status_code == 400
+    for data in [{'ids': a['id']}, {'ids': [1, 2]}, {'ids': [a['id'], None]}]:
+        resp = client.post('/orgs/_batch', json=data)
+        assert resp.status_code == 400
+        assert resp.json()['error_code'] == 'InvalidBatchRequest'
+    for fields in ['names', ['names', 1], {'names': True}]:
+        resp = client.post('/orgs/_batch', json={'ids': [a['id']], 'fields': fields})
+        assert resp.status_code == 400
+        assert resp.json()['error_code'] == 'InvalidBatchRequest'
+
+
+def test_metrics(client):
+    client.scopes(['uapi_test_post'])
+    client.post('/test', json={'string': 'a'})
+
+    resp = client.get('/_metrics')
+    assert resp.headers['content-type'].startswith('text/plain')
+    assert 'qvarn_aux_rows_written_count{resource_type="test"}' in resp.text
@@ -0,0 +1,100 @@
+import asyncio
+import gzip
+import json
+
+import pytest
+
+from qvarn.compression import Compression
+from qvarn.compression import parse_accept_encoding
+
+
+class Channel:
+
+    def __init__(self):
+        self.messages = []
+
+    async def send(self, message):
+        self.messages.append(message)
+
+
+def reply(compression, accept_encoding, *messages):
+    channel = Channel()
+    reply = compression.reply_channel({'headers': [[b'accept-encoding', accept_encoding.encode()]]}, channel)
+    loop = asyncio.get_event_loop()
+    for message in messages:
+        loop.run_until_complete(reply.send(message))
+    return channel.messages
+
+
+def response(content, content_type=b'application/json', **kwargs):
+    return dict({'status': 200, 'headers': [[b'content-type', content_type]], 'content': content}, **kwargs)
+
+
+def test_parse_accept_encoding():
+    assert parse_accept_encoding('gzip, deflate;q=0.5, br;q=0,  *;q=x') == {
+        'gzip': 1.0,
+        'deflate': 0.5,
+        'br': 0.0,
+        '*': 0.0,
+    }
+
+
+def test_get_encoding():
+    compression = Compression()
+    compression.encodings = ('br', 'gzip')
+    assert compression.get_encoding('') is None
+    assert compression.get_encoding('identity') is None
+    assert compression.get_encoding('gzip, deflate') == 'gzip'
+    assert compression.get_encoding('gzip, br') == 'br'
+    assert compression.get_encoding('gzip, br;q=0.5') == 'gzip'
+    assert compression.get_encoding('*, gzip;q=0') == 'br'
+    assert compression.get_encoding('br;q=0, gzip;q=0') is None
+    compression.encodings = ('gzip',)
+    assert compression.get_encoding('br') is None
+
+
+def test_compress():
+    compression = Compression(min_size=100)
+    content = json.dumps(list(range(100))).encode()
+
+    message, = reply(compression, 'gzip', response(content))
+    assert [b'content-encoding', b'gzip'] in message['headers']
+    assert [b'vary', b'Accept-Encoding'] in message['headers']
+    assert gzip.decompress(message['content']) == content
+
+    # Small, already encoded and not compressible responses are sent as is.
+    assert reply(compression, 'gzip', response(content[:50])) == [response(content[:50])]
+    assert reply(compression, 'gzip', response(content, b'image/png')) == [response(content, b'image/png')]
+    encoded = response(content, headers=[[b'content-type', b'application/json'], [b'content-encoding', b'gzip']])
+    assert reply(compression, 'gzip', encoded) == [encoded]
+    assert reply(compression, 'identity', response(content)) == [response(content)]
+
+
+def test_compress_in_executor():
+    compression = Compression(min_size=100, executor_min_size=1000)
+    content = json.dumps(list(range(1000))).encode()
+    message, = reply(compression, 'gzip', response(content))
+    assert gzip.decompress(message['content']) == content
+
+
+def test_compress_stream():
+    compression = Compression(min_size=100)
+    chunks = [b'{"n": %d}\n' % i for i in range(3)]
+    messages = reply(
+        compression, 'gzip',
+        response(b'', b'application/x-ndjson', more_content=True),
+        *({'content': chunk, 'more_content': True} for chunk in chunks),
+        {'content': b'', 'more_content': False},
+    )
+    assert [b'content-encoding', b'gzip'] in messages[0]['headers']
+    assert [message.get('more_content') for message in messages] == [True, True, True, True, False]
+    assert gzip.decompress(b''.join(message['content'] for message in messages)) == b''.join(chunks)
+
+
+def test_compress_brotli():
+    brotli = pytest.importorskip('brotli')
+    compression = Compression(min_size=100)
+    content = json.dumps(list(range(100))).encode()
+    message, = reply(compression, 'gzip, br', response(content))
+    assert [b'content-encoding', b'br'] in message['headers']
+    assert brotli.decompress(message['content']) == content
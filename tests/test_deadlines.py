@@ -0,0 +1,43 @@
+import asyncio
+import copy
+
+from qvarn import deadlines
+from qvarn.app import get_app
+
+from tests.conftest import SETTINGS
+from tests.conftest import TestClient
+
+
+def test_deadlines():
+    loop = asyncio.get_event_loop()
+
+    async def run():
+        assert deadlines.get_timeout() is None
+        deadlines.set_deadline(10)
+        assert 9 < deadlines.get_timeout() <= 10
+        assert 9 < await deadlines.inherit(get_timeout()) <= 10
+        assert await asyncio.ensure_future(get_timeout()) is None
+        deadlines.set_deadline(None)
+        assert deadlines.get_timeout() is None
+
+    async def get_timeout():
+        return deadlines.get_timeout()
+
+    loop.run_until_complete(run())
+
+
+def test_request_deadline():
+    settings = copy.deepcopy(SETTINGS)
+    settings['QVARN']['DEADLINES'] = {'SEARCHES': 0.000001}
+    client = TestClient(asyncio.get_event_loop().run_until_complete(get_app(settings)), 'http', 'testserver')
+    client.scopes(['uapi_test_get', 'uapi_test_search_id_get'])
+
+    resp = client.get('/test/search/exact/string/x')
+    assert resp.status_code == 503
+    assert resp.json()['error_code'] == 'RequestTimeout'
+
+    assert client.get('/test', headers={'Request-Timeout': '10'}).status_code == 200
+    resp = client.get('/test', headers={'Request-Timeout': 'soon'})
+    assert resp.status_code == 400
+    assert resp.json()['error_code'] == 'InvalidRequestTimeout'
+    assert client.get('/test', headers={'Request-Timeout': '0.000001'}).status_code == 503
@@ -0,0 +1,71 @@
+import asyncio
+import copy
+import json
+
+from qvarn import deadlines
+from qvarn import timing
+from qvarn.app import get_app
+
+from tests.conftest import SETTINGS
+from tests.conftest import TestClient
+
+
+def get_client(settings):
+    client = TestClient(asyncio.get_event_loop().run_until_complete(get_app(settings)), 'http', 'testserver')
+    client.scopes(['uapi_test_post', 'uapi_test_get', 'uapi_test_id_get'])
+    return client
+
+
+def get_phases(resp):
+    return {
+        name: float(duration[len('dur='):])
+        for name, duration in (item.split(';') for item in resp.headers['server-timing'].split(', '))
+    }
+
+
+def test_timing_inherited():
+    loop = asyncio.get_event_loop()
+
+    async def run():
+        timing._timings[deadlines.current_task()] = request = timing.Timing()
+        with timing.phase('outer'):
+            await deadlines.inherit(inner())
+        del timing._timings[deadlines.current_task()]
+        return request
+
+    async def inner():
+        timing.record('inner', timing.now())
+
+    assert [name for name, start, end in loop.run_until_complete(run()).spans] == ['inner', 'outer']
+
+
+def test_server_timing(tmpdir):
+    settings = copy.deepcopy(SETTINGS)
+    settings['QVARN']['TIMING'] = {'ENABLED': True, 'TRACE_FILE': str(tmpdir / 'trace.jsonl')}
+    client = get_client(settings)
+
+    resp = client.post('/test', json={'string': 'x'})
+    assert resp.status_code == 200
+    phases = get_phases(resp)
+    assert {'auth', 'scopes', 'validate', 'flatten', 'pool', 'db', 'render', 'total'} <= set(phases)
+    assert all(duration >= 0 for duration in phases.values())
+    assert phases['total'] >= phases['db']
+
+    assert 'server-timing' in client.get('/test/nope').headers
+
+    traces = [json.loads(line) for line in (tmpdir / 'trace.jsonl').read_text('utf-8').splitlines()]
+    assert [(trace['method'], trace['path'], trace['status']) for trace in traces] == [
+        ('POST', '/test', resp.status_code),
+        ('GET', '/test/nope', 404),
+    ]
+    assert {span['name'] for span in traces[0]['spans']} == set(phases) - {'total'}
+
+
+def test_server_timing_token():
+    settings = copy.deepcopy(SETTINGS)
+    settings['QVARN']['TIMING'] = {'TOKEN': 'secret'}
+    client = get_client(settings)
+
+    assert 'server-timing' not in client.get('/test').headers
+    assert 'server-timing' not in client.get('/test', headers={'Qvarn-Timing': 'wrong'}).headers
+    assert 'db' in get_phases(client.get('/test', headers={'Qvarn-Timing': 'secret'}))
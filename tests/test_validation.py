@@ -0,0 +1,68 @@
+import pytest
+
+from qvarn.validation import ValidationError
+from qvarn.validation import Validator
+from qvarn.validation import get_validator
+
+
+PROTOTYPE = {
+    'id': '',
+    'revision': '',
+    'type': '',
+    'integer': 0,
+    'float': 0.0,
+    'boolean': False,
+    'list': [
+        {'foo': '', 'numbers': [0]},
+    ],
+    'any': None,
+}
+
+
+def test_validate():
+    validator = Validator(PROTOTYPE)
+    data = {
+        'id': 'x',
+        'revision': 'y',
+        'integer': 3.0,
+        'float': 2,
+        'boolean': None,
+        'list': [{'foo': 'a', 'numbers': [1, 2.0, None]}, None],
+        'any': {'anything': [1]},
+    }
+    assert validator.validate(data) == {
+        'integer': 3,
+        'float': 2.0,
+        'boolean': None,
+        'list': [{'foo': 'a', 'numbers': [1, 2, None]}, None],
+        'any': {'anything': [1]},
+    }
+    assert type(data['integer']) is int
+    assert type(data['float']) is float
+    assert validator.validate({}) == {}
+
+
+@pytest.mark.parametrize('data, error_code, field', [
+    ([], 'WrongType', ''),
+    ({'nope': 1}, 'UnknownField', 'nope'),
+    ({'type': 1}, 'WrongType', 'type'),
+    ({'integer': True}, 'WrongType', 'integer'),
+    ({'integer': 1.5}, 'WrongType', 'integer'),
+    ({'integer': '1'}, 'WrongType', 'integer'),
+    ({'float': '1.5'}, 'WrongType', 'float'),
+    ({'boolean': 0}, 'WrongType', 'boolean'),
+    ({'list': {}}, 'WrongType', 'list'),
+    ({'list': ['foo']}, 'WrongType', 'list[0]'),
+    ({'list': [{}, {'bar': ''}]}, 'UnknownField', 'list[1].bar'),
+    ({'list': [{'numbers': [1, 'x']}]}, 'WrongType', 'list[0].numbers[1]'),
+])
+def test_validate_errors(data, error_code, field):
+    with pytest.raises(ValidationError) as e:
+        Validator(PROTOTYPE).validate(data)
+    assert e.value.error_code == error_code
+    assert e.value.field == field
+
+
+def test_get_validator():
+    assert get_validator(PROTOTYPE) is get_validator(dict(PROTOTYPE))
+    assert get_validator(PROTOTYPE) is not get_validator({'type': ''})